@@ -0,0 +1,1020 @@
+"""
+ココトシのベンチマーク。
+
+    python benchmark.py                              # 全部（負荷試験以外）を 1千・1万・10万件で
+    python benchmark.py --sizes 1000,10000 --only tree,routes
+    python benchmark.py --json bench.json            # 結果をJSONに保存
+    python benchmark.py --json new.json --compare bench.json   # 前回の結果と比べる（遅くなったら終了コード1）
+
+台帳は make_ledger_rows で合成する（親＋子カードのチェーン、空売り、ウォッチ、感情5種・目的5種、メモ）。
+同じ seed なら毎回同じ台帳になるので、コミット間で結果を比べられる。
+ルートは Flask のテストクライアント、コア関数は直接呼んで、それぞれ最速値を記録する。
+/summary はページ単位でSQLを発行するので、保有数が増えても時間がほぼ一定になる。
+負荷試験（--only concurrency）では gunicorn のワーカーに見立てた複数プロセスで読み書きを同時に流し、
+従来の「毎回 connect・rollback journal」と「接続の使い回し・WAL」を比べる。
+--only server では実際に gunicorn を起動し、従来の sync ワーカーと gunicorn.conf.py（gthread）を
+数百の同時接続で比べる（req/s と p99）。
+--only shards では同時に書き込むユーザー数を増やし、1つのDBを共用する場合とユーザーごとのシャードを比べる。
+CSV取り込みは1トランザクション・executemany なので10万行でも数秒で終わる。
+"""
+import argparse
+import asyncio
+import gc
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+import cocotoshi
+from cocotoshi import build_trade_tree
+
+DEFAULT_SIZES = (1_000, 10_000, 100_000)
+DEFAULT_SEED = 0
+
+MEMO_PHRASES = [
+    "25日移動平均線タッチのため買い", "決算跨ぎは避ける", "レジスタンスラインをブレイク",
+    "下げトレンドの戻り売り", "ロスカット予定", "利益確定を検討", "押し目買い", "高値掴みで損切り",
+    "配当狙いで長期保有", "優待目的", "出来高急増", "地合いが悪い",
+]
+
+# 計測結果 {名前: {件数: 秒}}。--json で保存する
+RESULTS = {}
+
+
+def record(name, n, seconds):
+    RESULTS.setdefault(name, {})[str(n)] = round(seconds, 6)
+    return seconds
+
+
+# ===============================
+# 合成台帳
+# ===============================
+def pick_companies(count=300, seed=DEFAULT_SEED):
+    """
+    code2company から銘柄を count 件選ぶ（無ければ「銘柄XXXX」）。
+    """
+    rnd = random.Random(seed)
+    try:
+        table = cocotoshi.get_company_index()
+        codes = sorted(table)
+        return [(code, table[code]) for code in rnd.sample(codes, min(count, len(codes)))]
+    except OSError:
+        return [("%04d" % (1300 + i), "銘柄%d" % (1300 + i)) for i in range(count)]
+
+
+def make_ledger_rows(n, seed=DEFAULT_SEED, short_ratio=0.2, watch_ratio=0.05, closed_ratio=0.6):
+    """
+    trades テーブルと同じ列順のタプルを n 件作る。
+      - 約5%はウォッチカード（親だけ・数量0）
+      - 残りは親カード＋子カード（追加・一部決済・決済）のチェーン。子は親と同じ銘柄で日付は親以降
+      - チェーンの約2割は空売り（売りの親＋買い戻しの子）、約6割は最後まで決済する
+      - 感情・目的は5種類すべて、メモは約半分のカードに入れる
+    """
+    rnd = random.Random(seed)
+    companies = pick_companies(seed=seed)
+    start = date(2015, 1, 1)
+    rows = []
+
+    def add(type, code, stock, price, quantity, day, parent_id, purpose):
+        memo = "。".join(rnd.sample(MEMO_PHRASES, rnd.randint(1, 3))) if rnd.random() < 0.5 else ""
+        rows.append((
+            len(rows) + 1, type, stock, price, quantity, price * quantity,
+            (start + timedelta(days=day)).isoformat(), rnd.randint(0, 4), memo,
+            parent_id, code, None, str(purpose),
+        ))
+        return len(rows)
+
+    while len(rows) < n:
+        code, stock = rnd.choice(companies)
+        price = rnd.randint(50, 500) * 10
+        day = rnd.randint(0, 3650)
+        purpose = rnd.randint(0, 4)
+        if rnd.random() < watch_ratio:
+            add("watch", code, stock, price, 0, day, None, purpose)
+            continue
+
+        short = rnd.random() < short_ratio
+        open_type, close_type = ("sell", "buy") if short else ("buy", "sell")
+        remaining = rnd.randint(1, 10) * 100
+        parent_id = add(open_type, code, stock, price, remaining, day, None, purpose)
+        for _ in range(rnd.randint(0, 4)):
+            if len(rows) >= n:
+                break
+            day += rnd.randint(1, 60)
+            price = max(10, price + rnd.randint(-50, 50) * 10)
+            if rnd.random() < 0.3:
+                quantity = rnd.randint(1, 5) * 100
+                add(open_type, code, stock, price, quantity, day, parent_id, purpose)
+                remaining += quantity
+            else:
+                quantity = min(rnd.randint(1, max(1, remaining // 100)) * 100, remaining)
+                add(close_type, code, stock, price, quantity, day, parent_id, purpose)
+                remaining -= quantity
+                if remaining == 0:
+                    break
+        if remaining and rnd.random() < closed_ratio and len(rows) < n:
+            day += rnd.randint(1, 60)
+            add(close_type, code, stock, max(10, price + rnd.randint(-50, 50) * 10), remaining, day, parent_id, purpose)
+    return rows
+
+
+def make_ledger_db(path, n, seed=DEFAULT_SEED):
+    """
+    合成台帳 n 件を入れた SQLite ファイルを作り、マイグレーション（positions・全文検索など）まで流す。
+    """
+    with sqlite3.connect(path) as conn:
+        conn.execute("""
+            CREATE TABLE trades (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                type TEXT, stock TEXT, price REAL, quantity INTEGER, total REAL, date TEXT,
+                feeling INTEGER, memo TEXT, parent_id INTEGER, code TEXT,
+                remaining_quantity INTEGER, purpose TEXT
+            )
+        """)
+        conn.executemany(
+            "INSERT INTO trades VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            make_ledger_rows(n, seed)
+        )
+    original = cocotoshi.DATABASE
+    cocotoshi.DATABASE = path
+    try:
+        cocotoshi.init_db()
+    finally:
+        cocotoshi.close_db()
+        cocotoshi.DATABASE = original
+
+
+def make_broker_csv(n, seed=DEFAULT_SEED):
+    """
+    証券会社CSVに見立てた n 行の文字列（日本語ヘッダ・YYYY/MM/DD）を作る。
+    """
+    rnd = random.Random(seed)
+    lines = ["約定日,銘柄コード,銘柄名,売買,約定単価,数量"]
+    for i in range(n):
+        code = 1300 + rnd.randint(0, 499)
+        lines.append("2025/%02d/%02d,%d,銘柄%d,%s,%d,%d" % (
+            rnd.randint(1, 12), rnd.randint(1, 28), code, code,
+            rnd.choice(["買", "買", "売"]), rnd.randint(500, 5000), rnd.randint(1, 10) * 100,
+        ))
+    return "\n".join(lines) + "\n"
+
+
+def make_price_csv(codes, days=250, seed=DEFAULT_SEED):
+    """
+    codes の各銘柄について days 営業日分の終値CSV（code, date, close）を作る。
+    """
+    rnd = random.Random(seed)
+    start = date(2025, 1, 1)
+    lines = ["code,date,close"]
+    for code in codes:
+        price = rnd.randint(100, 5000)
+        for i in range(days):
+            price = max(1, price + rnd.randint(-30, 30))
+            lines.append(f"{code},{(start + timedelta(days=i)).isoformat()},{price}")
+    return "\n".join(lines) + "\n"
+
+
+def timeit(func, *args, repeat=3):
+    """
+    最速値（秒）を返す。標準の timeit と同じく計測中はGCを止める。
+    """
+    best = None
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            func(*args)
+            elapsed = time.perf_counter() - t0
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return best
+
+
+class use_database:
+    """
+    with use_database(path): の間だけ cocotoshi.DATABASE を差し替える（接続とキャッシュも切り替える）。
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self.original = cocotoshi.DATABASE
+        cocotoshi.close_db()
+        cocotoshi.result_cache.clear()
+        cocotoshi.fragment_cache.clear()
+        cocotoshi.DATABASE = self.path
+
+    def __exit__(self, *exc):
+        cocotoshi.close_db()
+        cocotoshi.result_cache.clear()
+        cocotoshi.fragment_cache.clear()
+        cocotoshi.DATABASE = self.original
+
+
+# ===============================
+# コア関数
+# ===============================
+def bench_build_trade_tree(sizes=DEFAULT_SIZES, seed=DEFAULT_SEED):
+    print("build_trade_tree")
+    for n in sizes:
+        rows = make_ledger_rows(n, seed)
+        elapsed = record("build_trade_tree", n, timeit(build_trade_tree, rows))
+        print(f"  {n:>7,} 件: {elapsed * 1000:9.1f} ms  ({elapsed / n * 1e6:.2f} µs/件)")
+
+
+def _current_rss_kb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _tree_memory(n, seed):
+    """
+    （別プロセスで）台帳 n 件から build_trade_tree を作り、ツリーが持つメモリを測る。
+    戻り値: (RSSの増分KB, tracemalloc の最大KB, ツリーが保持しているブロック数)
+    tracemalloc 自体もメモリを使うので、RSS は tracemalloc を止めた1回目で測る。
+    """
+    rows = make_ledger_rows(n, seed)
+    gc.collect()
+    rss_before = _current_rss_kb()
+    trade_tree = build_trade_tree(rows)
+    rss = _current_rss_kb() - rss_before
+    del trade_tree
+    gc.collect()
+
+    tracemalloc.start()
+    trade_tree = build_trade_tree(rows)
+    peak = tracemalloc.get_traced_memory()[1]
+    blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+    tracemalloc.stop()
+    return rss, peak / 1024, blocks
+
+
+def bench_tree_memory(sizes=DEFAULT_SIZES, seed=DEFAULT_SEED):
+    """
+    build_trade_tree のメモリ（RSSの増分・tracemalloc の最大・保持ブロック数）。
+    RSS は他の計測の影響を受けないよう、件数ごとに新しいプロセスで測る。
+    """
+    print("build_trade_tree メモリ")
+    ctx = multiprocessing.get_context("spawn")
+    for n in sizes:
+        with ctx.Pool(1) as pool:
+            rss_kb, peak_kb, blocks = pool.apply(_tree_memory, (n, seed))
+        record("tree memory rss_kb", n, rss_kb)
+        record("tree memory peak_kb", n, peak_kb)
+        record("tree memory blocks", n, blocks)
+        print(f"  {n:>7,} 件: RSS +{rss_kb / 1024:7.1f} MB  tracemalloc 最大 {peak_kb / 1024:7.1f} MB  "
+              f"ブロック {blocks:,}（{blocks / n:.1f}/件）")
+
+
+MATRIX_CASES = (
+    ("date_desc", None, None),
+    ("profit_desc", None, None),
+    ("date_desc", "2020-01-01", "2020-12-31"),
+)
+
+
+def bench_matrix(sizes=DEFAULT_SIZES, seed=DEFAULT_SEED, cases=MATRIX_CASES):
+    """
+    /matrix の集計（build_matrix_analytics: 日次集計の合計・件数・並べ替えたページの読み出し）を測る。
+    結果キャッシュは通さず、並び順と期間を変えて1ページ目を作る。
+    """
+    print("build_matrix_analytics")
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            db_path = os.path.join(tmp, f"ledger_{n}.db")
+            make_ledger_db(db_path, n, seed)
+            print(f"  {n:,} 件")
+            with use_database(db_path), cocotoshi.app.app_context():
+                for sort, start, end in cases:
+                    label = f"{sort} {start or ''}〜{end or ''}"
+                    elapsed = record(f"matrix {label}", n,
+                                     timeit(cocotoshi.build_matrix_analytics, start, end, sort, 1))
+                    print(f"    {label:<34} {elapsed * 1000:9.1f} ms")
+
+
+def bench_equity_curve(sizes=DEFAULT_SIZES, seed=DEFAULT_SEED):
+    """
+    決済日 n 日分の日次集計行から損益曲線（累計・ドローダウン・移動勝率・LTTB 間引き）を作る時間と、
+    ブラウザに送る JSON の大きさ（日数が増えても EQUITY_POINTS 点で頭打ちのはず）。
+    """
+    print("損益曲線（equity_curve）")
+    rng = np.random.default_rng(seed)
+    for n in sizes:
+        start = date(2000, 1, 1)
+        counts = rng.integers(1, 6, n)
+        rows = [
+            ((start + timedelta(days=i)).isoformat(), float(profit), int(count), int(wins))
+            for i, (profit, count, wins) in enumerate(zip(
+                rng.normal(2_000, 50_000, n).round(), counts, rng.binomial(counts, 0.5)))
+        ]
+        elapsed = record("equity_curve", n, timeit(cocotoshi.equity_curve, rows))
+        curve = cocotoshi.equity_curve(rows)
+        size = len(json.dumps(curve, ensure_ascii=False, separators=(",", ":")))
+        print(f"  {n:>7,} 日: {elapsed * 1000:8.1f} ms  {len(curve['dates']):,} 点  JSON {size / 1024:.1f} KB")
+
+
+def bench_company_search(seed=DEFAULT_SEED,
+                         queries=("1", "13", "130", "1301", "7203", "ｉＦｒｅｅ", "ifree etf", "トヨタ", "極", "zzz")):
+    """
+    銘柄の前方一致検索1回あたりの時間（目標は1ms未満）。
+    """
+    print("company_search")
+    index = cocotoshi.get_company_index()
+    for q in queries:
+        loops = 1000
+        elapsed = timeit(lambda: [index.search(q, 10) for _ in range(loops)]) / loops
+        record("company_search", q, elapsed)
+        print(f"  {q!r:>14}: {elapsed * 1e6:7.1f} µs  ({len(index.search(q, 10))} 件)")
+
+
+STARTUP_SCRIPT = """
+import json, sys, time
+t0 = time.perf_counter()
+import cocotoshi
+t1 = time.perf_counter()
+if sys.argv[1] == "dict":
+    table = cocotoshi.load_code2company(cocotoshi.CODE2COMPANY_CSV)
+else:
+    table = cocotoshi.code2company.load()
+table.get("1301")
+t2 = time.perf_counter()
+status = dict(line.split(":", 1) for line in open("/proc/self/status") if ":" in line)
+print(json.dumps({
+    "import_ms": (t1 - t0) * 1000,
+    "first_lookup_ms": (t2 - t1) * 1000,
+    "rss_anon_kb": int(status.get("RssAnon", "0 kB").split()[0]),
+    "rss_file_kb": int(status.get("RssFile", "0 kB").split()[0]),
+}))
+"""
+
+
+def bench_startup(seed=DEFAULT_SEED):
+    """
+    ワーカー起動時の import 時間と、code2company を使った後のメモリ（Linux のみ）。
+    dict: 従来どおりCSVをdictに読み込む / mmap: コンパイル済みバイナリを共有
+    RssAnon はワーカー固有のメモリ、RssFile はプロセス間で共有できるページ。
+    """
+    print("起動時間とメモリ（code2company）")
+    here = os.path.dirname(os.path.abspath(__file__))
+    for mode in ("dict", "mmap"):
+        out = subprocess.run(
+            [sys.executable, "-c", STARTUP_SCRIPT, mode],
+            cwd=os.getcwd(), env=dict(os.environ, PYTHONPATH=here),
+            capture_output=True, text=True, check=True,
+        ).stdout
+        r = json.loads(out.strip().splitlines()[-1])
+        record("startup import", mode, r["import_ms"] / 1000)
+        record("startup first_lookup", mode, r["first_lookup_ms"] / 1000)
+        print(f"  {mode:>4}: import {r['import_ms']:6.1f} ms  初回参照 {r['first_lookup_ms']:6.1f} ms"
+              f"  RssAnon {r['rss_anon_kb']:,} kB  RssFile {r['rss_file_kb']:,} kB")
+
+
+# ===============================
+# ルート（Flask テストクライアント）
+# ===============================
+ROUTES = (
+    "/summary",
+    "/matrix",
+    "/matrix?sort=profit_desc&page=3",
+    "/matrix?start=2020-01-01&end=2020-12-31",
+    "/history",
+    "/history?page=50",
+    "/history?q=押し目買い",
+    "/form",
+    "/api/v1/chains",
+    "/api/v1/positions",
+    "/api/v1/analytics",
+)
+
+
+def bench_routes(sizes=DEFAULT_SIZES, seed=DEFAULT_SEED, paths=ROUTES):
+    """
+    各ルートの1ページ表示にかかる時間。結果キャッシュ・カードHTMLのキャッシュは毎回空にして計算込みで測る。
+    """
+    print("ルート")
+    client = cocotoshi.app.test_client()
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            db_path = os.path.join(tmp, f"ledger_{n}.db")
+            make_ledger_db(db_path, n, seed)
+            with sqlite3.connect(db_path) as conn:
+                positions = conn.execute("SELECT COUNT(*) FROM positions").fetchone()[0]
+            print(f"  {n:,} 件（{positions:,} チェーン）")
+            with use_database(db_path):
+                for path in paths:
+                    def uncached_get():
+                        cocotoshi.result_cache.clear()
+                        cocotoshi.fragment_cache.clear()
+                        response = client.get(path)
+                        assert response.status_code == 200, (path, response.status_code)
+
+                    elapsed = record(f"route {path}", n, timeit(uncached_get, repeat=5))
+                    print(f"    {path:<34} {elapsed * 1000:9.1f} ms")
+
+
+def bench_compression(seed=DEFAULT_SEED, n=10_000, paths=("/history", "/matrix", "/summary", "/api/v1/chains")):
+    """
+    ブラウザに送るバイト数：静的ファイル（元・.gz・.br）と、ページの HTML / JSON（圧縮なし・gzip）。
+    ページは結果キャッシュが効いた状態で、圧縮にかかる時間も見る。
+    """
+    print("圧縮（静的ファイル・ページ）")
+    cocotoshi.asset_manifest.update(cocotoshi.load_asset_manifest(rebuild=True))
+    total = {"raw": 0, "gz": 0, "br": 0}
+    for name, hashed in sorted(cocotoshi.asset_manifest.items()):
+        path = os.path.join(cocotoshi.ASSET_DIR, hashed)
+        total["raw"] += os.path.getsize(path)
+        for suffix in ("gz", "br"):
+            variant = path + "." + suffix
+            total[suffix] += os.path.getsize(variant) if os.path.exists(variant) else os.path.getsize(path)
+    print(f"  静的ファイル {len(cocotoshi.asset_manifest)} 個: {total['raw'] / 1024:7.1f} KB → "
+          f"gzip {total['gz'] / 1024:6.1f} KB  "
+          + (f"brotli {total['br'] / 1024:6.1f} KB" if cocotoshi.brotli else "（Brotli 未インストール）"))
+
+    client = cocotoshi.app.test_client()
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, f"compression_{n}.db")
+        make_ledger_db(db_path, n, seed)
+        with use_database(db_path):
+            for path in paths:
+                plain = client.get(path)
+                gzip_headers = {"Accept-Encoding": "gzip"}
+                compressed = client.get(path, headers=gzip_headers)
+                elapsed_plain = timeit(lambda: client.get(path), repeat=5)
+                elapsed_gzip = record(f"compressed {path}", n, timeit(lambda: client.get(path, headers=gzip_headers), repeat=5))
+                print(f"  {path:<16} {len(plain.data) / 1024:7.1f} KB → {len(compressed.data) / 1024:6.1f} KB  "
+                      f"{elapsed_plain * 1000:6.2f} ms → {elapsed_gzip * 1000:6.2f} ms")
+
+
+def bench_history_render(sizes=DEFAULT_SIZES, seed=DEFAULT_SEED, pages=(1, 2, 3)):
+    """
+    /history の表示時間を、カードHTMLのキャッシュが
+      cold: 空（全チェーンを描画）
+      warm: 全部ある（カードは組み立てるだけ）
+      edit: 各ページのチェーン1つのメモを書き換えた直後（そのチェーンだけ描画）
+    の3通りで測る。結果キャッシュは毎回空にするので、SQL とツリーの組み立ては毎回行う。
+    """
+    print("/history 描画（カードHTMLのキャッシュ）")
+    client = cocotoshi.app.test_client()
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            db_path = os.path.join(tmp, f"history_{n}.db")
+            make_ledger_db(db_path, n, seed)
+            with use_database(db_path):
+                paths = [f"/history?page={page}" for page in pages]
+
+                def get_pages():
+                    for path in paths:
+                        cocotoshi.result_cache.clear()
+                        assert client.get(path).status_code == 200
+
+                def cold():
+                    cocotoshi.fragment_cache.clear()
+                    get_pages()
+
+                edits = iter(range(10 ** 9))
+
+                def edit():
+                    # 各ページ先頭のチェーンの親カードのメモだけ変える
+                    with cocotoshi.get_db() as conn:
+                        for page in pages:
+                            parent_id = conn.execute(
+                                "SELECT id FROM trades WHERE parent_id IS NULL ORDER BY date DESC, id DESC LIMIT 1 OFFSET ?",
+                                ((page - 1) * cocotoshi.HISTORY_PER_PAGE,)
+                            ).fetchone()[0]
+                            conn.execute("UPDATE trades SET memo = ? WHERE id = ?", (f"編集 {next(edits)}", parent_id))
+                    get_pages()
+
+                results = {}
+                before = cocotoshi.fragment_cache.stats()
+                for name, func in (("cold", cold), ("warm", get_pages), ("edit", edit)):
+                    get_pages()
+                    results[name] = record(f"history render {name}", n, timeit(func, repeat=5) / len(paths))
+                after = cocotoshi.fragment_cache.stats()
+                print(f"  {n:>7,} 件: cold {results['cold'] * 1000:6.2f} ms  warm {results['warm'] * 1000:6.2f} ms  "
+                      f"1チェーン編集後 {results['edit'] * 1000:6.2f} ms  （1ページあたり、"
+                      f"ヒット {after['hits'] - before['hits']:,} / 描画 {after['misses'] - before['misses']:,}）")
+
+
+def bench_search(seed=DEFAULT_SEED, n=100_000, queries=("押し目買い", "ロスカット", "1301", "トヨタ", "存在しない語")):
+    """
+    /history?q= の検索1回あたりの時間。従来の code LIKE 全件走査、
+    メモ・銘柄名・コードを LIKE で探す場合、FTS5（trigram）の3通りを比べる。
+    """
+    print(f"/history 検索（{n:,} 件）")
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "search.db")
+        make_ledger_db(db_path, n, seed)
+        with use_database(db_path):
+            c = cocotoshi.get_db().cursor()
+
+            def legacy(q):
+                # 変更前の検索（親カードの code LIKE のみ）
+                c.execute("SELECT COUNT(*) FROM trades WHERE parent_id IS NULL AND code LIKE ?", (f"%{q}%",))
+                c.fetchone()
+                c.execute("""
+                    SELECT * FROM trades WHERE parent_id IS NULL AND code LIKE ?
+                    ORDER BY date ASC, id ASC LIMIT 10
+                """, (f"%{q}%",))
+                c.fetchall()
+
+            def like(q):
+                # 同じ範囲（メモ・銘柄名・コード）を LIKE で探す
+                cocotoshi.FTS_MIN_QUERY_LENGTH, saved = 10 ** 9, cocotoshi.FTS_MIN_QUERY_LENGTH
+                try:
+                    cocotoshi.search_history_page(c, q)
+                finally:
+                    cocotoshi.FTS_MIN_QUERY_LENGTH = saved
+
+            def fts(q):
+                cocotoshi.search_history_page(c, q)
+
+            for q in queries:
+                results = [timeit(func, q, repeat=5) for func in (legacy, like, fts)]
+                for label, elapsed in zip(("code LIKE", "LIKE", "FTS5"), results):
+                    record(f"search {label}", q, elapsed)
+                hits = cocotoshi.search_history_page(c, q, per_page=10 ** 9)[0]
+                print(f"  {q!r:>16}: code LIKE {results[0] * 1000:7.1f} ms  LIKE {results[1] * 1000:7.1f} ms"
+                      f"  FTS5 {results[2] * 1000:7.1f} ms  ({len(hits):,} チェーン)")
+
+
+def bench_import(sizes=DEFAULT_SIZES, seed=DEFAULT_SEED):
+    """
+    import_trades で空の台帳にCSVを取り込む時間（振り分け・書き込み・positions 更新まで）。
+    """
+    print("import_trades（CSV行数）")
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            text = make_broker_csv(n, seed)
+            db_path = os.path.join(tmp, f"import_{n}.db")
+            with use_database(db_path):
+                cocotoshi.init_db()
+                t0 = time.perf_counter()
+                stats = cocotoshi.import_trades(io.StringIO(text))
+                elapsed = record("import_trades", n, time.perf_counter() - t0)
+            print(f"  {n:>7,} 行: {elapsed * 1000:9.1f} ms  ({n / elapsed:,.0f} 行/秒, エラー {stats['error_count']})")
+
+
+def bench_valuation(sizes=DEFAULT_SIZES, seed=DEFAULT_SEED):
+    """
+    株価CSV（台帳の全銘柄×250日）の取り込みと、建玉が残っている全チェーンの時価評価（value_positions）。
+    """
+    print("時価評価（prices）")
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            db_path = os.path.join(tmp, f"valuation_{n}.db")
+            make_ledger_db(db_path, n, seed)
+            with use_database(db_path):
+                c = cocotoshi.get_db().cursor()
+                codes = [row[0] for row in c.execute("SELECT DISTINCT code FROM trades WHERE code IS NOT NULL")]
+                text = make_price_csv(codes, seed=seed)
+                t0 = time.perf_counter()
+                stats = cocotoshi.import_prices(io.StringIO(text))
+                loaded = record("import_prices", n, time.perf_counter() - t0)
+                elapsed = record("value_positions", n, timeit(cocotoshi.value_positions, c))
+                valued = len(cocotoshi.value_positions(c)["positions"])
+            print(f"  {n:>7,} 件: 株価 {stats['loaded']:,} 行の取り込み {loaded * 1000:7.1f} ms  "
+                  f"時価評価 {valued:,} チェーン {elapsed * 1000:6.1f} ms")
+
+
+def bench_jobs(sizes=DEFAULT_SIZES, seed=DEFAULT_SEED):
+    """
+    全件の再計算を、リクエストの中で待つ時間（ジョブを積んで 202 が返るまで）と、ワーカーでの実行時間。
+    """
+    print("バックグラウンドジョブ（全件の再計算）")
+    client = cocotoshi.app.test_client()
+    with tempfile.TemporaryDirectory() as tmp:
+        original = cocotoshi.JOBS_DB
+        cocotoshi.JOBS_DB = os.path.join(tmp, "jobs.db")
+        try:
+            for n in sizes:
+                db_path = os.path.join(tmp, f"jobs_{n}.db")
+                make_ledger_db(db_path, n, seed)
+                with use_database(db_path):
+                    def enqueue():
+                        # 2回目以降は待機中の同じジョブにまとまるので、ワーカーが動かすのは1件だけ
+                        response = client.post("/api/v1/jobs", json={"kind": "recompute"})
+                        assert response.status_code == 202
+                        return response
+
+                    queued = record("jobs enqueue", n, timeit(enqueue))
+                    t0 = time.perf_counter()
+                    done = cocotoshi.run_worker(once=True)
+                    worker = record("jobs recompute", n, (time.perf_counter() - t0) / done)
+                print(f"  {n:>7,} 件: 積む {queued * 1000:6.2f} ms  ワーカーでの再計算 {worker * 1000:8.1f} ms/件")
+        finally:
+            cocotoshi.JOBS_DB = original
+
+
+def bench_export(sizes=DEFAULT_SIZES, seed=DEFAULT_SEED, paths=("/export/trades.csv", "/export/chains.json")):
+    """
+    エクスポートを最後まで読み切る時間と、その間のPythonのメモリ最大値（台帳が大きくても一定のはず）。
+    """
+    print("エクスポート（ストリーミング）")
+    client = cocotoshi.app.test_client()
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            db_path = os.path.join(tmp, f"export_{n}.db")
+            make_ledger_db(db_path, n, seed)
+            with use_database(db_path):
+                for path in paths:
+                    def read_all():
+                        response = client.get(path)
+                        size = sum(len(chunk) for chunk in response.response)
+                        response.close()
+                        return size
+
+                    elapsed = record(f"export {path}", n, timeit(read_all, repeat=1))
+                    # tracemalloc は遅くなるので時間とは別に測る
+                    tracemalloc.start()
+                    size = read_all()
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                    print(f"  {n:>7,} 件 {path}: {elapsed * 1000:8.1f} ms  {size / 1024:,.0f} KB  最大 {peak / 1024:,.0f} KB")
+
+
+# ===============================
+# 負荷試験（複数プロセス）
+# ===============================
+def _load_worker(mode, db_path, role, seconds, parent_ids):
+    """
+    1プロセス分の負荷。reader は /history を、writer は子カードの追加を繰り返す。
+    戻り値: (成功件数, エラー件数)
+    """
+    cocotoshi.DATABASE = db_path
+    if mode == "legacy":
+        # 変更前と同じく、毎回新しい接続を開く
+        cocotoshi.get_db = lambda: sqlite3.connect(cocotoshi.DATABASE)
+    client = cocotoshi.app.test_client()
+    rnd = random.Random(os.getpid())
+    ok = errors = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        try:
+            if role == "reader":
+                response = client.get("/history?page=%d" % rnd.randint(1, 20))
+            else:
+                response = client.post("/form", data={
+                    "parent_id": rnd.choice(parent_ids),
+                    "type": "buy",
+                    "stock": "負荷試験",
+                    "code": "1301",
+                    "price": "1000",
+                    "quantity": "100",
+                    "date": "2025-12-31",
+                    "feeling": "2",
+                    "purpose": "0",
+                    "memo": "",
+                })
+            if response.status_code < 500:
+                ok += 1
+            else:
+                errors += 1
+        except sqlite3.OperationalError:
+            errors += 1
+    return ok, errors
+
+
+def bench_concurrency(seed=DEFAULT_SEED, n=10_000, readers=4, writers=2, seconds=5):
+    print(f"負荷試験（読み{readers}・書き{writers}プロセス、{seconds}秒）")
+    ctx = multiprocessing.get_context("fork")
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ("legacy", "pooled"):
+            db_path = os.path.join(tmp, f"load_{mode}.db")
+            make_ledger_db(db_path, n, seed)
+            with sqlite3.connect(db_path) as conn:
+                if mode == "legacy":
+                    conn.execute("PRAGMA journal_mode = DELETE")
+                parent_ids = [row[0] for row in conn.execute("SELECT parent_id FROM positions LIMIT 100")]
+            roles = ["reader"] * readers + ["writer"] * writers
+            with ctx.Pool(len(roles)) as pool:
+                results = pool.starmap(
+                    _load_worker,
+                    [(mode, db_path, role, seconds, parent_ids) for role in roles]
+                )
+            reads = sum(r[0] for r, role in zip(results, roles) if role == "reader")
+            writes = sum(r[0] for r, role in zip(results, roles) if role == "writer")
+            errors = sum(r[1] for r in results)
+            # 他の項目と同じく「小さいほど良い」にそろえて、1リクエストあたりの秒で記録する
+            record(f"concurrency {mode} read", n, seconds / reads if reads else float("inf"))
+            record(f"concurrency {mode} write", n, seconds / writes if writes else float("inf"))
+            print(f"  {mode:>6}: 読み {reads / seconds:7.1f} req/s  書き {writes / seconds:7.1f} req/s  エラー {errors}")
+
+
+def _shard_writer(db_path, seconds, parent_ids):
+    """
+    1ユーザー分の書き込み負荷（子カードの追加を繰り返す）。戻り値: (成功件数, エラー件数)
+    """
+    cocotoshi.DATABASE = db_path
+    client = cocotoshi.app.test_client()
+    rnd = random.Random(os.getpid())
+    ok = errors = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        try:
+            response = client.post("/form", data={
+                "parent_id": rnd.choice(parent_ids), "type": "buy", "stock": "負荷試験", "code": "1301",
+                "price": "1000", "quantity": "100", "date": "2025-12-31", "feeling": "2", "purpose": "0", "memo": "",
+            })
+            if response.status_code < 500:
+                ok += 1
+            else:
+                errors += 1
+        except sqlite3.OperationalError:
+            errors += 1
+    return ok, errors
+
+
+def bench_shards(seed=DEFAULT_SEED, n=10_000, users=(1, 2, 4), seconds=5):
+    """
+    同時に書き込むユーザー数を増やしたときの書き込み件数。
+    全員で1つのDBを使う場合と、ユーザーごとのシャード（別ファイル）に書く場合を比べる。
+    シャードではファイルロックを取り合わないので、CPUが足りていればユーザー数に比例して伸びる。
+    """
+    print(f"シャード（同時に書き込むユーザー数ごと、{seconds}秒、CPU {os.cpu_count()}）")
+    ctx = multiprocessing.get_context("fork")
+    with tempfile.TemporaryDirectory() as tmp:
+        template = os.path.join(tmp, "template.db")
+        make_ledger_db(template, n, seed)
+        with sqlite3.connect(template) as conn:
+            parent_ids = [row[0] for row in conn.execute("SELECT parent_id FROM positions LIMIT 100")]
+        for count in users:
+            for mode in ("shared", "sharded"):
+                paths = []
+                for i in range(count if mode == "sharded" else 1):
+                    path = os.path.join(tmp, f"{mode}_{count}_{i}.db")
+                    with sqlite3.connect(template) as source, sqlite3.connect(path) as target:
+                        source.backup(target)
+                    paths.append(path)
+                with ctx.Pool(count) as pool:
+                    results = pool.starmap(
+                        _shard_writer, [(paths[i % len(paths)], seconds, parent_ids) for i in range(count)]
+                    )
+                writes = sum(r[0] for r in results)
+                errors = sum(r[1] for r in results)
+                record(f"shards {mode} {count} users write", n, seconds / writes if writes else float("inf"))
+                print(f"  {count} ユーザー {mode:>7}: 書き {writes / seconds:7.1f} req/s  エラー {errors}")
+
+
+# ===============================
+# 負荷試験（実際の gunicorn に多数の同時接続）
+# ===============================
+SERVER_MODES = {
+    # 変更前の Procfile（既定の sync ワーカー1つ）
+    "sync": [],
+    # gunicorn.conf.py（gthread ワーカー＋スレッドプール）
+    "gthread": ["-c", os.path.join(os.path.dirname(os.path.abspath(__file__)), "gunicorn.conf.py")],
+}
+SERVER_PATHS = ("/matrix", "/summary", "/history", "/history?page=20", "/api/v1/analytics", "/api/v1/chains")
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class _HttpClient:
+    """
+    1ユーザー分の HTTP/1.1 クライアント。ブラウザと同じく keep-alive で接続を使い回し、
+    サーバーが閉じたら（sync ワーカーは毎回閉じる）次のリクエストで張り直す。
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.reader = self.writer = None
+
+    async def get(self, path):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection("127.0.0.1", self.port)
+        try:
+            self.writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+            await self.writer.drain()
+            head = await self.reader.readuntil(b"\r\n\r\n")
+            headers = {}
+            for line in head.decode("latin-1").split("\r\n")[1:]:
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            await self.reader.readexactly(int(headers.get("content-length", 0)))
+        except (OSError, asyncio.IncompleteReadError):
+            self.close()
+            raise ConnectionError(path)
+        if headers.get("connection", "").lower() == "close":
+            self.close()
+        return int(head[9:12])
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+async def _run_users(port, users, seconds, db_path, write_interval):
+    """
+    users 人が SERVER_PATHS をランダムに開き続ける。write_interval 秒ごとに台帳バージョンを上げて
+    誰かが保存した状態（キャッシュ無効化）を再現する。戻り値: (レイテンシのリスト, エラー件数)
+    """
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + seconds
+
+    async def user(i):
+        nonlocal errors
+        rnd = random.Random(i)
+        client = _HttpClient(port)
+        while time.perf_counter() < deadline:
+            t0 = time.perf_counter()
+            try:
+                status = await client.get(rnd.choice(SERVER_PATHS))
+            except OSError:
+                status = None
+            if status == 200:
+                latencies.append(time.perf_counter() - t0)
+            else:
+                errors += 1
+        client.close()
+
+    async def writer():
+        with sqlite3.connect(db_path, timeout=30) as conn:
+            while time.perf_counter() < deadline:
+                await asyncio.sleep(write_interval)
+                conn.execute("UPDATE ledger_version SET version = version + 1 WHERE id = 1")
+                conn.commit()
+
+    await asyncio.gather(writer(), *(user(i) for i in range(users)))
+    return latencies, errors
+
+
+def _wait_for_server(port, timeout=30):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("gunicorn が起動しませんでした")
+
+
+def bench_server(seed=DEFAULT_SEED, n=10_000, users=200, seconds=20, write_interval=1.0):
+    """
+    gunicorn を sync（従来）と gthread（gunicorn.conf.py）で起動し、users 人の同時アクセスで
+    1秒あたりの処理数と p50 / p99 レイテンシを比べる。
+    """
+    print(f"サーバー負荷試験（{users} 同時ユーザー、{seconds}秒、{n:,} 件）")
+    root = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmp:
+        # cocotoshi.db・code2company.csv はカレントディレクトリから読むので、作業用ディレクトリで起動する
+        db_path = os.path.join(tmp, "cocotoshi.db")
+        make_ledger_db(db_path, n, seed)
+        csv_path = os.path.join(root, cocotoshi.CODE2COMPANY_CSV)
+        if os.path.exists(csv_path):
+            os.symlink(csv_path, os.path.join(tmp, cocotoshi.CODE2COMPANY_CSV))
+
+        for mode, options in SERVER_MODES.items():
+            port = _free_port()
+            server = subprocess.Popen(
+                [sys.executable, "-m", "gunicorn", *options, "--bind", f"127.0.0.1:{port}",
+                 "--chdir", tmp, "--pythonpath", root, "--log-level", "warning", "cocotoshi:app"],
+                cwd=tmp,
+            )
+            try:
+                _wait_for_server(port)
+                asyncio.run(_run_users(port, 10, 2, db_path, write_interval))  # 暖気
+                latencies, errors = asyncio.run(_run_users(port, users, seconds, db_path, write_interval))
+            finally:
+                server.terminate()
+                server.wait()
+            latencies.sort()
+            p50 = latencies[len(latencies) // 2] if latencies else float("inf")
+            p99 = latencies[int(len(latencies) * 0.99)] if latencies else float("inf")
+            record(f"server {mode} request", n, seconds / len(latencies) if latencies else float("inf"))
+            record(f"server {mode} p99", n, p99)
+            print(f"  {mode:>7}: {len(latencies) / seconds:7.1f} req/s  p50 {p50 * 1000:7.1f} ms  "
+                  f"p99 {p99 * 1000:7.1f} ms  エラー {errors}")
+
+
+# 件数（--sizes）を受け取るもの
+SIZED_BENCHMARKS = {
+    "tree": bench_build_trade_tree,
+    "tree_memory": bench_tree_memory,
+    "matrix": bench_matrix,
+    "equity_curve": bench_equity_curve,
+    "routes": bench_routes,
+    "history_render": bench_history_render,
+    "import": bench_import,
+    "valuation": bench_valuation,
+    "jobs": bench_jobs,
+    "export": bench_export,
+}
+# 決まった入力で測るもの
+FIXED_BENCHMARKS = {
+    "company_search": bench_company_search,
+    "startup": bench_startup,
+    "search": bench_search,
+    "compression": bench_compression,
+    "concurrency": bench_concurrency,
+    "shards": bench_shards,
+    "server": bench_server,
+}
+# 既定では流さない（時間がかかる）もの
+SLOW_BENCHMARKS = {"concurrency", "shards", "server"}
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(baseline, current, threshold):
+    """
+    前回のJSONと比べて、threshold 倍より遅くなった項目を返す。
+    """
+    print(f"前回（{baseline.get('commit')}）との比較")
+    regressions = []
+    for name, by_size in sorted(current.items()):
+        for n, seconds in by_size.items():
+            before = baseline.get("results", {}).get(name, {}).get(n)
+            if not before:
+                continue
+            ratio = seconds / before
+            mark = "  ← 遅くなった" if ratio > threshold else ""
+            print(f"  {name} [{n}]: {before * 1000:9.2f} → {seconds * 1000:9.2f} ms  ×{ratio:.2f}{mark}")
+            if ratio > threshold:
+                regressions.append((name, n, ratio))
+    return regressions
+
+
+def main(argv=None):
+    benchmarks = list(SIZED_BENCHMARKS) + list(FIXED_BENCHMARKS)
+    parser = argparse.ArgumentParser(description="ココトシのベンチマーク")
+    parser.add_argument("--sizes", default=",".join(str(n) for n in DEFAULT_SIZES),
+                        help="台帳の件数（カンマ区切り）")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    parser.add_argument("--only", help="流すベンチマーク（カンマ区切り）: " + ",".join(benchmarks))
+    parser.add_argument("--json", help="結果を保存するJSONファイル")
+    parser.add_argument("--compare", help="比べる前回のJSONファイル")
+    parser.add_argument("--threshold", type=float, default=1.2, help="この倍率より遅くなったら終了コード1")
+    args = parser.parse_args(argv)
+
+    sizes = tuple(int(n) for n in args.sizes.split(","))
+    names = args.only.split(",") if args.only else [name for name in benchmarks if name not in SLOW_BENCHMARKS]
+    unknown = [name for name in names if name not in benchmarks]
+    if unknown:
+        parser.error("不明なベンチマーク: " + ", ".join(unknown))
+
+    for name in names:
+        if name in SIZED_BENCHMARKS:
+            SIZED_BENCHMARKS[name](sizes=sizes, seed=args.seed)
+        else:
+            FIXED_BENCHMARKS[name](seed=args.seed)
+
+    report = {
+        "commit": git_commit(),
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "numpy": np.__version__,
+        "sizes": list(sizes),
+        "seed": args.seed,
+        "results": RESULTS,
+    }
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"{args.json} に保存しました")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if compare_results(baseline, RESULTS, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
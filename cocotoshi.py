@@ -1,14 +1,47 @@
-from flask import Flask, render_template, request, redirect, url_for,jsonify,flash
+from flask import Flask, render_template, request, redirect, url_for,jsonify,flash,Response
+from flask import g, session, has_app_context, has_request_context, before_render_template, template_rendered
+from flask import send_file
+from werkzeug.security import check_password_hash, generate_password_hash, safe_join
+from markupsafe import Markup, escape
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timedelta
 import csv
+import gzip
+import hashlib
+import io
+import mimetypes
+import json
+import os
+import re
+import unicodedata
+import mmap
+import struct
+import tempfile
+import time
+from bisect import bisect_left
+from math import ceil
+import atexit
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from time import perf_counter
+import click
+import numpy as np
+try:
+    import brotli  # 任意（pip install Brotli）。無ければ gzip だけで配る
+except ImportError:
+    brotli = None
 from flask import request
 
 
 
 app = Flask(__name__)
-app.secret_key = 'cocotoshi-super-secret-key'  # ← ここを必ず追加！
+DEFAULT_SECRET_KEY = 'cocotoshi-super-secret-key'
+app.secret_key = os.environ.get("COCOTOSHI_SECRET_KEY") or DEFAULT_SECRET_KEY  # ← ここを必ず追加！
 DATABASE = 'cocotoshi.db'
+# ユーザーごとのDB（シャード）を置くディレクトリ。未設定なら従来どおり DATABASE 1つを全員で使う
+SHARD_DIR = os.environ.get("COCOTOSHI_SHARD_DIR") or None
 
 entry_feelings = ["恐怖", "不安", "普通", "強気", "焦り"]
 exit_feelings = ["焦り", "不安", "普通", "安堵", "興奮"]
@@ -47,7 +80,9 @@ def load_code2company(csv_path):
     return code2company
 
 # プロジェクト直下などに保存したCSVファイル名に合わせてパスを設定
-code2company = load_code2company('code2company.csv')
+CODE2COMPANY_CSV = 'code2company.csv'
+# CSVをコンパイルしたバイナリ（CSVが変わったら自動で作り直す）
+CODE2COMPANY_BIN = 'code2company.bin'
 # ---ここまで---
 
 
@@ -62,473 +97,1983 @@ def inject_feelings():
 
 
 
+# ---ここから銘柄の前方一致検索（オートコンプリート用）---
+COMPANY_CACHE_SECONDS = 24 * 60 * 60  # CSVはデプロイ時にしか変わらない
+
+
+def normalize_company_key(text):
+    """
+    全角・半角、大文字・小文字、空白の違いを吸収した検索キー（ｉＦｒｅｅＥＴＦ → ifreeetf）
+    """
+    return "".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+
+# バイナリ形式（リトルエンディアン）
+#   ヘッダ: magic, CSVのmtime_ns, CSVのサイズ, 件数
+#   コード表: コード順に (コードoffset, コード長, 銘柄名offset, 銘柄名長)
+#   銘柄名表: 正規化した銘柄名順に (キーoffset, キー長, コード表の番号)
+#   文字列領域: UTF-8
+COMPANY_BIN_MAGIC = b"C2C1"
+COMPANY_BIN_HEADER = struct.Struct("<4sqqI")
+COMPANY_CODE_RECORD = struct.Struct("<IIII")
+COMPANY_NAME_RECORD = struct.Struct("<III")
+
+
+def compile_code2company(csv_path=CODE2COMPANY_CSV, bin_path=CODE2COMPANY_BIN):
+    """
+    CSVを読んで、コード順・銘柄名順の索引つきバイナリに書き出す。
+    一時ファイルに書いてから置き換えるので、ワーカーが同時に作っても壊れない。
+    """
+    stat = os.stat(csv_path)
+    table = load_code2company(csv_path)
+    codes = sorted(table)
+    blob = bytearray()
+
+    def put(text):
+        data = text.encode("utf-8")
+        offset = len(blob)
+        blob.extend(data)
+        return offset, len(data)
+
+    code_records = []
+    for code in codes:
+        code_records.append(put(code) + put(table[code]))
+    name_keys = sorted((normalize_company_key(table[code]), code, i) for i, code in enumerate(codes))
+    name_records = [put(key) + (i,) for key, _, i in name_keys]
+
+    base = (COMPANY_BIN_HEADER.size + COMPANY_CODE_RECORD.size * len(codes)
+            + COMPANY_NAME_RECORD.size * len(codes))
+    out = bytearray(COMPANY_BIN_HEADER.pack(COMPANY_BIN_MAGIC, stat.st_mtime_ns, stat.st_size, len(codes)))
+    for code_off, code_len, name_off, name_len in code_records:
+        out += COMPANY_CODE_RECORD.pack(base + code_off, code_len, base + name_off, name_len)
+    for key_off, key_len, i in name_records:
+        out += COMPANY_NAME_RECORD.pack(base + key_off, key_len, i)
+    out += blob
+
+    tmp_path = f"{bin_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(out)
+    os.replace(tmp_path, bin_path)
+
+
+class _CodeView:
+    # bisect 用：i番目のコード
+    def __init__(self, table):
+        self.table = table
+
+    def __len__(self):
+        return self.table.count
+
+    def __getitem__(self, i):
+        return self.table.code_at(i)
+
+
+class _NameKeyView:
+    # bisect 用：i番目の正規化した銘柄名
+    def __init__(self, table):
+        self.table = table
+
+    def __len__(self):
+        return self.table.count
+
+    def __getitem__(self, i):
+        key_off, key_len, _ = self.table.name_record(i)
+        return self.table.text(key_off, key_len)
+
+
+class CompanyTable:
+    """
+    コンパイル済みバイナリを mmap した code2company。
+    ページはOSのページキャッシュを全ワーカーで共有し、Pythonのdictは作らない。
+    dict と同じように get / [] / in / len / items が使える。
+    """
+
+    def __init__(self, bin_path):
+        with open(bin_path, "rb") as f:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.src_mtime_ns, self.src_size, self.count = COMPANY_BIN_HEADER.unpack_from(self.buf, 0)
+        if magic != COMPANY_BIN_MAGIC:
+            raise ValueError(f"{bin_path} は code2company のバイナリではありません")
+        self.codes_start = COMPANY_BIN_HEADER.size
+        self.names_start = self.codes_start + COMPANY_CODE_RECORD.size * self.count
+        self.codes = _CodeView(self)
+        self.names = _NameKeyView(self)
+
+    def text(self, offset, length):
+        return self.buf[offset:offset + length].decode("utf-8")
+
+    def record(self, i):
+        return COMPANY_CODE_RECORD.unpack_from(self.buf, self.codes_start + i * COMPANY_CODE_RECORD.size)
+
+    def name_record(self, i):
+        return COMPANY_NAME_RECORD.unpack_from(self.buf, self.names_start + i * COMPANY_NAME_RECORD.size)
+
+    def code_at(self, i):
+        code_off, code_len, _, _ = self.record(i)
+        return self.text(code_off, code_len)
+
+    def name_at(self, i):
+        _, _, name_off, name_len = self.record(i)
+        return self.text(name_off, name_len)
+
+    def find(self, code):
+        i = bisect_left(self.codes, code)
+        if i < self.count and self.codes[i] == code:
+            return i
+        return None
+
+    def get(self, code, default=None):
+        i = self.find(code)
+        return self.name_at(i) if i is not None else default
+
+    def __getitem__(self, code):
+        i = self.find(code)
+        if i is None:
+            raise KeyError(code)
+        return self.name_at(i)
+
+    def __contains__(self, code):
+        return self.find(code) is not None
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return (self.code_at(i) for i in range(self.count))
+
+    def items(self):
+        return ((self.code_at(i), self.name_at(i)) for i in range(self.count))
+
+    def search(self, query, limit=10):
+        """
+        コード → 正規化した銘柄名 の順に前方一致で最大 limit 件。
+        """
+        code_key = unicodedata.normalize("NFKC", query).strip().upper()
+        name_key = normalize_company_key(query)
+        if not name_key:
+            return []
+
+        found = []
+        seen = set()
+
+        def add(i):
+            if i not in seen:
+                seen.add(i)
+                found.append({"code": self.code_at(i), "company": self.name_at(i)})
+
+        # 1. コードの前方一致
+        i = bisect_left(self.codes, code_key)
+        while i < self.count and len(found) < limit and self.codes[i].startswith(code_key):
+            add(i)
+            i += 1
+        # 2. 銘柄名の前方一致
+        j = bisect_left(self.names, name_key)
+        while j < self.count and len(found) < limit and self.names[j].startswith(name_key):
+            add(self.name_record(j)[2])
+            j += 1
+        return found
+
+
+def open_code2company(csv_path=CODE2COMPANY_CSV, bin_path=CODE2COMPANY_BIN):
+    """
+    バイナリを開く。無い・CSVより古い・壊れているときはコンパイルし直す。
+    """
+    stat = os.stat(csv_path)
+    try:
+        table = CompanyTable(bin_path)
+        if (table.src_mtime_ns, table.src_size) == (stat.st_mtime_ns, stat.st_size):
+            return table
+    except (OSError, ValueError, struct.error):
+        pass
+    compile_code2company(csv_path, bin_path)
+    return CompanyTable(bin_path)
+
+
+class LazyCode2Company:
+    """
+    最初に使われたときに open_code2company する（import を軽くするため）。
+    """
+
+    def __init__(self):
+        self._table = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._table is None:
+            with self._lock:
+                if self._table is None:
+                    self._table = open_code2company()
+        return self._table
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+    def __getitem__(self, code):
+        return self.load()[code]
+
+    def __contains__(self, code):
+        return code in self.load()
+
+    def __len__(self):
+        return len(self.load())
+
+    def __iter__(self):
+        return iter(self.load())
+
+
+code2company = LazyCode2Company()
+
+
+def get_company_index():
+    return code2company.load()
+# ---ここまで---
+
+
 # --- 必ず app = Flask() のあとに！ ---
 @app.route('/api/company_name')
 def company_name():
     code = request.args.get('code', '').zfill(4)
     name = code2company.get(code, '')
-    return jsonify({'company': name})
+    response = jsonify({'company': name})
+    response.headers['Cache-Control'] = f'public, max-age={COMPANY_CACHE_SECONDS}'
+    return response
 
 
+@app.route('/api/company_search')
+def company_search():
+    """
+    コードまたは銘柄名の前方一致で上位N件を返す。?q=...&limit=10
+    """
+    q = request.args.get('q', '')
+    try:
+        limit = max(1, min(int(request.args.get('limit', 10)), 50))
+    except ValueError:
+        limit = 10
+    response = jsonify({'results': get_company_index().search(q, limit)})
+    response.headers['Cache-Control'] = f'public, max-age={COMPANY_CACHE_SECONDS}'
+    return response
+
+
+
+
+
+# ===============================
+# 計測（COCOTOSHI_PROFILE=1 で起動したときだけ有効）
+# ===============================
+# リクエストごとに SQL（回数・時間）/ ツリー構築 / 集計 / テンプレート描画の時間を測り、
+# Server-Timing ヘッダで返しつつ、ルート×区分ごとのヒストグラムに貯めて /metrics で出す。
+# PROFILE_PHASES 以外の区分（analytics.page など内訳）も、測ったものはその後ろに並べて出す。
+PROFILE_ENABLED = os.environ.get("COCOTOSHI_PROFILE") == "1"
+PROFILE_PHASES = ("db", "tree", "analytics", "render")
+PROFILE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+PROFILE_WINDOW = 1000  # パーセンタイルは直近この件数のサンプルから出す
+PROFILE_QUANTILES = (0.5, 0.9, 0.99)
+
+
+def profile_add(phase, seconds, count=1):
+    # 計測中のリクエストの中でだけ g.profile[phase] = [回数, 秒] に足し込む
+    if not has_request_context():
+        return
+    profile = g.get("profile")
+    if profile is None:
+        return
+    entry = profile.setdefault(phase, [0, 0.0])
+    entry[0] += count
+    entry[1] += seconds
+
+
+@contextmanager
+def profiled(phase):
+    if not PROFILE_ENABLED:
+        yield
+        return
+    t0 = perf_counter()
+    try:
+        yield
+    finally:
+        profile_add(phase, perf_counter() - t0)
 
 
+class ProfiledCursor(sqlite3.Cursor):
+    """
+    execute と fetch の時間を "db" に足すカーソル。回数は execute 1回につき1。
+    SQLite は fetch のときに実際の検索を進めるので、fetch 側の時間も含める。
+    """
 
-# データベース初期化
-def init_db():
-    with sqlite3.connect(DATABASE) as conn:
-        c = conn.cursor()
-        c.execute('''
-           CREATE TABLE IF NOT EXISTS trades (
-          id INTEGER PRIMARY KEY AUTOINCREMENT,
-           type TEXT,
-           stock TEXT,
-           price REAL,
-           quantity INTEGER,
-            total REAL,
-            date TEXT,
-          feeling INTEGER,
-          memo TEXT,
-           parent_id INTEGER,
-           code TEXT,  -- ← これを追加！
-        remaining_quantity INTEGER
-               )
-        ''')
-        conn.commit()
+    def execute(self, sql, parameters=()):
+        t0 = perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            profile_add("db", perf_counter() - t0)
 
-# データ取得
-def get_trades():
-    with sqlite3.connect(DATABASE) as conn:
-        c = conn.cursor()
-        c.execute("SELECT * FROM trades ORDER BY date DESC")
-        return c.fetchall()
+    def executemany(self, sql, seq_of_parameters):
+        t0 = perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            profile_add("db", perf_counter() - t0)
 
+    def fetchone(self):
+        t0 = perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            profile_add("db", perf_counter() - t0, count=0)
 
-from math import ceil
+    def fetchmany(self, size=None):
+        t0 = perf_counter()
+        try:
+            return super().fetchmany(self.arraysize if size is None else size)
+        finally:
+            profile_add("db", perf_counter() - t0, count=0)
 
-@app.route("/")
-def index():
-    # ✅ URLのどちらかに watch_to_delete が含まれているかチェック！
-    watch_to_delete = request.args.get("watch_to_delete")
-    new_code = request.args.get("new_code")
+    def fetchall(self):
+        t0 = perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            profile_add("db", perf_counter() - t0, count=0)
 
-    with sqlite3.connect(DATABASE) as conn:
-        c = conn.cursor()
+    def __next__(self):
+        t0 = perf_counter()
+        try:
+            return super().__next__()
+        finally:
+            profile_add("db", perf_counter() - t0, count=0)
 
-        # 🧠 URLに ?watch_to_delete が含まれていればそのまま使う（優先）
-        if not watch_to_delete and new_code:
-            c.execute("SELECT id FROM trades WHERE type = 'watch' AND code = ?", (new_code,))
-            row = c.fetchone()
-            if row:
-                watch_to_delete = row[0]
 
-        c.execute("SELECT * FROM trades ORDER BY date DESC, id DESC")
-        trades = c.fetchall()
+class ProfiledConnection(sqlite3.Connection):
+    # conn.execute() は cursor() を経由しないので、こちらも ProfiledCursor に回す
 
-    trade_tree = build_trade_tree(trades)
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
 
-        # --- ページネーション追加ここから ---
-    page = int(request.args.get('page', 1))
-    per_page = 10  # 1ページあたりの表示件数（必要なら調整OK）
-    total = len(trade_tree)
-    total_pages = ceil(total / per_page)
-    start = (page - 1) * per_page
-    end = start + per_page
-    trade_tree_page = trade_tree[start:end]
-    # --- ページネーションここまで ---
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
 
-    return redirect(url_for('form'))
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
 
 
-from math import ceil
+class LatencyHistogram:
+    """
+    Prometheus 形式の累積ヒストグラム（起動からの合計）と、
+    パーセンタイル用の直近 PROFILE_WINDOW 件のサンプル。
+    """
 
-@app.route("/matrix")
-def matrix():
-    from math import ceil
-    from datetime import datetime, date
+    def __init__(self, buckets=PROFILE_BUCKETS, window=PROFILE_WINDOW):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, seconds):
+        index = bisect_left(self.buckets, seconds)
+        if index < len(self.buckets):
+            self.bucket_counts[index] += 1
+        self.count += 1
+        self.sum += seconds
+        self.recent.append(seconds)
+
+    def quantile(self, q):
+        if not self.recent:
+            return 0.0
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class RouteMetrics:
+    """
+    (ルート, 区分) ごとの LatencyHistogram と、ルートごとの SQL 回数。
+    値はワーカープロセスごと（gunicorn では各ワーカーが自分の分だけ返す）。
+    """
 
-    # 1. 日付パラメータ取得（なければ全期間）
-    start = request.args.get('start')
-    end = request.args.get('end')
+    def __init__(self):
+        self.histograms = {}
+        self.queries = {}
+        self.lock = threading.Lock()
+
+    def observe(self, route, phase, seconds):
+        with self.lock:
+            histogram = self.histograms.get((route, phase))
+            if histogram is None:
+                histogram = self.histograms[(route, phase)] = LatencyHistogram()
+            histogram.observe(seconds)
+
+    def add_queries(self, route, count):
+        with self.lock:
+            self.queries[route] = self.queries.get(route, 0) + count
+
+    def clear(self):
+        with self.lock:
+            self.histograms.clear()
+            self.queries.clear()
+
+    def render_prometheus(self):
+        lines = [
+            "# HELP cocotoshi_phase_seconds ルート・区分（db/tree/analytics/render/total）ごとの処理時間",
+            "# TYPE cocotoshi_phase_seconds histogram",
+        ]
+        with self.lock:
+            items = sorted(self.histograms.items())
+            for (route, phase), h in items:
+                labels = f'route="{route}",phase="{phase}"'
+                cumulative = 0
+                for bound, count in zip(h.buckets, h.bucket_counts):
+                    cumulative += count
+                    lines.append(f'cocotoshi_phase_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'cocotoshi_phase_seconds_bucket{{{labels},le="+Inf"}} {h.count}')
+                lines.append(f"cocotoshi_phase_seconds_sum{{{labels}}} {h.sum:.6f}")
+                lines.append(f"cocotoshi_phase_seconds_count{{{labels}}} {h.count}")
+
+            lines.append(f"# HELP cocotoshi_phase_recent_seconds 直近{PROFILE_WINDOW}件のパーセンタイル")
+            lines.append("# TYPE cocotoshi_phase_recent_seconds summary")
+            for (route, phase), h in items:
+                labels = f'route="{route}",phase="{phase}"'
+                for q in PROFILE_QUANTILES:
+                    lines.append(f'cocotoshi_phase_recent_seconds{{{labels},quantile="{q}"}} {h.quantile(q):.6f}')
+                lines.append(f"cocotoshi_phase_recent_seconds_sum{{{labels}}} {sum(h.recent):.6f}")
+                lines.append(f"cocotoshi_phase_recent_seconds_count{{{labels}}} {len(h.recent)}")
+
+            lines.append("# HELP cocotoshi_sql_queries_total ルートごとに発行したSQLの回数")
+            lines.append("# TYPE cocotoshi_sql_queries_total counter")
+            for route, count in sorted(self.queries.items()):
+                lines.append(f'cocotoshi_sql_queries_total{{route="{route}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+
+route_metrics = RouteMetrics()
+
+
+@app.before_request
+def start_profile():
+    if PROFILE_ENABLED:
+        g.profile = {}
+        g.profile_started = perf_counter()
+
+
+@before_render_template.connect_via(app)
+def start_render_timer(sender, template, context, **extra):
+    if g.get("profile") is not None:
+        g.render_started = perf_counter()
+
+
+@template_rendered.connect_via(app)
+def stop_render_timer(sender, template, context, **extra):
+    started = g.get("render_started")
+    if started is not None:
+        profile_add("render", perf_counter() - started)
+        g.render_started = None
+
+
+@app.after_request
+def finish_profile(response):
+    profile = g.get("profile")
+    if profile is None:
+        return response
+    total = perf_counter() - g.profile_started
+    route = request.endpoint or "unknown"
+    timings = []
+    phases = [phase for phase in PROFILE_PHASES if phase in profile]
+    phases += [phase for phase in profile if phase not in PROFILE_PHASES]
+    for phase in phases:
+        count, seconds = profile[phase]
+        route_metrics.observe(route, phase, seconds)
+        desc = f';desc="{count} queries"' if phase == "db" else ""
+        timings.append(f"{phase};dur={seconds * 1000:.2f}{desc}")
+    route_metrics.observe(route, "total", total)
+    route_metrics.add_queries(route, profile.get("db", [0])[0])
+    timings.append(f"total;dur={total * 1000:.2f}")
+    response.headers["Server-Timing"] = ", ".join(timings)
+    return response
+
+
+@app.route("/metrics")
+def metrics():
+    if not PROFILE_ENABLED:
+        return "COCOTOSHI_PROFILE=1 で起動すると有効になります\n", 404, {"Content-Type": "text/plain; charset=utf-8"}
+    return route_metrics.render_prometheus(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+# ===============================
+# 静的ファイル（中身のハッシュ入りのファイル名・事前圧縮）とレスポンスの圧縮
+# ===============================
+# static/ の各ファイルを中身のハッシュ入りの名前（style.3f2a1b9c0d4e.css）で static/dist/ に書き出し、
+# 文字のファイルは .gz（Brotli があれば .br も）を一緒に作っておく。名前が中身で決まるので
+# /assets/ からは1年キャッシュ（immutable）で配り、中身が変われば名前ごと変わる。
+# 書き出すのは flask build-assets か gunicorn の起動時（on_starting）だけで、import しただけでは書かない
+ASSET_DIR = os.path.join(app.static_folder, "dist")
+ASSET_MANIFEST = os.path.join(ASSET_DIR, "manifest.json")
+ASSET_MAX_AGE = 365 * 24 * 60 * 60
+ASSET_COMPRESSIBLE = (".css", ".js", ".svg", ".json", ".txt")
+# サードパーティのファイルは static/vendor/ に置いてリポジトリに入れ、ほかと同じく /assets/ から配る。
+# 取得元（固定したバージョン）は build-assets --fetch-vendor で取り直すときにだけ使う
+VENDOR_ASSETS = {
+    "vendor/chart.umd.js": "https://cdn.jsdelivr.net/npm/chart.js@4.4.0/dist/chart.umd.js",
+}
+COMPRESS_MIMETYPES = {"text/html", "application/json"}
+# TCP の初期ウィンドウ（約14KB）に収まるレスポンスは、圧縮しても往復の回数が変わらないのでそのまま返す
+COMPRESS_MIN_BYTES = 14 * 1024
+# 動的なレスポンスは毎回圧縮するので最速の設定にする（gzip 1 でも HTML は 1/7 ほどになる）
+COMPRESS_LEVEL = 1
+COMPRESS_BROTLI_QUALITY = 1
 
-    # 日付条件ありでクエリ
-    with sqlite3.connect(DATABASE) as conn:
-        c = conn.cursor()
-        if start and end:
-            c.execute("SELECT * FROM trades WHERE date BETWEEN ? AND ? ORDER BY date, id", (start, end))
-        else:
-            c.execute("SELECT * FROM trades ORDER BY date, id")
-        trades = c.fetchall()
-
-    # 2. build_trade_treeで履歴情報構築
-    trade_tree = build_trade_tree(trades)
-    matrix_results = []
-
-    # 3. 各ツリー（親＋子カード）を走査
-    for item in trade_tree:
-        parent = item["parent"]
-        for child in item["children"]:
-            is_opposite_trade = (
-                (parent["type"] == "buy" and child["type"] == "sell") or
-                (parent["type"] == "sell" and child["type"] == "buy")
-            )
-            if is_opposite_trade and "profits" in child and child["profits"]:
-                for profit in child["profits"]:
-                    try:
-                        fmt = "%Y-%m-%d"
-                        entry_date = parent["date"]
-                        exit_date = child["date"]
-                        d0 = datetime.strptime(entry_date, fmt)
-                        d1 = datetime.strptime(exit_date, fmt)
-                        days_held = (d1 - d0).days
-                    except Exception:
-                        days_held = "-"
-                    parent_purpose = parent.get("purpose", 0)
-                    try:
-                        parent_purpose = int(parent_purpose)
-                    except Exception:
-                        parent_purpose = 0
-                    matrix_results.append((
-                        profit,
-                        clamp_feeling(parent["feeling"]),
-                        clamp_feeling(child["feeling"]),
-                        days_held,
-                        parent.get("memo", ""),
-                        child.get("memo", ""),
-                        child.get("id"),
-                        exit_date,
-                        parent.get("stock", ""),
-                        parent_purpose
-                    ))
-
-    # 並び順
-    sort = request.args.get('sort', 'date_desc')
-    if sort == "date_asc":
-        matrix_results.sort(key=lambda x: x[7])
-    elif sort == "profit_desc":
-        matrix_results.sort(key=lambda x: x[0] or 0, reverse=True)
-    elif sort == "profit_asc":
-        matrix_results.sort(key=lambda x: x[0] or 0)
-    else:
-        matrix_results.sort(key=lambda x: x[7], reverse=True)
-
-    # 投資目的ラベル
-    purpose_labels = ["短期", "中期", "長期", "優待", "配当"]
-
-    # ヒートマップ集計
-    heatmap_trades = []
-    for item in trade_tree:
-        parent = item["parent"]
-        for child in item["children"]:
-            is_opposite_trade = (
-                (parent["type"] == "buy" and child["type"] == "sell") or
-                (parent["type"] == "sell" and child["type"] == "buy")
-            )
-            if is_opposite_trade and "profits" in child and child["profits"]:
-                for profit in child["profits"]:
-                    heatmap_trades.append(
-                        (parent["feeling"], child["feeling"], profit)
-                    )
-    heatmap, heatmap_counts = calc_heatmap(heatmap_trades)
-
-    # ====== 追加ここから ======
-    def calc_heatmap_sum(trades):
-        import numpy as np
-        N = 5
-        profit_mat = np.zeros((N, N))
-        count_mat = np.zeros((N, N))
-        for entry, exit_, profit in trades:
-            if entry is not None and exit_ is not None:
-                i = int(entry)
-                j = int(exit_)
-                profit_mat[i][j] += profit
-                count_mat[i][j] += 1
-        return profit_mat.astype(int).tolist(), count_mat.astype(int).tolist()
-
-    heatmap_avg, heatmap_counts = calc_heatmap(heatmap_trades)
-    heatmap_sum, _ = calc_heatmap_sum(heatmap_trades)
-    mode = request.args.get('mode', 'avg')
-
-
-
-    # 集計期間：トレードデータの日付で自動判定
-    dates = [row[6] for row in trades if row[6] and row[6] != "None"]
-    if dates:
-        start_date = min(dates)
-        end_date = max(dates)
-    else:
-        today_str = date.today().strftime('%Y-%m-%d')
-        start_date = start or today_str
-        end_date = end or today_str
-
-    # グラフ用
-    purpose_stats = {label: {"days": [], "win": 0, "total": 0} for label in purpose_labels}
-    for row in matrix_results:
-        profit = row[0]
-        days_held = row[3]
-        purpose_idx = row[9]
-        try:
-            purpose_label = purpose_labels[int(purpose_idx)]
-        except (ValueError, IndexError, TypeError):
+
+def asset_sources(static_dir=None):
+    """
+    static/ の配るファイル（dist/ 自体は除く）の {static からの相対パス: (mtime_ns, size)}。
+    """
+    static_dir = static_dir or app.static_folder
+    dist_dir = os.path.join(static_dir, "dist")
+    sources = {}
+    for root, dirs, files in os.walk(static_dir):
+        if os.path.abspath(root) == os.path.abspath(dist_dir):
+            dirs[:] = []
             continue
-        if isinstance(days_held, int):
-            purpose_stats[purpose_label]["days"].append(days_held)
-        if profit is not None:
-            purpose_stats[purpose_label]["total"] += 1
-            if profit > 0:
-                purpose_stats[purpose_label]["win"] += 1
-    purpose_graph_data = []
-    for label in purpose_labels:
-        stats = purpose_stats[label]
-        avg_days = round(sum(stats["days"]) / len(stats["days"]), 1) if stats["days"] else 0
-        win_rate = round(stats["win"] / stats["total"] * 100, 1) if stats["total"] > 0 else 0
-        purpose_graph_data.append({
-            "purpose": label,
-            "avg_days": avg_days,
-            "win_rate": win_rate
-        })
+        for name in files:
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            sources[os.path.relpath(path, static_dir).replace(os.sep, "/")] = (stat.st_mtime_ns, stat.st_size)
+    return sources
 
-    # ページネーション
-    page = int(request.args.get('page', 1))
-    per_page = 10
-    total = len(matrix_results)
-    total_pages = ceil(total / per_page)
-    start_idx = (page - 1) * per_page
-    end_idx = start_idx + per_page
-    results_page = matrix_results[start_idx:end_idx]
 
-    return render_template(
-        "matrix.html",
-        start_date=start_date,
-        end_date=end_date,
-        results=results_page,
-        page=page,
-        total_pages=total_pages,
-        current="matrix",
-        sort=sort,
-        purposes=purposes,
-        entry_feelings=entry_feelings,
-        exit_feelings=exit_feelings,
-        purpose_graph_data=purpose_graph_data,
-        heatmap_avg=heatmap_avg,
-        heatmap_sum=heatmap_sum,
-        heatmap_counts=heatmap_counts,
-        mode=mode,
-    )
+def build_assets(static_dir=None, dist_dir=None):
+    """
+    static/ を dist/ に書き出して manifest（{元の名前: ハッシュ入りの名前}）を返す。
+    同じ中身のファイルは書き直さない。以前のハッシュ名のファイルは、古いページから参照されうるので消さない。
+    """
+    static_dir = static_dir or app.static_folder
+    dist_dir = dist_dir or ASSET_DIR
+    sources = asset_sources(static_dir)
+    files = {}
+    for name in sorted(sources):
+        with open(os.path.join(static_dir, name), "rb") as f:
+            data = f.read()
+        stem, ext = os.path.splitext(name)
+        hashed = f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+        files[name] = hashed
+        target = os.path.join(dist_dir, hashed)
+        if os.path.exists(target):
+            continue
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        variants = [("", data)]
+        if ext in ASSET_COMPRESSIBLE:
+            # mtime=0 にして、同じ中身からは毎回同じ .gz ができるようにする
+            variants.append((".gz", gzip.compress(data, compresslevel=9, mtime=0)))
+            if brotli is not None:
+                variants.append((".br", brotli.compress(data, quality=11)))
+        # 本体を最後に置く（本体があれば .gz/.br もそろっているものとして扱う）
+        for suffix, body in reversed(variants):
+            write_atomic(target + suffix, body)
+    manifest = {"files": files, "sources": sources}
+    write_atomic(os.path.join(dist_dir, "manifest.json"),
+                 json.dumps(manifest, ensure_ascii=False, indent=1, sort_keys=True).encode("utf-8"))
+    return manifest
+
+
+def write_atomic(path, data):
+    # 一時ファイルに書いてから置き換えるので、ワーカーが同時に作っても壊れない
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def load_asset_manifest(rebuild=False):
+    """
+    manifest を読む。無い・元のファイルと食い違う・壊れているときは、rebuild なら作り直し、
+    そうでなければ {}（ハッシュ名を使わず今までどおり /static/ から配る）を返す。
+    static/ に書けない環境でも {} になる。
+    """
+    try:
+        with open(ASSET_MANIFEST, encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest["sources"] == {name: list(src) for name, src in asset_sources().items()}:
+            return manifest["files"]
+    except (OSError, ValueError, KeyError):
+        pass
+    if not rebuild:
+        return {}
+    try:
+        return build_assets()["files"]
+    except OSError:
+        app.logger.warning("static/dist に書き出せないので、静的ファイルは /static/ から配ります")
+        return {}
 
 
+asset_manifest = {}
 
 
+@app.template_global()
+def asset_url(filename):
+    """
+    テンプレートから静的ファイルを参照するときに使う（url_for('static', ...) の代わり）。
+    ハッシュ入りの名前があれば /assets/、無ければ /static/ を返す。
+    """
+    if app.debug:
+        # 開発中は CSS を書き換えたらすぐ反映されるように、毎回元のファイルと突き合わせる
+        asset_manifest.update(load_asset_manifest(rebuild=True))
+    hashed = asset_manifest.get(filename)
+    if hashed:
+        return url_for("asset", filename=hashed)
+    return url_for("static", filename=filename)
 
 
-@app.route("/summary")
-def summary():
-    from datetime import datetime
+@app.route("/assets/<path:filename>")
+def asset(filename):
+    """
+    ハッシュ入りの静的ファイル。ブラウザが受け取れれば事前に圧縮した .br / .gz をそのまま返す。
+    """
+    path = safe_join(ASSET_DIR, filename)
+    if path is None or not os.path.isfile(path):
+        return "Not Found", 404
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    encoding = None
+    for candidate, suffix in (("br", ".br"), ("gzip", ".gz")):
+        if request.accept_encodings[candidate] and os.path.isfile(path + suffix):
+            path, encoding = path + suffix, candidate
+            break
+    response = send_file(path, mimetype=mimetype, conditional=True, max_age=ASSET_MAX_AGE)
+    response.headers["Cache-Control"] = f"public, max-age={ASSET_MAX_AGE}, immutable"
+    response.vary.add("Accept-Encoding")
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    return response
+
+
+@app.after_request
+def compress_response(response):
+    """
+    大きな HTML / JSON（/history・/matrix・API）を gzip（Brotli があればそちら）で圧縮して返す。
+    ストリーミング（エクスポート）や send_file、304 などはそのまま。
+    """
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or "Content-Encoding" in response.headers or response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+    response.vary.add("Accept-Encoding")
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        encoding = "br"
+    elif accepted["gzip"]:
+        encoding = "gzip"
+    else:
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return response
+    if encoding == "br":
+        response.set_data(brotli.compress(data, quality=COMPRESS_BROTLI_QUALITY))
+    else:
+        response.set_data(gzip.compress(data, compresslevel=COMPRESS_LEVEL))
+    response.headers["Content-Encoding"] = encoding
+    # 圧縮した本文はバイト単位では別物なので、API の ETag は弱い比較用にする（If-None-Match は弱い比較で見ている）
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+@app.cli.command("build-assets")
+@click.option("--fetch-vendor", is_flag=True, help="static/vendor/ に無いサードパーティのファイルを取得元から取ってくる")
+def build_assets_command(fetch_vendor):
+    """静的ファイルをハッシュ入りの名前で static/dist/ に書き出し、.gz/.br を作る"""
+    if fetch_vendor:
+        import urllib.request
+        for name, url in VENDOR_ASSETS.items():
+            path = os.path.join(app.static_folder, name)
+            if os.path.exists(path):
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                with urllib.request.urlopen(url, timeout=30) as remote:
+                    write_atomic(path, remote.read())
+            except OSError as e:
+                raise click.ClickException(f"{url} を取得できませんでした: {e}")
+            click.echo(f"{url} → {path}")
+    manifest = build_assets()
+    asset_manifest.update(manifest["files"])
+    for name, hashed in sorted(manifest["files"].items()):
+        click.echo(f"{name} → {hashed}")
+    missing = [name for name in VENDOR_ASSETS if name not in manifest["files"]]
+    if missing:
+        click.echo(f"static/ に無いファイルがあります: {', '.join(missing)}（--fetch-vendor で取得してコミットしてください）")
+    if brotli is None:
+        click.echo("Brotli が入っていないので .gz だけ作りました（pip install Brotli で .br も作ります）")
+
+
+# ===============================
+# DB接続（ワーカーごとに使い回す）
+# ===============================
+# 接続ごとに設定するPRAGMA（journal_mode=WAL は init_db でDBファイルに設定済み）
+SQLITE_PRAGMAS = (
+    "PRAGMA busy_timeout = 5000",   # 他ワーカーの書き込み中は最大5秒待つ
+    "PRAGMA synchronous = NORMAL",  # WAL ではこれで十分安全
+    "PRAGMA cache_size = -20000",   # ページキャッシュ約20MB
+    "PRAGMA temp_store = MEMORY",
+)
+
+# スレッドごとに開いたままにしておく接続の数（シャードが多いときは古いものから閉じる）
+SHARD_CONNECTIONS = int(os.environ.get("COCOTOSHI_SHARD_CONNECTIONS", 8))
+
+_db_local = threading.local()
+_migrated = set()  # このプロセスでマイグレーション済みのDBファイル
+_migrate_lock = threading.Lock()
+
+
+def current_database():
+    """
+    いまのリクエスト（またはCLIコマンド）が使うDBファイル。
+    ログイン中なら resolve_shard がセッションから決めたユーザーのシャード、それ以外は DATABASE。
+    """
+    if has_app_context():
+        return g.get("database") or DATABASE
+    return DATABASE
 
-    with sqlite3.connect(DATABASE) as conn:
-        c = conn.cursor()
-        # 1. 親カード（parent_idがNULLまたは''）のみ取得
-        c.execute("""
-            SELECT id, code, stock, purpose, quantity, price, date, feeling, memo, type
-            FROM trades
-            WHERE (parent_id IS NULL OR parent_id = '')
-            AND code IS NOT NULL
-        """)
-        parents = c.fetchall()
 
-        summary_data = []
-        today = datetime.today().date()
-        purpose_map = {
-            "0": "短期", "1": "中期", "2": "長期", "3": "優待", "4": "配当",
-            0: "短期", 1: "中期", 2: "長期", 3: "優待", 4: "配当"
-        }
+def connect_db(path):
+    factory = ProfiledConnection if PROFILE_ENABLED else sqlite3.Connection
+    conn = sqlite3.connect(path, timeout=5, factory=factory)
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
+    return conn
 
-        # ここで「最新売買日」を拾うためのリストを準備
-        for parent in parents:
-            parent_id = parent[0]
-            code = parent[1]
-            stock = parent[2]
-            purpose_raw = parent[3]
-            date = parent[6]
-            feeling = parent[7]
-            parent_memo = parent[8]
-            parent_type = parent[9]
-
-            # 子カードのうち、最新（最大日付）のものを取得
-            # ★ここを追加！
-            c.execute("""
-                SELECT type, quantity FROM trades
-                WHERE id=? OR parent_id=?
-            """, (parent_id, parent_id))
-            rows = c.fetchall()
-            quantity = sum(q if t == "buy" else -q for t, q in rows)
-            child_row = c.fetchone()
-
-            # 最新売買日付・メモ
-            if child_row and child_row[0]:
-                latest_date = child_row[0]
-                memo = child_row[1] if child_row[1] not in [None, "", "None"] else parent_memo
-            else:
-                latest_date = date
-                memo = parent_memo
 
-            # 保有日数＝今日－最新売買日
-            hold_days = "-"
-            if latest_date and latest_date != "None":
-                try:
-                    base_date_dt = datetime.strptime(latest_date, "%Y-%m-%d").date()
-                    delta = (today - base_date_dt).days
-                    hold_days = delta if delta >= 0 else 0
-                except Exception:
-                    hold_days = "-"
-
-            # 目的名変換
-            purpose = purpose_map.get(str(purpose_raw), purpose_raw)
-
-            summary_data.append([
-                code,      # 0
-                stock,     # 1
-                purpose,   # 2
-                quantity,  # 3
-                "-",       # 4: avg_price
-                latest_date, # 5
-                feeling,   # 6
-                hold_days, # 7
-                memo,      # 8
-                parent_type, # 9 ← typeを渡す
-            ])
-
-        # 新しい売買日順（最新売買が上にくるよう）に並べる
-        summary_data.sort(key=lambda x: x[5] or "", reverse=True)
-
-    # ページ送り
-    page = int(request.args.get('page', 1))
-    per_page = 12
-    total = len(summary_data)
-    total_pages = (total + per_page - 1) // per_page
-    start = (page - 1) * per_page
-    end = start + per_page
-    summary_data_page = summary_data[start:end]
+def _thread_connections():
+    # fork 後は親プロセスの接続を使わない（閉じもしない）で、空の表から始める
+    if getattr(_db_local, "pid", None) != os.getpid():
+        _db_local.conns = OrderedDict()
+        _db_local.pid = os.getpid()
+    return _db_local.conns
 
-    return render_template(
-        "summary.html",
-        page=page,
-        total_pages=total_pages,
-        current="summary",
-        summary_data=summary_data_page,
-        entry_feelings=entry_feelings,
-    )
 
+def get_db():
+    """
+    このワーカー（スレッド）用の、いまのDB（current_database）への接続を返す。リクエストをまたいで使い回す。
+    接続はDBファイルごとに1本、合わせて SHARD_CONNECTIONS 本まで開いておき、超えたら最後に使ったのが古いものから閉じる。
+    初めて開くDBファイルはその場でマイグレーションする。
+    `with get_db() as conn:` で従来どおりブロック単位にコミット／ロールバックされる。
+    """
+    path = current_database()
+    conns = _thread_connections()
+    conn = conns.get(path)
+    if conn is not None:
+        conns.move_to_end(path)
+        return conn
+    if path not in _migrated:
+        init_db(path)
+    conn = conns[path] = connect_db(path)
+    while len(conns) > SHARD_CONNECTIONS:
+        conns.popitem(last=False)[1].close()
+    return conn
+
+
+def close_db():
+    conns = _thread_connections()
+    while conns:
+        conns.popitem()[1].close()
+
+
+@app.teardown_appcontext
+def release_db(exc):
+    # 接続は閉じずに使い回す。途中で例外になった書き込みだけ取り消しておく
+    for conn in getattr(_db_local, "conns", {}).values():
+        if conn.in_transaction:
+            conn.rollback()
+
+
+atexit.register(close_db)
+
+
+# ===============================
+# ユーザーとシャード（COCOTOSHI_SHARD_DIR を設定したときだけ）
+# ===============================
+# ユーザー一覧は SHARD_DIR/users.db、各ユーザーの台帳は SHARD_DIR/user_<id>.db。
+# ファイルロック・WAL・ページキャッシュがユーザーごとに分かれるので、他人の書き込みを待たない。
+# 結果キャッシュやカードのキャッシュのキーには current_database() が入るので、ユーザー間で混ざらない
+USERS_DB = "users.db"
+SESSION_DAYS = 30
+PUBLIC_ENDPOINTS = {"login", "register", "static", "asset"}
+USERNAME_PATTERN = re.compile(r"^[\w.\-]{1,32}$")
+MIN_PASSWORD_LENGTH = 8
+
+
+def init_users_db():
+    if app.secret_key == DEFAULT_SECRET_KEY:
+        # セッションに user_id を入れるので、鍵が公開されていると他人のシャードを開けてしまう
+        raise RuntimeError("COCOTOSHI_SHARD_DIR を使うときは COCOTOSHI_SECRET_KEY を設定してください")
+    os.makedirs(SHARD_DIR, exist_ok=True)
+    app.permanent_session_lifetime = timedelta(days=SESSION_DAYS)
+    with users_db() as conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL UNIQUE,
+                password_hash TEXT NOT NULL,
+                created_at TEXT NOT NULL
+            )
+        ''')
 
 
+def users_db():
+    # ログイン・登録のときにしか使わないので、その都度開く
+    return sqlite3.connect(os.path.join(SHARD_DIR, USERS_DB), timeout=5)
 
 
+def shard_path(user_id):
+    return os.path.join(SHARD_DIR, f"user_{int(user_id)}.db")
 
 
-@app.route("/settings")
-def settings():
-    return render_template("settings.html",current="settings")
+def create_user(name, password, copy_from=None):
+    """
+    ユーザーを登録して、その人のシャードを作る（マイグレーション済みの空の台帳）。
+    copy_from を渡すと、そのDBファイル（これまでの共用の cocotoshi.db など）を丸ごと複製して台帳にする。
+    戻り値: ユーザーid
+    """
+    name = name.strip()
+    if not USERNAME_PATTERN.match(name):
+        raise ValueError("ユーザー名は32文字以内で入力してください（記号は ._- だけ使えます）")
+    if len(password) < MIN_PASSWORD_LENGTH:
+        raise ValueError(f"パスワードは{MIN_PASSWORD_LENGTH}文字以上にしてください")
+    try:
+        with users_db() as conn:
+            user_id = conn.execute(
+                "INSERT INTO users (name, password_hash, created_at) VALUES (?, ?, ?)",
+                (name, generate_password_hash(password), datetime.now().isoformat(timespec="seconds")),
+            ).lastrowid
+    except sqlite3.IntegrityError:
+        raise ValueError(f"ユーザー名 {name} はすでに使われています")
+
+    path = shard_path(user_id)
+    if copy_from:
+        # 書き込み中でも一貫した状態を写せるよう、ファイルコピーではなく backup API を使う
+        source = sqlite3.connect(copy_from)
+        target = sqlite3.connect(path)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
+    init_db(path)
+    return user_id
 
 
+def authenticate(name, password):
+    with users_db() as conn:
+        row = conn.execute("SELECT id, password_hash FROM users WHERE name = ?", (name.strip(),)).fetchone()
+    if row and check_password_hash(row[1], password):
+        return row[0]
+    return None
 
 
+def safe_next(url):
+    # ログイン後の戻り先は同じサイト内のパスだけ（//example.com などは使わない）
+    if url and url.startswith("/") and not url.startswith("//") and "\\" not in url:
+        return url
+    return url_for("history")
 
-@app.route('/form', methods=['GET', 'POST'])
-def form():
-    edit_id = request.form.get('edit_id') or request.args.get('edit_id')
-    trade = None
-    is_parent_edit = True  # デフォルトは親
 
+@app.before_request
+def resolve_shard():
+    """
+    シャードを使うときは、ログイン中のユーザーの台帳を g.database にする（以降の get_db はそこを開く）。
+    未ログインなら画面はログインへ、API は 401 を返す。
+    """
+    if not SHARD_DIR or request.endpoint in PUBLIC_ENDPOINTS:
+        return None
+    user_id = session.get("user_id")
+    if user_id is None:
+        if request.path.startswith("/api/"):
+            return jsonify({"error": "login required"}), 401
+        return redirect(url_for("login", next=request.full_path))
+    g.database = shard_path(user_id)
+    return None
+
+
+@app.route("/login", methods=["GET", "POST"])
+def login():
+    if not SHARD_DIR:
+        return redirect(url_for("history"))
     if request.method == "POST":
-        # 入力値取得
-        stock = request.form.get("stock")
-        code = request.form.get("code")
-        purpose_raw = request.form.get("purpose")
-        type = request.form.get("type")
-        price_raw = request.form.get("price")
-        quantity_raw = request.form.get("quantity")
-        date = request.form.get("date")
-        feeling_raw = request.form.get("feeling", "")
-        memo = request.form.get("memo")
-        parent_id = request.form.get("parent_id")
-        parent_id = int(parent_id) if parent_id else None
-        confirm = request.form.get("confirm")  # "合算" or "新規" or None
+        user_id = authenticate(request.form.get("name", ""), request.form.get("password", ""))
+        if user_id is None:
+            flash("ユーザー名かパスワードが違います。")
+        else:
+            session.clear()
+            session.permanent = True
+            session["user_id"] = user_id
+            session["user_name"] = request.form["name"].strip()
+            return redirect(safe_next(request.args.get("next")))
+    return render_template("login.html", current="login")
+
+
+@app.route("/register", methods=["POST"])
+def register():
+    if not SHARD_DIR:
+        return redirect(url_for("history"))
+    name = request.form.get("name", "")
+    try:
+        user_id = create_user(name, request.form.get("password", ""))
+    except ValueError as e:
+        flash(str(e))
+        return redirect(url_for("login"))
+    session.clear()
+    session.permanent = True
+    session["user_id"] = user_id
+    session["user_name"] = name.strip()
+    return redirect(url_for("history"))
 
-        # バリデーション：数値項目
-        try:
-            price = int(float(price_raw))
-        except Exception:
-            return render_template('form.html', error_msg="株価が不正です", **locals())
-        try:
-            quantity = int(quantity_raw)
-        except Exception:
-            return render_template('form.html', error_msg="数量が不正です", **locals())
-        if not stock:
-            return render_template('form.html', error_msg="銘柄名が入力されていません", **locals())
-        if not code:
-            return render_template('form.html', error_msg="銘柄コードが入力されていません", **locals())
-        total = price * quantity
 
-        # 感情・目的（デフォルト値）
-        try:
-            feeling = int(feeling_raw)
-        except Exception:
-            feeling = 2  # 普通
+@app.route("/logout", methods=["POST"])
+def logout():
+    session.clear()
+    return redirect(url_for("login") if SHARD_DIR else url_for("history"))
+
+
+def use_user_shard(name):
+    """
+    CLIコマンドの --user：そのユーザーのシャードを、このコマンドの間 current_database() にする。
+    """
+    if not name:
+        return
+    if not SHARD_DIR:
+        raise click.UsageError("--user は COCOTOSHI_SHARD_DIR を設定したときだけ使えます")
+    with users_db() as conn:
+        row = conn.execute("SELECT id FROM users WHERE name = ?", (name,)).fetchone()
+    if row is None:
+        raise click.UsageError(f"ユーザー {name} がいません")
+    g.database = shard_path(row[0])
+
+
+@app.cli.command("create-user")
+@click.argument("name")
+@click.password_option()
+@click.option("--copy-from", type=click.Path(exists=True, dir_okay=False),
+              help="このDBファイル（共用の cocotoshi.db など）を複製してそのユーザーの台帳にする")
+def create_user_command(name, password, copy_from):
+    """ユーザーを登録して、その人のシャードを作る"""
+    if not SHARD_DIR:
+        raise click.UsageError("COCOTOSHI_SHARD_DIR を設定してください")
+    try:
+        user_id = create_user(name, password, copy_from=copy_from)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    click.echo(f"ユーザー {name}（id={user_id}）を作りました: {shard_path(user_id)}")
+
+
+# ===============================
+# データベース初期化（マイグレーション）
+# ===============================
+# PRAGMA user_version に「適用済みの件数」を記録し、未適用のものだけ順に流す。
+# 追加するときは末尾に足すこと（順番を入れ替えたり消したりしない）。
+def migration_base_schema(c):
+    # trades 本体（purpose 列は以前は手作業の ALTER TABLE で追加していた）
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS trades (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            type TEXT,
+            stock TEXT,
+            price REAL,
+            quantity INTEGER,
+            total REAL,
+            date TEXT,
+            feeling INTEGER,
+            memo TEXT,
+            parent_id INTEGER,
+            code TEXT,
+            remaining_quantity INTEGER,
+            purpose TEXT
+        )
+    ''')
+    c.execute("PRAGMA table_info(trades)")
+    columns = [row[1] for row in c.fetchall()]
+    if "purpose" not in columns:
+        c.execute("ALTER TABLE trades ADD COLUMN purpose TEXT")
+
+
+def migration_normalize_parent_id(c):
+    # 親カードの parent_id は NULL に統一（'' と NULL が混在していた）、子カードは整数に
+    c.execute("UPDATE trades SET parent_id = NULL WHERE parent_id = ''")
+    c.execute('''
+        UPDATE trades SET parent_id = CAST(parent_id AS INTEGER)
+        WHERE typeof(parent_id) = 'text' AND parent_id GLOB '[0-9]*'
+    ''')
+
+
+def migration_trade_indexes(c):
+    # 親カード一覧・子カード取得（parent_id IS NULL / parent_id=? と date, id 順）
+    c.execute("CREATE INDEX IF NOT EXISTS idx_trades_parent ON trades (parent_id, date, id)")
+    # 銘柄コードでの重複親カード判定・件数
+    c.execute("DROP INDEX IF EXISTS idx_trades_code")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_trades_code_parent ON trades (code, parent_id)")
+    # ウォッチ中の銘柄（type='watch' AND code=?）
+    c.execute("CREATE INDEX IF NOT EXISTS idx_trades_watch ON trades (code) WHERE type = 'watch'")
+    # 期間指定（date BETWEEN）と date, id 順の全件走査
+    c.execute("CREATE INDEX IF NOT EXISTS idx_trades_date ON trades (date, id)")
+
+
+def migration_positions(c):
+    # チェーン（親＋子カード）ごとの残数・平均単価・確定損益のスナップショット
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS positions (
+            parent_id INTEGER PRIMARY KEY,
+            pos_qty INTEGER,
+            pos_cost REAL,
+            avg_price REAL,
+            short_qty INTEGER,
+            short_cost REAL,
+            short_avg_price REAL,
+            realized_profit REAL,
+            is_completed INTEGER,
+            last_date TEXT
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_positions_last_date ON positions (last_date DESC, parent_id)")
+    # parent_id の正規化で親カードが増えている可能性があるので作り直す
+    rebuild_positions(c)
+
+
+def migration_ledger_version(c):
+    # 書き込みのたびに1つ増やすカウンタ（全ワーカー共通のキャッシュ無効化に使う）
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS ledger_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )
+    ''')
+    c.execute("INSERT OR IGNORE INTO ledger_version (id, version) VALUES (1, 0)")
+
+
+def migration_trades_fts(c):
+    # メモ・銘柄名・コードの全文検索。trigram なので日本語も分かち書きなしで部分一致できる
+    # 本文は trades から読む外部コンテンツ表にして、トリガーで索引だけ同期する
+    try:
+        c.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS trades_fts USING fts5(
+                memo, stock, code, content='trades', content_rowid='id', tokenize='trigram'
+            )
+        """)
+    except sqlite3.OperationalError:
+        # FTS5/trigram の無い古い SQLite（3.34 未満）では LIKE 検索のまま使う
+        return
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS trades_fts_insert AFTER INSERT ON trades BEGIN
+            INSERT INTO trades_fts (rowid, memo, stock, code) VALUES (new.id, new.memo, new.stock, new.code);
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS trades_fts_delete AFTER DELETE ON trades BEGIN
+            INSERT INTO trades_fts (trades_fts, rowid, memo, stock, code)
+            VALUES ('delete', old.id, old.memo, old.stock, old.code);
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS trades_fts_update AFTER UPDATE OF memo, stock, code ON trades BEGIN
+            INSERT INTO trades_fts (trades_fts, rowid, memo, stock, code)
+            VALUES ('delete', old.id, old.memo, old.stock, old.code);
+            INSERT INTO trades_fts (rowid, memo, stock, code) VALUES (new.id, new.memo, new.stock, new.code);
+        END
+    """)
+    c.execute("INSERT INTO trades_fts (trades_fts) VALUES ('rebuild')")
+
+
+def migration_rollup(c):
+    # 決済1件ごとの確定損益（子カード単位）と、それを決済日×感情×目的で日ごとにまとめた表
+    # /matrix はこの2つを読むだけで、台帳の再生はしない
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS closed_trades (
+            child_id INTEGER PRIMARY KEY,
+            parent_id INTEGER NOT NULL,
+            exit_date TEXT,
+            entry_date TEXT,
+            entry_feeling INTEGER,
+            exit_feeling INTEGER,
+            purpose INTEGER NOT NULL,
+            profit REAL NOT NULL,
+            holding_days INTEGER
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_closed_trades_parent ON closed_trades (parent_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_closed_trades_exit_date ON closed_trades (exit_date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_closed_trades_profit ON closed_trades (profit)")
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS daily_rollup (
+            exit_date TEXT NOT NULL,
+            entry_feeling INTEGER NOT NULL,  -- 感情が無いものは -1
+            exit_feeling INTEGER NOT NULL,
+            purpose INTEGER NOT NULL,
+            profit_sum REAL NOT NULL,
+            trade_count INTEGER NOT NULL,
+            win_count INTEGER NOT NULL,
+            holding_days_sum INTEGER NOT NULL,
+            holding_days_count INTEGER NOT NULL,  -- 保有日数が計算できた件数
+            PRIMARY KEY (exit_date, entry_feeling, exit_feeling, purpose)
+        ) WITHOUT ROWID
+    ''')
+    rebuild_rollup(c)
+
+
+def migration_prices(c):
+    # 銘柄ごとの日々の終値（ローカルのCSVから import-prices で取り込む）。
+    # (code, date) の主キーだけで「銘柄ごとの最新日」を索引から引ける
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS prices (
+            code TEXT NOT NULL,
+            date TEXT NOT NULL,
+            close REAL NOT NULL,
+            PRIMARY KEY (code, date)
+        ) WITHOUT ROWID
+    ''')
+    # 時価評価は建玉が残っているチェーンだけを読む
+    c.execute("CREATE INDEX IF NOT EXISTS idx_positions_open ON positions (parent_id) WHERE is_completed = 0")
+
+
+def migration_sort_indexes(c):
+    # /matrix の一覧は並び順（MATRIX_ORDER）ごとの索引を読むだけでページを切り出す（一時B木で並べ替えない）
+    c.execute("DROP INDEX IF EXISTS idx_closed_trades_exit_date")
+    c.execute("DROP INDEX IF EXISTS idx_closed_trades_profit")
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_closed_trades_date_asc
+        ON closed_trades (exit_date, entry_date, parent_id, child_id)
+    """)
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_closed_trades_date_desc
+        ON closed_trades (exit_date DESC, entry_date, parent_id, child_id)
+    """)
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_closed_trades_profit_asc
+        ON closed_trades (profit, entry_date, parent_id, exit_date, child_id)
+    """)
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_closed_trades_profit_desc
+        ON closed_trades (profit DESC, entry_date, parent_id, exit_date, child_id)
+    """)
+    # 期間指定なしのヒートマップ集計は (感情, 感情, 目的) 順の被覆索引だけで GROUP BY する
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_daily_rollup_cell
+        ON daily_rollup (entry_feeling, exit_feeling, purpose, profit_sum, trade_count,
+                         win_count, holding_days_sum, holding_days_count)
+    """)
+
+
+def migration_trade_date_not_null(c):
+    # 日付の無いカードは '' に統一する（NULL だと履歴の (date, id) のカーソルで比較できず、ページ送りから漏れる）。
+    # 列に NOT NULL を付けるには表を作り直す必要があるので、書き込みのたびにトリガーで '' にそろえる
+    c.execute("UPDATE trades SET date = '' WHERE date IS NULL")
+    if c.rowcount:
+        rebuild_positions(c)
+        rebuild_rollup(c)
+        bump_ledger_version(c)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS trades_date_insert AFTER INSERT ON trades WHEN new.date IS NULL BEGIN
+            UPDATE trades SET date = '' WHERE id = new.id;
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS trades_date_update AFTER UPDATE OF date ON trades WHEN new.date IS NULL BEGIN
+            UPDATE trades SET date = '' WHERE id = new.id;
+        END
+    """)
+
+
+MIGRATIONS = [
+    migration_base_schema,
+    migration_normalize_parent_id,
+    migration_trade_indexes,
+    migration_positions,
+    migration_ledger_version,
+    migration_trades_fts,
+    migration_rollup,
+    migration_prices,
+    migration_sort_indexes,
+    migration_trade_date_not_null,
+]
+
+
+def run_migrations(conn):
+    """
+    未適用のマイグレーションを1件ずつトランザクションで流す。
+    gunicorn の複数ワーカーが同時に起動しても、BEGIN IMMEDIATE で書き込みロックを
+    取ってから user_version を読み直すので二重には適用されない。
+    """
+    c = conn.cursor()
+    while True:
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("PRAGMA user_version")
+        version = c.fetchone()[0]
+        if version >= len(MIGRATIONS):
+            c.execute("COMMIT")
+            return version
         try:
-            purpose = int(purpose_raw)
+            MIGRATIONS[version](c)
+            c.execute(f"PRAGMA user_version = {version + 1}")
+            c.execute("COMMIT")
         except Exception:
-            purpose = 0  # 未設定
+            c.execute("ROLLBACK")
+            raise
 
 
+def init_db(path=None):
+    path = path or DATABASE
+    with _migrate_lock:
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        try:
+            # WAL はDBファイルに記録されるので一度設定すれば全ワーカーに効く
+            conn.execute("PRAGMA journal_mode = WAL")
+            run_migrations(conn)
+        finally:
+            conn.close()
+        _migrated.add(path)
+
+def hot_queries():
+    """
+    各ルートのホットなクエリを (ラベル, sql, params) で返す。
+    SQL はルートが実行するのと同じ定数・関数から作る（手で書き写さない）。
+    """
+    period = ("2025-01-01", "2025-12-31")
+    queries = [
+        ("/history 件数", HISTORY_COUNT_SQL, ()),
+        ("/history 親カード", HISTORY_PAGE_SQL, (HISTORY_PER_PAGE, 0)),
+        ("/history 次ページ", HISTORY_AFTER_SQL, ("2025-01-01", 1, HISTORY_PER_PAGE)),
+        ("/history 前ページ", HISTORY_BEFORE_SQL, ("2025-01-01", 1, HISTORY_PER_PAGE)),
+        ("/history 子カード", children_sql(2), (1, 2)),
+        ("/history?id=", CHAIN_SQL, (1, 1)),
+        ("/history?q= 全文検索", search_ranked_sql(SEARCH_FTS_HITS), ('"極洋"',)),
+        ("/summary 件数", SUMMARY_COUNT_SQL, ()),
+        ("/summary 一覧", SUMMARY_PAGE_SQL, (SUMMARY_PER_PAGE, 0)),
+        ("/summary 最新終値", LATEST_PRICES_SQL, ()),
+        ("/summary 建玉", OPEN_POSITIONS_SQL, ()),
+        ("/form 重複親カード", DUPLICATE_PARENTS_SQL, ("1301", "極洋")),
+        ("/form ウォッチ", WATCH_SQL, ("1301",)),
+        ("/form 残数", POSITION_SQL, (1,)),
+        ("/delete", DELETE_CHAIN_SQL, (1, 1)),
+    ]
+    for sort in MATRIX_ORDER:
+        for start, end in ((None, None), period):
+            # 期間を絞った損益順は期間内の行を並べ替えるしかないので、期間なしだけ見る
+            if start and sort.startswith("profit"):
+                continue
+            label = f"/matrix {sort}" + (" 期間" if start else "")
+            for name, (sql, params) in matrix_queries(start, end, sort, 2).items():
+                if name == "page" or sort == "date_desc":
+                    queries.append((f"{label} {name}", sql, params))
+    return queries
+
+
+def plan_problems(plan):
+    """
+    EXPLAIN QUERY PLAN の行から、実テーブルの全件走査（SCAN で索引なし）と、
+    実テーブルを走査しながらの一時B木での並べ替え（ORDER BY）を探す。
+    サブクエリ（MATERIALIZE / CO-ROUTINE）を読む SCAN は対象外。
+    """
+    subqueries = {"CONSTANT"}
+    for _, _, _, detail in plan:
+        match = re.match(r"(?:MATERIALIZE|CO-ROUTINE) (\S+)", detail)
+        if match:
+            subqueries.add(match.group(1))
+    scanning = set()  # 実テーブルを SCAN している階層（親の id）
+    problems = []
+    for _, parent, _, detail in plan:
+        match = re.match(r"SCAN (\S+)", detail)
+        if match and match.group(1) not in subqueries:
+            scanning.add(parent)
+            if "INDEX" not in detail:
+                problems.append(detail)
+    for _, parent, _, detail in plan:
+        if detail.startswith("USE TEMP B-TREE") and "ORDER BY" in detail and parent in scanning:
+            problems.append(detail)
+    return problems
+
+
+def check_query_plans():
+    """
+    hot_queries() のうち、実テーブルを索引なしで全件走査しているものと、
+    ページの並べ替えに一時B木を使っているものを返す。
+    """
+    problems = []
+    with get_db() as conn:
+        c = conn.cursor()
+        for label, sql, params in hot_queries():
+            c.execute("EXPLAIN QUERY PLAN " + sql, params)
+            problems.extend(f"{label}: {detail}" for detail in plan_problems(c.fetchall()))
+    return problems
 
 
+@app.cli.command("check-query-plans")
+def check_query_plans_command():
+    """ホットなクエリが索引を使っているか EXPLAIN QUERY PLAN で確認する"""
+    problems = check_query_plans()
+    for problem in problems:
+        click.echo(problem)
+    if problems:
+        raise SystemExit(1)
+    click.echo(f"{len(hot_queries())} 件のクエリすべてで索引が使われています。")
 
-        # ===============================
-        # 編集時：そのままUPDATE
-        # ===============================
-        if edit_id:
-            with sqlite3.connect(DATABASE) as conn:
-                c = conn.cursor()
-                c.execute("""
-                    UPDATE trades
-                    SET type=?, stock=?, price=?, quantity=?, total=?, date=?, feeling=?, memo=?, parent_id=?, code=?, purpose=?
-                    WHERE id=?
-                """, (type, stock, price, quantity, total, date, feeling, memo, parent_id, code, purpose, edit_id))
-                conn.commit()
-            return redirect("/history")
 
-        # ===============================
-        # 売り注文バリデーション
-        # ===============================
+# データ取得
+def get_trades():
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("SELECT * FROM trades ORDER BY date DESC")
+        return c.fetchall()
+
+
+@app.route("/")
+def index():
+    # トップは入力画面へ（履歴の組み立ては /history でページ単位に行う）
+    return redirect(url_for('form'))
+
+
+# ===============================
+# 集計結果のキャッシュ（台帳バージョンで無効化）
+# ===============================
+RESULT_CACHE_SIZE = 256
+
+
+def get_ledger_version(c):
+    c.execute("SELECT version FROM ledger_version WHERE id = 1")
+    row = c.fetchone()
+    return row[0] if row else 0
+
+
+def bump_ledger_version(c):
+    """
+    trades を書き換えたら同じトランザクション内で呼ぶ。
+    """
+    c.execute("UPDATE ledger_version SET version = version + 1 WHERE id = 1")
+
+
+class ResultCache:
+    """
+    ルートの計算結果をプロセス内に置いておくLRUキャッシュ。
+    台帳バージョンが保存時と違う結果は使わないので、どのワーカーで書き込んでも
+    次のリクエストから自動的に作り直される。
+    同じキー・同じバージョンの計算が走っている間に来たスレッドは、その結果を待って使う
+    （書き込み直後に同時アクセスが来ても重い集計は1回だけ）。
+    キーの先頭はDBファイル（ユーザーのシャード）で、ヒット数などはそれごとにも数える。
+    """
+
+    def __init__(self, maxsize=RESULT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.pending = {}  # 計算中のキー → (バージョン, 完了を知らせる Event)
+        self.counts = {}  # キーの先頭 → {"hits", "misses", "waits"}
+        self.lock = threading.Lock()
+
+    def count(self, key, name):
+        # lock を取った中で呼ぶ
+        counts = self.counts.setdefault(key[0], {"hits": 0, "misses": 0, "waits": 0})
+        counts[name] += 1
+
+    def get_or_compute(self, key, version, compute):
+        while True:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is not None and entry[0] == version:
+                    self.entries.move_to_end(key)
+                    self.count(key, "hits")
+                    return entry[1]
+                pending = self.pending.get(key)
+                if pending is None or pending[0] != version:
+                    done = threading.Event()
+                    self.pending[key] = (version, done)
+                    self.count(key, "misses")
+                    break
+                self.count(key, "waits")
+            # 計算していたスレッドが失敗したときは、起きたあと自分で計算する
+            pending[1].wait()
+
+        try:
+            value = compute()
+            with self.lock:
+                entry = self.entries.get(key)
+                # 遅れて終わった古いバージョンの計算で新しい結果を上書きしない
+                if entry is None or entry[0] <= version:
+                    self.entries[key] = (version, value)
+                    self.entries.move_to_end(key)
+                while len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+            return value
+        finally:
+            with self.lock:
+                if self.pending.get(key) == (version, done):
+                    del self.pending[key]
+            done.set()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self, scope=None):
+        """
+        scope（キーの先頭＝DBファイル）を渡せばその分だけ、無ければ全体の数を返す。
+        """
+        with self.lock:
+            scopes = [self.counts.get(scope, {})] if scope is not None else list(self.counts.values())
+            hits, misses, waits = (sum(counts.get(name, 0) for counts in scopes) for name in ("hits", "misses", "waits"))
+            lookups = hits + misses
+            return {
+                "hits": hits,
+                "misses": misses,
+                "waits": waits,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0,
+                "size": len(self.entries) if scope is None else sum(1 for key in self.entries if key[0] == scope),
+                "maxsize": self.maxsize,
+            }
+
+
+result_cache = ResultCache()
+
+
+def cached_result(key, compute):
+    """
+    (ルート名, パラメータ…) をキーに compute() の結果をキャッシュする。
+    バージョンは計算の前に読む（計算中に書き込みがあっても古い結果を新しい版として保存しない）。
+    """
+    with get_db() as conn:
+        version = get_ledger_version(conn.cursor())
+    return result_cache.get_or_compute((current_database(),) + key, version, compute)
+
+
+@app.route('/api/cache_stats')
+def cache_stats():
+    # キャッシュはワーカーごとなので pid も返す。シャードを使うときはログイン中のユーザーの分だけ
+    database = current_database()
+    return jsonify(dict(result_cache.stats(database), fragments=fragment_cache.stats(database), pid=os.getpid()))
+
+
+PURPOSE_LABELS = ["短期", "中期", "長期", "優待", "配当"]
+DATE_PATTERN = re.compile(r"[0-9]{4}-[0-9]{2}-[0-9]{2}")
+
+MATRIX_PER_PAGE = 10
+MATRIX_ORDER = {
+    # 同じ値どうしは従来（ツリーを親の date, id 順に走査）と同じ並びにする
+    "date_asc": "exit_date, entry_date, parent_id, child_id",
+    "date_desc": "exit_date DESC, entry_date, parent_id, child_id",
+    "profit_desc": "profit DESC, entry_date, parent_id, exit_date, child_id",
+    "profit_asc": "profit, entry_date, parent_id, exit_date, child_id",
+}
+
+
+def matrix_queries(start, end, sort, page, per_page=MATRIX_PER_PAGE):
+    """
+    build_matrix_analytics が流す SQL を {名前: (sql, params)} で返す（check_query_plans でも使う）。
+    期間は決済日で絞り込む。
+    """
+    if start and end:
+        where, params = "WHERE exit_date BETWEEN ? AND ?", [start, end]
+    else:
+        where, params = "", []
+    order = MATRIX_ORDER.get(sort, MATRIX_ORDER["date_desc"])
+    # 集計期間：トレードデータの日付で自動判定（date の索引の両端を読むだけ）
+    date_where = "date NOT IN ('', 'None')" + (" AND date BETWEEN ? AND ?" if start and end else "")
+    return {
+        # ヒートマップと目的別統計は (感情, 感情, 目的) ごとの合計（最大125行）から両方作る
+        "rollup": (f"""
+            SELECT entry_feeling, exit_feeling, purpose, SUM(profit_sum), SUM(trade_count),
+                   SUM(win_count), SUM(holding_days_sum), SUM(holding_days_count)
+            FROM daily_rollup {where}
+            GROUP BY entry_feeling, exit_feeling, purpose
+        """, params),
+        "count": (f"SELECT COUNT(*) FROM closed_trades {where}", params),
+        # 並べ替えとページの切り出しは closed_trades だけで行い、表示する行にだけメモ・銘柄を付ける
+        "page": (f"""
+            SELECT ct.profit, ct.entry_feeling, ct.exit_feeling, ct.holding_days, p.memo, ch.memo,
+                   ct.child_id, ct.exit_date, p.stock, ct.purpose
+            FROM (
+                SELECT * FROM closed_trades {where}
+                ORDER BY {order}
+                LIMIT ? OFFSET ?
+            ) ct
+            JOIN trades p ON p.id = ct.parent_id
+            JOIN trades ch ON ch.id = ct.child_id
+            ORDER BY {", ".join("ct." + column.strip() for column in order.split(","))}
+        """, params + [per_page, (page - 1) * per_page]),
+        "period": (f"""
+            SELECT (SELECT date FROM trades WHERE {date_where} ORDER BY date LIMIT 1),
+                   (SELECT date FROM trades WHERE {date_where} ORDER BY date DESC LIMIT 1)
+        """, params + params),
+        # 損益曲線は決済日ごとの合計（日付として並べられない '' や 'None' は除く）
+        # >= '0000' は主キーを範囲で引かせるため（GLOB だけでは索引を使えない）
+        "equity": (f"""
+            SELECT exit_date, SUM(profit_sum), SUM(trade_count), SUM(win_count)
+            FROM daily_rollup {where + " AND" if where else "WHERE"} exit_date >= '0000'
+                AND exit_date GLOB '[0-9][0-9][0-9][0-9]-*'
+            GROUP BY exit_date
+            ORDER BY exit_date
+        """, params),
+    }
+
+
+def build_matrix_analytics(start, end, sort, page, per_page=MATRIX_PER_PAGE):
+    """
+    /matrix の集計を closed_trades / daily_rollup から作る（台帳の再生はしない）。
+    ヒートマップと目的別統計は日ごとの集計行の合計、
+    一覧は SQL で並べ替えたページ分の行だけ読む。
+    """
+    from datetime import date
+
+    # analytics は集計全体（SQL を含む）。内訳は analytics.<クエリ名> と analytics.build（表・曲線の組み立て）
+    with profiled("analytics"):
+        rows = {}
+        with get_db() as conn:
+            c = conn.cursor()
+            for name, (sql, params) in matrix_queries(start, end, sort, page, per_page).items():
+                with profiled(f"analytics.{name}"):
+                    c.execute(sql, params)
+                    rows[name] = c.fetchall()
+        rollup_rows, page_rows, equity_rows = rows["rollup"], rows["page"], rows["equity"]
+        total = rows["count"][0][0]
+        first_date, last_date = rows["period"][0]
+
+        with profiled("analytics.build"):
+            analytics = build_matrix_results(rollup_rows, page_rows, equity_rows, total, per_page)
+
+    if first_date:
+        analytics["start_date"] = first_date
+        analytics["end_date"] = last_date
+    else:
+        today_str = date.today().strftime('%Y-%m-%d')
+        analytics["start_date"] = start or today_str
+        analytics["end_date"] = end or today_str
+    return analytics
+
+
+def build_matrix_results(rollup_rows, page_rows, equity_rows, total, per_page):
+    """
+    matrix_queries の結果から、画面・API に渡すヒートマップ・目的別統計・一覧・損益曲線を作る。
+    """
+    heatmap_avg, heatmap_sum, heatmap_counts = rollup_heatmaps(
+        [(entry, exit_, profit_sum, count) for entry, exit_, _, profit_sum, count, _, _, _ in rollup_rows]
+    )
+    return {
+        "results": [
+            (profit, clamp_feeling(entry), clamp_feeling(exit_), days if days is not None else "-",
+             entry_memo, exit_memo, child_id, exit_date, stock, purpose)
+            for profit, entry, exit_, days, entry_memo, exit_memo, child_id, exit_date, stock, purpose in page_rows
+        ],
+        "total_pages": ceil(total / per_page),
+        "heatmap_avg": heatmap_avg,
+        "heatmap_sum": heatmap_sum,
+        "heatmap_counts": heatmap_counts,
+        "purpose_graph_data": rollup_purpose_stats(
+            [(purpose, count, wins, days, days_n) for _, _, purpose, _, count, wins, days, days_n in rollup_rows]
+        ),
+        "equity_curve": equity_curve(equity_rows),
+    }
+
+
+def rollup_heatmaps(rows):
+    """
+    (エントリー感情, 決済感情, 損益合計, 件数) の集計行から 平均損益・合計損益・件数 の5×5表を作る。
+    """
+    N = 5  # 感情種類数
+    profit_mat = np.zeros((N, N))
+    count_mat = np.zeros((N, N))
+    for entry, exit_, profit_sum, count in rows:
+        if isinstance(entry, int) and isinstance(exit_, int) and 0 <= entry < N and 0 <= exit_ < N:
+            profit_mat[entry, exit_] += profit_sum
+            count_mat[entry, exit_] += count
+    with np.errstate(divide="ignore", invalid="ignore"):
+        avg_profit = np.where(count_mat > 0, profit_mat / count_mat, 0)
+    # 日ごとの合計を足し直すので、整数に切り捨てる前に足し算の順序による誤差を丸めておく
+    return (np.round(avg_profit, 6).astype(int).tolist(), np.round(profit_mat, 6).astype(int).tolist(),
+            count_mat.astype(int).tolist())
+
+
+def rollup_purpose_stats(rows):
+    """
+    (目的, 件数, 勝ち数, 保有日数合計, 保有日数の件数) の集計行から目的別の平均保有日数と勝率を作る。
+    目的コードが範囲外のものは除外し、負数は後ろから数える（-1 は配当）。
+    """
+    n = len(PURPOSE_LABELS)
+    total, win, days_sum, days_count = (np.zeros(n) for _ in range(4))
+    for purpose, count, wins, days, days_n in rows:
+        if -n <= purpose < n:
+            k = purpose % n
+            total[k] += count
+            win[k] += wins
+            days_sum[k] += days
+            days_count[k] += days_n
+
+    purpose_graph_data = []
+    for k, label in enumerate(PURPOSE_LABELS):
+        avg_days = round(float(days_sum[k]) / int(days_count[k]), 1) if days_count[k] else 0
+        win_rate = round(int(win[k]) / int(total[k]) * 100, 1) if total[k] > 0 else 0
+        purpose_graph_data.append({
+            "purpose": label,
+            "avg_days": avg_days,
+            "win_rate": win_rate
+        })
+    return purpose_graph_data
+
+
+EQUITY_POINTS = 200  # ブラウザに送る損益曲線の点数の上限（10年分の日次でも数KBに収まる）
+EQUITY_WIN_WINDOW = 20  # 移動勝率は直近この件数以上の決済（日単位で区切る）で計算する
+
+
+def equity_curve(rows, max_points=EQUITY_POINTS, win_window=EQUITY_WIN_WINDOW):
+    """
+    (決済日, 損益合計, 件数, 勝ち数) の日ごとの行（決済日順）から、確定損益の累計・ドローダウン・移動勝率を作る。
+    全日分を計算してから LTTB で max_points 点に間引き、最大ドローダウンの山と谷の日は必ず残す。
+    """
+    if not rows:
+        return {"dates": [], "equity": [], "drawdown": [], "win_rate": [], "days": 0, "total_profit": 0,
+                "max_drawdown": 0, "max_drawdown_peak": None, "max_drawdown_trough": None,
+                "win_window": win_window}
+
+    dates = [row[0] for row in rows]
+    profit = np.array([row[1] for row in rows], dtype=float)
+    counts = np.array([row[2] for row in rows], dtype=np.int64)
+    wins = np.array([row[3] for row in rows], dtype=np.int64)
+
+    equity = np.cumsum(profit)
+    # 開始時点（累計0）も山に含めるので、最初から負けていればそれもドローダウン
+    peak = np.maximum.accumulate(np.maximum(equity, 0))
+    drawdown = equity - peak
+    trough = int(np.argmin(drawdown))
+    peak_at = np.flatnonzero(equity[:trough + 1] == peak[trough])
+
+    # 移動勝率：累計件数で「直近 win_window 件以上」を含む最初の日を二分探索して、累計の差で数える
+    cum_count = np.cumsum(counts)
+    cum_win = np.cumsum(wins)
+    start = np.searchsorted(cum_count, cum_count - win_window, side="right")
+    before = np.where(start > 0, start - 1, 0)
+    window_count = cum_count - np.where(start > 0, cum_count[before], 0)
+    window_win = cum_win - np.where(start > 0, cum_win[before], 0)
+    win_rate = window_win / window_count * 100
+
+    keep = lttb(np.arange(len(equity), dtype=float), equity, max_points)
+    keep = np.union1d(keep, [trough] + ([int(peak_at[-1])] if len(peak_at) else []))
+    return {
+        "dates": [dates[i] for i in keep],
+        "equity": np.round(equity[keep]).astype(np.int64).tolist(),
+        "drawdown": np.round(drawdown[keep]).astype(np.int64).tolist(),
+        "win_rate": np.round(win_rate[keep], 1).tolist(),
+        "days": len(rows),
+        "total_profit": int(round(float(equity[-1]))),
+        "max_drawdown": int(round(float(drawdown[trough]))),
+        "max_drawdown_peak": dates[int(peak_at[-1])] if len(peak_at) and drawdown[trough] < 0 else None,
+        "max_drawdown_trough": dates[trough] if drawdown[trough] < 0 else None,
+        "win_window": win_window,
+    }
+
+
+def lttb(x, y, n_out):
+    """
+    Largest-Triangle-Three-Buckets で (x, y) を n_out 点に間引き、残す点の添字を返す。
+    両端は必ず残し、間をほぼ等しい幅のバケツに分けて、前に選んだ点と次のバケツの平均とで作る
+    三角形の面積が最大の点を各バケツから1点ずつ選ぶ（山や谷の形が残る）。
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    keep = np.empty(n_out, dtype=np.int64)
+    keep[0], keep[-1] = 0, n - 1
+    a = 0
+    for b in range(n_out - 2):
+        lo, hi = edges[b], edges[b + 1]
+        next_lo, next_hi = (edges[b + 1], edges[b + 2]) if b + 2 < len(edges) else (n - 1, n)
+        avg_x = x[next_lo:next_hi].mean()
+        avg_y = y[next_lo:next_hi].mean()
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(np.argmax(area))
+        keep[b + 1] = a
+    return keep
+
+
+@app.route("/matrix")
+def matrix():
+    # 1. 日付パラメータ取得（なければ全期間）
+    start = request.args.get('start')
+    end = request.args.get('end')
+    sort = request.args.get('sort', 'date_desc')
+    page = int(request.args.get('page', 1))
+    mode = request.args.get('mode', 'avg')  # 表示の切り替えだけなのでキャッシュのキーには含めない
+
+    analytics = cached_result(
+        ("matrix", start, end, sort, page),
+        lambda: build_matrix_analytics(start, end, sort, page)
+    )
+
+    return render_template(
+        "matrix.html",
+        start_date=analytics["start_date"],
+        end_date=analytics["end_date"],
+        results=analytics["results"],
+        page=page,
+        total_pages=analytics["total_pages"],
+        current="matrix",
+        sort=sort,
+        purposes=purposes,
+        entry_feelings=entry_feelings,
+        exit_feelings=exit_feelings,
+        purpose_graph_data=analytics["purpose_graph_data"],
+        equity_curve=analytics["equity_curve"],
+        heatmap_avg=analytics["heatmap_avg"],
+        heatmap_sum=analytics["heatmap_sum"],
+        heatmap_counts=analytics["heatmap_counts"],
+        mode=mode,
+    )
+
+
+
+
+
+
+
+SUMMARY_PER_PAGE = 12
+# 件数は positions の行数から、コード未設定の親カードを引く（どちらも索引だけで数えられる）
+SUMMARY_COUNT_SQL = """
+    SELECT (SELECT COUNT(*) FROM positions) -
+           (SELECT COUNT(*) FROM trades WHERE code IS NULL AND parent_id IS NULL)
+"""
+SUMMARY_PAGE_SQL = """
+    SELECT pg.*,
+           (SELECT ch.memo FROM trades ch
+            WHERE ch.parent_id = pg.id
+            ORDER BY ch.date DESC, ch.id DESC LIMIT 1) AS latest_child_memo
+    FROM (
+        SELECT t.id, t.code, t.stock, t.purpose, t.feeling, t.memo, t.type,
+               p.pos_qty, p.short_qty, p.avg_price, p.short_avg_price,
+               p.last_date AS latest_date
+        FROM positions p
+        JOIN trades t ON t.id = p.parent_id
+        WHERE t.code IS NOT NULL
+        ORDER BY p.last_date DESC, p.parent_id
+        LIMIT ? OFFSET ?
+    ) pg
+"""
+
+
+def fetch_summary_page(c, page=1, per_page=SUMMARY_PER_PAGE):
+    """
+    保有一覧1ページ分を1本のSQLで取得する。
+    残数・平均単価・最新売買日は positions、最新メモは最新の子カードから取る。
+    並び替え（positions.last_date の索引順）とページングもSQL側で行い、
+    メモの取得はページ内の行だけに絞る。
+    戻り値: (行のリスト, total_pages)
+    各行: (id, code, stock, purpose, feeling, memo, type, pos_qty, short_qty,
+           avg_price, short_avg_price, latest_date, latest_child_memo)
+    """
+    c.execute(SUMMARY_COUNT_SQL)
+    total = c.fetchone()[0]
+    total_pages = (total + per_page - 1) // per_page
+
+    c.execute(SUMMARY_PAGE_SQL, (per_page, (max(page, 1) - 1) * per_page))
+    return c.fetchall(), total_pages
+
+
+PURPOSE_NAMES = {
+    "0": "短期", "1": "中期", "2": "長期", "3": "優待", "4": "配当",
+    0: "短期", 1: "中期", 2: "長期", 3: "優待", 4: "配当"
+}
+
+
+def position_record(row, today, valuation=None):
+    """
+    fetch_summary_page の1行を保有1件分のdictにする（/summary と /api/v1/positions で共用）。
+    保有日数は today－最新売買日（日付が無い・不正なら None）。
+    valuation は value_positions の1件分（終値が無ければ None）。
+    """
+    (parent_id, code, stock, purpose_raw, feeling, parent_memo, parent_type,
+     pos_qty, short_qty, long_avg_price, short_avg_price, latest_date, child_memo) = row
+
+    # 残数・平均単価は positions スナップショットから（買いは+、空売りは-）
+    quantity = (pos_qty or 0) - (short_qty or 0)
+    avg_price = long_avg_price if parent_type == "buy" else short_avg_price
+
+    # 最新の子カードのメモ（空なら親カードのメモ）
+    memo = child_memo if child_memo not in [None, "", "None"] else parent_memo
+
+    # 保有日数＝今日－最新売買日
+    hold_days = None
+    if latest_date and latest_date != "None":
+        try:
+            base_date_dt = datetime.strptime(latest_date, "%Y-%m-%d").date()
+            delta = (today - base_date_dt).days
+            hold_days = delta if delta >= 0 else 0
+        except Exception:
+            hold_days = None
+
+    return {
+        "parent_id": parent_id,
+        "code": code,
+        "stock": stock,
+        "purpose": PURPOSE_NAMES.get(str(purpose_raw), purpose_raw),  # 目的名変換
+        "quantity": quantity,
+        "avg_price": avg_price,
+        "latest_date": latest_date,
+        "feeling": feeling,
+        "hold_days": hold_days,
+        "memo": memo,
+        "type": parent_type,
+        "valuation": valuation,
+    }
+
+
+@app.route("/summary")
+def summary():
+    page = int(request.args.get('page', 1))
+
+    def load_page():
+        with get_db() as conn:
+            return fetch_summary_page(conn.cursor(), page)
+
+    rows, total_pages = cached_result(("summary", page), load_page)
+    valuation = cached_valuation()
+
+    summary_data = []
+    today = datetime.today().date()
+    for row in rows:
+        position = position_record(row, today, valuation["positions"].get(row[0]))
+        summary_data.append([
+            position["code"],      # 0
+            position["stock"],     # 1
+            position["purpose"],   # 2
+            position["quantity"],  # 3
+            position["avg_price"] if position["avg_price"] else "-",  # 4: avg_price
+            position["latest_date"], # 5
+            position["feeling"],   # 6
+            position["hold_days"] if position["hold_days"] is not None else "-", # 7
+            position["memo"],      # 8
+            position["type"], # 9 ← typeを渡す
+            position["valuation"], # 10: 時価評価（終値が無ければ None）
+        ])
+
+    return render_template(
+        "summary.html",
+        page=page,
+        total_pages=total_pages,
+        current="summary",
+        summary_data=summary_data,
+        entry_feelings=entry_feelings,
+        valuation=valuation,
+    )
+
+
+
+
+
+
+
+@app.route("/settings")
+def settings():
+    return render_template("settings.html",current="settings", jobs=list_jobs(), job_labels=JOB_LABELS)
+
+
+
+
+
+# 同じ銘柄の親カード（合算/新規の確認）と、登録した銘柄のウォッチカード
+DUPLICATE_PARENTS_SQL = "SELECT * FROM trades WHERE code=? AND stock=? AND parent_id IS NULL"
+WATCH_SQL = "SELECT id FROM trades WHERE type = 'watch' AND code = ?"
+
+
+@app.route('/form', methods=['GET', 'POST'])
+def form():
+    edit_id = request.form.get('edit_id') or request.args.get('edit_id')
+    trade = None
+    is_parent_edit = True  # デフォルトは親
+
+    if request.method == "POST":
+        # 入力値取得
+        stock = request.form.get("stock")
+        code = request.form.get("code")
+        purpose_raw = request.form.get("purpose")
+        type = request.form.get("type")
+        price_raw = request.form.get("price")
+        quantity_raw = request.form.get("quantity")
+        date = request.form.get("date")
+        feeling_raw = request.form.get("feeling", "")
+        memo = request.form.get("memo")
+        parent_id = request.form.get("parent_id")
+        parent_id = int(parent_id) if parent_id else None
+        confirm = request.form.get("confirm")  # "合算" or "新規" or None
+
+        # バリデーション：数値項目
+        try:
+            price = int(float(price_raw))
+        except Exception:
+            return render_template('form.html', error_msg="株価が不正です", **locals())
+        try:
+            quantity = int(quantity_raw)
+        except Exception:
+            return render_template('form.html', error_msg="数量が不正です", **locals())
+        if not stock:
+            return render_template('form.html', error_msg="銘柄名が入力されていません", **locals())
+        if not code:
+            return render_template('form.html', error_msg="銘柄コードが入力されていません", **locals())
+        total = price * quantity
+
+        # 感情・目的（デフォルト値）
+        try:
+            feeling = int(feeling_raw)
+        except Exception:
+            feeling = 2  # 普通
+        try:
+            purpose = int(purpose_raw)
+        except Exception:
+            purpose = 0  # 未設定
+
+
+
+
+
+        # ===============================
+        # 編集時：そのままUPDATE
+        # ===============================
+        if edit_id:
+            with get_db() as conn:
+                c = conn.cursor()
+                c.execute("SELECT parent_id FROM trades WHERE id=?", (edit_id,))
+                old_row = c.fetchone()
+                c.execute("""
+                    UPDATE trades
+                    SET type=?, stock=?, price=?, quantity=?, total=?, date=?, feeling=?, memo=?, parent_id=?, code=?, purpose=?
+                    WHERE id=?
+                """, (type, stock, price, quantity, total, date, feeling, memo, parent_id, code, purpose, edit_id))
+                # 編集前後のチェーンを再計算（親の付け替えにも対応）
+                old_root = (old_row[0] or int(edit_id)) if old_row else None
+                new_root = parent_id or int(edit_id)
+                refresh_position(c, old_root)
+                if new_root != old_root:
+                    refresh_position(c, new_root)
+                bump_ledger_version(c)
+                conn.commit()
+            return redirect("/history")
+
+        # ===============================
+        # 売り注文バリデーション
+        # ===============================
         if type == 'sell' and parent_id:
-            with sqlite3.connect(DATABASE) as conn:
+            with get_db() as conn:
                 c = conn.cursor()
                 c.execute("SELECT type FROM trades WHERE id=?", (parent_id,))
                 parent_row = c.fetchone()
                 parent_type = parent_row[0] if parent_row else "buy"
+                # 残数は positions スナップショットから読む（チェーンの再集計はしない）
+                position = load_position(c, parent_id)
+                net_qty = (position.pos_qty - position.short_qty) if position else 0
                 if parent_type == "buy":
-                    c.execute("""
-                        SELECT COALESCE(SUM(CASE WHEN type='buy' THEN quantity ELSE 0 END), 0) -
-                               COALESCE(SUM(CASE WHEN type='sell' THEN quantity ELSE 0 END), 0)
-                        FROM trades
-                        WHERE parent_id=? OR id=?
-                    """, (parent_id, parent_id))
-                    remaining = c.fetchone()[0]
+                    remaining = net_qty
                 elif parent_type == "sell":
-                    c.execute("""
-                        SELECT COALESCE(SUM(CASE WHEN type='sell' THEN quantity ELSE 0 END), 0) -
-                               COALESCE(SUM(CASE WHEN type='buy' THEN quantity ELSE 0 END), 0)
-                        FROM trades
-                        WHERE parent_id=? OR id=?
-                    """, (parent_id, parent_id))
-                    remaining = c.fetchone()[0]
+                    remaining = -net_qty
                 else:
                     remaining = 0
             if quantity > remaining:
                 error_msg = f"親カードの残株数（{remaining}株）以上の売りはできません！"
-                trade_tree = build_trade_tree(get_trades())
+                with get_db() as conn:
+                    trade_tree, _, _, _ = fetch_history_page(conn.cursor(), page=1)
                 return render_template(
                     "history.html",
-                    trade_tree=trade_tree,
+                    cards=render_trade_cards(trade_tree),
                     error_msg=error_msg,
                     current="history"
                 )
@@ -538,13 +2083,10 @@ def form():
         # ===============================
         # 追加売買（parent_idあり）や編集時はスルー
         if not edit_id and not parent_id:
-            with sqlite3.connect(DATABASE) as conn:
-                conn.row_factory = sqlite3.Row
+            with get_db() as conn:
                 c = conn.cursor()
-                c.execute(
-                    "SELECT * FROM trades WHERE code=? AND stock=? AND (parent_id IS NULL OR parent_id='')",
-                    (code, stock)
-                )
+                c.row_factory = sqlite3.Row
+                c.execute(DUPLICATE_PARENTS_SQL, (code, stock))
                 existing_parents = c.fetchall()
             same_purpose = [row for row in existing_parents if str(row["purpose"]) == str(purpose)]
             diff_purpose = [row for row in existing_parents if str(row["purpose"]) != str(purpose)]
@@ -563,12 +2105,14 @@ def form():
                 new_qty = old_qty + quantity
                 new_total = old_total + total
                 new_price = new_total / new_qty if new_qty else 0
-                with sqlite3.connect(DATABASE) as conn:
+                with get_db() as conn:
                     c = conn.cursor()
                     c.execute(
                         "UPDATE trades SET quantity=?, total=?, price=?, date=? WHERE id=?",
                         (new_qty, new_total, new_price, date, parent_id_)
                     )
+                    refresh_position(c, parent_id_)
+                    bump_ledger_version(c)
                     conn.commit()
                 flash("合算で登録しました。")
                 return redirect(url_for("history"))
@@ -599,9 +2143,9 @@ def form():
         # ===============================
         show_modal = False
         watch_id = None
-        with sqlite3.connect(DATABASE) as conn:
+        with get_db() as conn:
             c = conn.cursor()
-            c.execute("SELECT id FROM trades WHERE type = 'watch' AND code = ?", (code,))
+            c.execute(WATCH_SQL, (code,))
             watch = c.fetchone()
             if watch:
                 watch_id = watch[0]
@@ -609,6 +2153,11 @@ def form():
                 INSERT INTO trades (type, stock, price, quantity, total, date, feeling, memo, parent_id, code, purpose)
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             """, (type, stock, price, quantity, total, date, feeling, memo, parent_id, code, purpose))
+            if parent_id:
+                apply_trade_to_position(c, parent_id, c.lastrowid)
+            else:
+                refresh_position(c, c.lastrowid)
+            bump_ledger_version(c)
             conn.commit()
             if watch_id and type != 'watch':
                 show_modal = True
@@ -617,7 +2166,7 @@ def form():
 
     # GET時：編集データ取得
     if edit_id and request.method == 'GET':
-        with sqlite3.connect(DATABASE) as conn:
+        with get_db() as conn:
             c = conn.cursor()
             c.execute("SELECT * FROM trades WHERE id=?", (edit_id,))
             trade = c.fetchone()
@@ -630,9 +2179,12 @@ def form():
 
 
 
+DELETE_CHAIN_SQL = "DELETE FROM trades WHERE id=? OR parent_id=?"
+
+
 @app.route('/delete/<int:id>')
 def delete(id):
-    with sqlite3.connect(DATABASE) as conn:
+    with get_db() as conn:
         c = conn.cursor()
         # まず指定idのparent_idを取得
         c.execute('SELECT parent_id FROM trades WHERE id=?', (id,))
@@ -641,252 +2193,1947 @@ def delete(id):
             parent_id = result[0]
             if parent_id is None:
                 # 親カード（parent_idがNULL）なら親＋子を全部消す
-                c.execute('DELETE FROM trades WHERE id=? OR parent_id=?', (id, id))
+                c.execute(DELETE_CHAIN_SQL, (id, id))
+                refresh_position(c, id)
             else:
                 # 子カードなら自分だけ消す
                 c.execute('DELETE FROM trades WHERE id=?', (id,))
+                refresh_position(c, parent_id)
+            bump_ledger_version(c)
             conn.commit()
     return redirect('/history')
 
 
-@app.route("/history")
-def history():
-    id = request.args.get("id")
-    q = request.args.get("q", "").strip()
-    watch_to_delete = request.args.get("watch_to_delete")  # ← 追加
-    with sqlite3.connect(DATABASE) as conn:
-        c = conn.cursor()
-        if id:
-            # 1. 親idを特定
-            c.execute("SELECT parent_id FROM trades WHERE id=?", (id,))
-            parent_id_row = c.fetchone()
-            if parent_id_row and parent_id_row[0]:
-                # 子カードなら親idを使う
-                root_id = parent_id_row[0]
-            else:
-                # 親カードなら自分のid
-                root_id = id
-            # 2. 親＋子カードのみ取得
-            c.execute("SELECT * FROM trades WHERE id=? OR parent_id=? ORDER BY date, id", (root_id, root_id))
-            trades = c.fetchall()
-        elif q:
-            # 検索
-            q_like = f"%{q}%"
-            c.execute("SELECT * FROM trades WHERE code LIKE ? ORDER BY date, id", (q_like,))
-            trades = c.fetchall()
-        else:
-            c.execute("SELECT * FROM trades ORDER BY date DESC, id DESC")
-            trades = c.fetchall()
-    trade_tree = build_trade_tree(trades)
+HISTORY_PER_PAGE = 10
 
 
-        # ページネーション処理を追加
-    page = int(request.args.get("page", 1))
-    per_page = 10
-    total = len(trade_tree)
-    total_pages = ceil(total / per_page)
-    start = (page - 1) * per_page
-    end = start + per_page
-    trade_tree_page = trade_tree[start:end]
+def parse_cursor(value):
+    """
+    ページ送りのカーソル「日付:id」を (date, id) にする。不正ならNone。
+    日付の無いカードは ''（trades.date は NULL にならない）なので「:id」になる。
+    """
+    if not value:
+        return None
+    date, _, id_ = value.rpartition(":")
+    try:
+        return (date, int(id_))
+    except ValueError:
+        return None
 
-    return render_template(
-        "history.html",
-        trade_tree=trade_tree_page,
-        current="history",
-        page=page,
-        total_pages=total_pages,
-        watch_to_delete=watch_to_delete,
-    )
 
+# 履歴の親カードは (date, id) の降順。カーソルは idx_trades_parent (parent_id, date, id) を範囲で引く
+HISTORY_COUNT_SQL = "SELECT COUNT(*) FROM trades WHERE parent_id IS NULL"
+HISTORY_PAGE_SQL = """
+    SELECT * FROM trades WHERE parent_id IS NULL
+    ORDER BY date DESC, id DESC LIMIT ? OFFSET ?
+"""
+HISTORY_AFTER_SQL = """
+    SELECT * FROM trades WHERE parent_id IS NULL AND (date, id) < (?, ?)
+    ORDER BY date DESC, id DESC LIMIT ?
+"""
+HISTORY_BEFORE_SQL = """
+    SELECT * FROM trades WHERE parent_id IS NULL AND (date, id) > (?, ?)
+    ORDER BY date ASC, id ASC LIMIT ?
+"""
+CHAIN_SQL = "SELECT * FROM trades WHERE id=? OR parent_id=? ORDER BY date, id"
 
 
+def children_sql(count):
+    return f"SELECT * FROM trades WHERE parent_id IN ({','.join('?' * count)})"
 
 
-@app.route("/debug")
-def debug():
-    conn = sqlite3.connect("cocotoshi.db")
-    c = conn.cursor()
-    c.execute("SELECT id, type, stock, code, parent_id FROM trades ORDER BY date DESC")
-    rows = c.fetchall()
-    conn.close()
+def fetch_history_page(c, page=1, per_page=HISTORY_PER_PAGE, after=None, before=None, q=None):
+    """
+    履歴1ページ分の親カードとその子カードだけを取得してツリーにする。
+    親カードは (date, id) のキーセットでページ送りする（after=次へ / before=前へ）。
+    カーソルが無いときは page 番号から OFFSET で位置を決める。
+    q があれば search_history_page で検索結果のページを返す。
+    戻り値: (trade_tree, total_pages, prev_cursor, next_cursor)
+    """
+    if q:
+        return search_history_page(c, q, page=page, per_page=per_page)
 
-    html = "<h2>トレード一覧（デバッグ表示）</h2><table border='1'><tr><th>ID</th><th>タイプ</th><th>銘柄</th><th>コード</th><th>親ID</th></tr>"
-    for row in rows:
-        html += "<tr>" + "".join(f"<td>{col}</td>" for col in row) + "</tr>"
-    html += "</table>"
+    c.execute(HISTORY_COUNT_SQL)
+    total = c.fetchone()[0]
+    total_pages = ceil(total / per_page)
 
-    return html
+    if after:
+        c.execute(HISTORY_AFTER_SQL, (after[0], after[1], per_page))
+        parents = c.fetchall()
+    elif before:
+        c.execute(HISTORY_BEFORE_SQL, (before[0], before[1], per_page))
+        parents = c.fetchall()[::-1]
+    else:
+        c.execute(HISTORY_PAGE_SQL, (per_page, (max(page, 1) - 1) * per_page))
+        parents = c.fetchall()
 
+    trade_tree = build_trade_tree(parents + fetch_children(c, parents))
+    prev_cursor = f"{parents[0][6]}:{parents[0][0]}" if parents else None
+    next_cursor = f"{parents[-1][6]}:{parents[-1][0]}" if parents else None
+    return trade_tree, total_pages, prev_cursor, next_cursor
 
 
-def build_trade_tree(trades):
-    # トレードを辞書形式に変換（列名付き）
-    trade_list = [dict(
-        id=row[0],
-        type=row[1],
-        stock=row[2],
-        price=float(row[3]) if row[3] is not None else 0.0,
-        quantity=int(row[4]) if row[4] is not None else 0,
-        total=float(row[5]) if row[5] is not None else 0.0,
-        date=row[6],
-        feeling=row[7],
-        memo=row[8],
-        parent_id=row[9],
-        code=row[10],
-        remaining_quantity=row[11] if len(row) > 11 else 0,
-        purpose=row[12] if len(row) > 12 else ""
-    ) for row in trades]
+def fetch_children(c, parents):
+    if not parents:
+        return []
+    c.execute(children_sql(len(parents)), [row[0] for row in parents])
+    return c.fetchall()
 
-    tree = []
 
-    for parent in [t for t in trade_list if t["parent_id"] is None]:
-        # 親＋子カードをdate, id順でまとめる
-        trade_chain = sorted(
-            [parent] + [c for c in trade_list if c["parent_id"] == parent["id"]],
-            key=lambda x: (x["date"], x["id"])
-        )
+def fetch_chain(c, trade_id):
+    """
+    trade_id（親でも子でもよい）を含むチェーン1つだけをツリーにする。無ければ空リスト。
+    """
+    # 1. 親idを特定
+    c.execute("SELECT parent_id FROM trades WHERE id=?", (trade_id,))
+    parent_id_row = c.fetchone()
+    if parent_id_row and parent_id_row[0]:
+        # 子カードなら親idを使う
+        root_id = parent_id_row[0]
+    else:
+        # 親カードなら自分のid
+        root_id = trade_id
+    # 2. 親＋子カードのみ取得
+    c.execute(CHAIN_SQL, (root_id, root_id))
+    return build_trade_tree(c.fetchall())
+
+
+FTS_MIN_QUERY_LENGTH = 3  # trigram は3文字未満の語を索引で引けない
+
+
+def has_trades_fts(c):
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'trades_fts'")
+    return c.fetchone() is not None
+
+
+SEARCH_FTS_HITS = """
+    SELECT COALESCE(t.parent_id, t.id) AS root, MIN(f.rank) AS score
+    FROM trades_fts f JOIN trades t ON t.id = f.rowid
+    WHERE trades_fts MATCH ?
+    GROUP BY root
+"""
+# 3文字未満の語は trigram の索引で引けないので全件を LIKE で見る
+SEARCH_LIKE_HITS = """
+    SELECT COALESCE(parent_id, id) AS root, 0 AS score
+    FROM trades
+    WHERE memo LIKE ? OR stock LIKE ? OR code LIKE ?
+    GROUP BY root
+"""
+
+
+def search_ranked_sql(hits):
+    return f"""
+        SELECT p.id FROM ({hits}) h JOIN trades p ON p.id = h.root AND p.parent_id IS NULL
+        ORDER BY h.score, p.date DESC, p.id DESC
+    """
+
+
+def search_history_page(c, q, page=1, per_page=HISTORY_PER_PAGE):
+    """
+    メモ・銘柄名・コードに q を含むカードがあるチェーンを、関連度（bm25）の高い順に返す。
+    ヒットしたカードの親を単位にまとめ、ページ分のチェーンだけツリーにする。
+    3文字未満の検索語や FTS5 の無い環境では LIKE で探し、新しい順に並べる。
+    戻り値は fetch_history_page と同じ（検索結果はランク順なのでカーソルは None）。
+    """
+    if len(q) >= FTS_MIN_QUERY_LENGTH and has_trades_fts(c):
+        # 全体を1つのフレーズとして渡す（記号や AND/OR を演算子として解釈させない）
+        hits = SEARCH_FTS_HITS
+        params = ['"' + q.replace('"', '""') + '"']
+    else:
+        hits = SEARCH_LIKE_HITS
+        params = [f"%{q}%"] * 3
+
+    # ヒットは1回だけ引いて、件数とページの切り出しは並べた id の列で行う
+    c.execute(search_ranked_sql(hits), params)
+    ranked_ids = [row[0] for row in c.fetchall()]
+    total_pages = ceil(len(ranked_ids) / per_page)
+    offset = (max(page, 1) - 1) * per_page
+    page_ids = ranked_ids[offset:offset + per_page]
+
+    parents = []
+    if page_ids:
+        c.execute(f"SELECT * FROM trades WHERE id IN ({','.join('?' * len(page_ids))})", page_ids)
+        rows = {row[0]: row for row in c.fetchall()}
+        parents = [rows[id_] for id_ in page_ids]
+
+    trade_tree = build_trade_tree(parents + fetch_children(c, parents))
+    return trade_tree, total_pages, None, None
+
+
+FRAGMENT_CACHE_SIZE = 1024  # チェーン1つ分のHTMLは数KBなので、ワーカーあたり数MBまで
+
+# チェーンごとのカードHTML。キーにチェーンの版を含めるので、古い版は LRU で押し出される
+fragment_cache = ResultCache(FRAGMENT_CACHE_SIZE)
+
+
+def chain_version(item):
+    """
+    チェーンの版＝カードに出る列の値そのもの（親＋子カード）。
+    画面・CSV取り込み・positions の作り直しなど、どの経路で書き換わっても別の版になる。
+    """
+    return tuple(
+        (t.id, t.type, t.stock, t.price, t.quantity, t.total, t.date, t.feeling, t.memo,
+         t.parent_id, t.code, t.purpose)
+        for t in [item.parent] + item.children
+    )
+
+
+def render_trade_cards(trade_tree):
+    """
+    history.html に並べるチェーンごとのカードHTMLを返す。
+    (チェーンid, 版) ごとにキャッシュし、書き換わったチェーンだけ描画し直す。
+    """
+    template = app.jinja_env.get_template("history_card.html")
+    cards = []
+    database = current_database()
+    with profiled("render"):
+        for item in trade_tree:
+            key = (database, "card", item.parent.id, chain_version(item))
+            cards.append(fragment_cache.get_or_compute(key, 0, lambda: Markup(template.render(
+                item=item, entry_feelings=entry_feelings, exit_feelings=exit_feelings,
+            ))))
+    return cards
+
+
+@app.route("/history")
+def history():
+    id = request.args.get("id")
+    q = request.args.get("q", "").strip()
+    watch_to_delete = request.args.get("watch_to_delete")  # ← 追加
+    page = int(request.args.get("page", 1))
+    prev_cursor = next_cursor = None
+    with get_db() as conn:
+        c = conn.cursor()
+        if id:
+            trade_tree = fetch_chain(c, id)
+            page, total_pages = 1, 1
+        else:
+            # 親カードをSQL側でページングし、そのページのチェーンだけ組み立てる
+            trade_tree, total_pages, prev_cursor, next_cursor = fetch_history_page(
+                c,
+                page=page,
+                after=parse_cursor(request.args.get("after")),
+                before=parse_cursor(request.args.get("before")),
+                q=q,
+            )
+
+    return render_template(
+        "history.html",
+        cards=render_trade_cards(trade_tree),
+        current="history",
+        page=page,
+        total_pages=total_pages,
+        prev_cursor=prev_cursor,
+        next_cursor=next_cursor,
+        watch_to_delete=watch_to_delete,
+    )
+
+
+
+
+
+# ===============================
+# JSON API（/api/v1）
+# ===============================
+API_VERSION = "v1"
+
+
+def api_response(key, compute, *etag_parts):
+    """
+    compute() の結果をJSONで返す。ETag は API の版・DB（シャード）・台帳バージョン（＋etag_parts）から作る強いETag。
+    シャードごとに台帳バージョンは別に数えるので、DB を入れないと別のユーザーと同じ ETag になる。
+    If-None-Match が一致すれば compute() を呼ばずに 304 を返す。
+    結果は cached_result と同じく台帳バージョン付きで result_cache に置く。
+    """
+    with get_db() as conn:
+        version = get_ledger_version(conn.cursor())
+    tenant = hashlib.sha256(current_database().encode()).hexdigest()[:8]
+    etag = "-".join([API_VERSION, tenant, str(version)] + [str(part) for part in etag_parts])
+
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(result_cache.get_or_compute((current_database(), "api") + key, version, compute))
+    response.set_etag(etag)
+    # 保存してよいが、使う前に必ず再検証させる（変わっていなければ 304 で本文を送らない）
+    response.headers["Cache-Control"] = "no-cache"
+    if SHARD_DIR:
+        # 中身はログイン中のユーザーのものなので、共有キャッシュには置かせずクッキーごとに分けさせる
+        response.headers["Cache-Control"] = "private, no-cache"
+        response.vary.add("Cookie")
+    return response
+
+
+@app.route("/api/v1/chains")
+def api_chains():
+    """
+    親カード単位のチェーン（build_trade_tree の出力）を1ページ分。
+    ?page= / ?after=・?before=（日付:id のカーソル）/ ?q= は /history と同じ。
+    """
+    page = max(request.args.get("page", 1, type=int), 1)
+    after = request.args.get("after")
+    before = request.args.get("before")
+    q = request.args.get("q", "").strip()
+
+    def load():
+        with get_db() as conn:
+            trade_tree, total_pages, prev_cursor, next_cursor = fetch_history_page(
+                conn.cursor(), page=page, after=parse_cursor(after), before=parse_cursor(before), q=q
+            )
+        return {
+            "chains": trade_tree,
+            "page": page,
+            "total_pages": total_pages,
+            "prev_cursor": prev_cursor,
+            "next_cursor": next_cursor,
+        }
+
+    return api_response(("chains", page, after, before, q), load)
+
+
+@app.route("/api/v1/chains/<int:trade_id>")
+def api_chain(trade_id):
+    """
+    trade_id（親でも子でもよい）を含むチェーン1つ。無ければ 404。
+    """
+    with get_db() as conn:
+        # 子カードなら親カードがあるかを見る（fetch_chain と同じ親の決め方）
+        exists = conn.execute("""
+            SELECT 1 FROM trades
+            WHERE id = COALESCE((SELECT parent_id FROM trades WHERE id = ?), ?) AND parent_id IS NULL
+        """, (trade_id, trade_id)).fetchone()
+    if not exists:
+        return jsonify({"error": "not found"}), 404
+
+    def load():
+        with get_db() as conn:
+            return fetch_chain(conn.cursor(), trade_id)[0]
+
+    return api_response(("chain", trade_id), load)
+
+
+@app.route("/api/v1/positions")
+def api_positions():
+    """
+    保有一覧（/summary のデータ）を1ページ分。時価評価（prices の最新終値）も付ける。
+    保有日数は今日の日付で変わるのでETagに日付も入れる。
+    """
+    from datetime import date
+
+    page = max(request.args.get("page", 1, type=int), 1)
+    today = date.today()
+
+    def load():
+        with get_db() as conn:
+            c = conn.cursor()
+            rows, total_pages = fetch_summary_page(c, page)
+            valuation = value_positions(c)
+        return {
+            "positions": [position_record(row, today, valuation["positions"].get(row[0])) for row in rows],
+            "page": page,
+            "total_pages": total_pages,
+            "market_value": valuation["market_value"],
+            "unrealized": valuation["unrealized"],
+            "price_date": valuation["price_date"],
+        }
+
+    return api_response(("positions", page, today), load, today.isoformat())
+
+
+@app.route("/api/v1/analytics")
+def api_analytics():
+    """
+    /matrix の集計（感情ヒートマップ・目的別統計・損益曲線・決済一覧1ページ）。?start=&end=&sort=&page= は /matrix と同じ。
+    """
+    start = request.args.get("start")
+    end = request.args.get("end")
+    sort = request.args.get("sort", "date_desc")
+    page = max(request.args.get("page", 1, type=int), 1)
+
+    def load():
+        analytics = build_matrix_analytics(start, end, sort, page)
+        columns = ("profit", "entry_feeling", "exit_feeling", "holding_days", "entry_memo", "exit_memo",
+                   "child_id", "exit_date", "stock", "purpose")
+        return dict(
+            analytics,
+            page=page,
+            sort=sort,
+            results=[
+                dict(zip(columns, row), holding_days=row[3] if row[3] != "-" else None)
+                for row in analytics["results"]
+            ],
+        )
+
+    return api_response(("analytics", start, end, sort, page), load)
+
+
+@app.route("/debug")
+def debug():
+    database = current_database()
+
+    def generate():
+        conn = connect_db(database)
+        try:
+            c = conn.execute("SELECT id, type, stock, code, parent_id FROM trades ORDER BY date DESC")
+            yield "<h2>トレード一覧（デバッグ表示）</h2><table border='1'><tr><th>ID</th><th>タイプ</th><th>銘柄</th><th>コード</th><th>親ID</th></tr>"
+            for row in iter_cursor(c):
+                yield "<tr>" + "".join(f"<td>{escape(col)}</td>" for col in row) + "</tr>"
+            yield "</table>"
+        finally:
+            conn.close()
+
+    return Response(generate(), mimetype="text/html")
+
+
+
+# ===============================
+# エクスポート（CSV / JSON をストリーミングで返す）
+# ===============================
+EXPORT_FETCH_SIZE = 1000  # 一度にSQLiteから読む行数。台帳の大きさに関わらずメモリはこの分だけ
+EXPORT_TRADE_COLUMNS = ["id", "type", "stock", "price", "quantity", "total", "date",
+                        "feeling", "memo", "parent_id", "code", "purpose"]
+EXPORT_CHAIN_COLUMNS = ["parent_id", "code", "stock", "type", "purpose", "entry_date", "last_date",
+                        "trade_count", "remaining", "average_price", "total_profit", "is_completed"]
+
+
+def iter_cursor(c, size=EXPORT_FETCH_SIZE):
+    while True:
+        rows = c.fetchmany(size)
+        if not rows:
+            return
+        yield from rows
+
+
+def export_filters(args):
+    """
+    ?start=YYYY-MM-DD&end=YYYY-MM-DD&code=XXXX を (start, end, code) にする。形式が違う日付は無視。
+    """
+    start = args.get("start", "")
+    end = args.get("end", "")
+    code = args.get("code", "").strip()
+    return (
+        start if DATE_PATTERN.fullmatch(start) else None,
+        end if DATE_PATTERN.fullmatch(end) else None,
+        code or None,
+    )
+
 
-        # 現物・空売り両対応
-        pos_qty = 0          # 現物残数
-        pos_cost = 0.0       # 現物コスト合計
-        avg_price = 0.0      # 現物平均単価
-
-        short_qty = 0        # 空売り残数
-        short_cost = 0.0     # 空売りコスト合計
-        short_avg_price = 0.0# 空売り平均単価
-
-        profits = []
-
-        for t in trade_chain:
-            t["profits"] = []
-            q = t["quantity"]
-
-            if t["type"] == "buy":
-                if short_qty > 0:
-                    cover_qty = min(q, short_qty)
-                    if cover_qty > 0:
-                        profit = (short_avg_price - t["price"]) * cover_qty
-                        t["profits"].append(profit)
-                        short_cost -= short_avg_price * cover_qty
-                        short_qty -= cover_qty
-                        q -= cover_qty
-                    if q > 0:
-                        pos_cost += t["price"] * q
-                        pos_qty += q
-                        avg_price = pos_cost / pos_qty if pos_qty else 0
+def filter_clause(start, end, code, prefix=""):
+    conditions, params = [], []
+    if start:
+        conditions.append(f"{prefix}date >= ?")
+        params.append(start)
+    if end:
+        conditions.append(f"{prefix}date <= ?")
+        params.append(end)
+    if code:
+        conditions.append(f"{prefix}code = ?")
+        params.append(code)
+    return conditions, params
+
+
+def iter_export_trades(conn, start=None, end=None, code=None):
+    """
+    trades の生データを id 順に1行ずつ返す（日付・コードで絞り込み）。
+    """
+    conditions, params = filter_clause(start, end, code)
+    where = "WHERE " + " AND ".join(conditions) if conditions else ""
+    c = conn.execute(f"SELECT {', '.join(EXPORT_TRADE_COLUMNS)} FROM trades {where} ORDER BY id", params)
+    yield from iter_cursor(c)
+
+
+def iter_export_chains(conn, start=None, end=None, code=None):
+    """
+    親カードごとの損益・平均単価（build_trade_tree と同じ計算）を1チェーンずつ返す。
+    日付・コードは親カードで絞り込む。
+    親カードを id 順、子カードを (parent_id, date, id) 順に読む2本のカーソルを突き合わせるので、
+    メモリに持つのは今のチェーン1本だけ。
+    """
+    columns = "id, type, stock, price, quantity, total, date, feeling, memo, parent_id, code, remaining_quantity, purpose"
+    conditions, params = filter_clause(start, end, code)
+    parents = conn.execute(
+        f"SELECT {columns} FROM trades WHERE " + " AND ".join(["parent_id IS NULL"] + conditions) + " ORDER BY id",
+        params
+    )
+    # 子カードは親と別コードのこともあるので絞り込まない（build_trade_tree と同じチェーンにする）
+    children = conn.cursor().execute(
+        f"SELECT {columns} FROM trades WHERE parent_id IS NOT NULL ORDER BY parent_id, date, id"
+    )
+    child_rows = iter_cursor(children)
+    child = next(child_rows, None)
+
+    for row in iter_cursor(parents):
+        parent = row_to_trade(row)
+        chain = [parent]
+        while child is not None and child[9] < parent.id:
+            child = next(child_rows, None)  # 親が絞り込みで外れた子カード
+        while child is not None and child[9] == parent.id:
+            chain.append(row_to_trade(child))
+            child = next(child_rows, None)
+        chain.sort(key=trade_order)
+        state = replay_chain(chain)
+        yield (
+            parent.id, parent.code, parent.stock, parent.type, parent.purpose,
+            parent.date, chain[-1].date, len(chain),
+            state.remaining,
+            state.average_price(parent.type),
+            state.total_profit,
+            state.is_completed,
+        )
+
+
+def stream_csv(columns, rows):
+    # Excel で文字化けしないよう BOM を付ける（/import はそのまま読める）
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write("\ufeff")
+    writer.writerow(columns)
+    for i, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if i % EXPORT_FETCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def stream_json(columns, rows):
+    yield "["
+    separator = ""
+    for row in rows:
+        yield separator + json.dumps(dict(zip(columns, row)), ensure_ascii=False)
+        separator = ","
+    yield "]"
+
+
+EXPORTS = {
+    "trades": (EXPORT_TRADE_COLUMNS, iter_export_trades),
+    "chains": (EXPORT_CHAIN_COLUMNS, iter_export_chains),
+}
+EXPORT_FORMATS = {
+    "csv": (stream_csv, "text/csv"),
+    "json": (stream_json, "application/json"),
+}
+
+
+@app.route("/export/<kind>.<fmt>")
+def export(kind, fmt):
+    if kind not in EXPORTS or fmt not in EXPORT_FORMATS:
+        return jsonify({"error": "unknown export"}), 404
+    columns, iter_rows = EXPORTS[kind]
+    stream, mimetype = EXPORT_FORMATS[fmt]
+    start, end, code = export_filters(request.args)
+    database = current_database()  # ストリーミング中は g（ログイン中のユーザーのシャード）が使えない
+
+    def generate():
+        # ストリーミング中はリクエストの外で読むので、専用の接続を開いて最後に閉じる
+        conn = connect_db(database)
+        try:
+            yield from stream(columns, iter_rows(conn, start, end, code))
+        finally:
+            conn.close()
+
+    filename = f"cocotoshi_{kind}_{datetime.now().strftime('%Y%m%d')}.{fmt}"
+    return Response(
+        generate(),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
+
+
+# ===============================
+# 証券会社CSVの一括取り込み
+# ===============================
+IMPORT_BATCH_SIZE = 5000
+IMPORT_MAX_ERRORS = 20  # 画面に出すエラー行の上限（件数は全部数える）
+
+# CSVの列名（英語・日本語どちらでもよい）
+IMPORT_COLUMNS = {
+    "date": ["date", "日付", "約定日"],
+    "code": ["code", "コード", "銘柄コード"],
+    "type": ["type", "売買", "取引", "売買区分"],
+    "price": ["price", "単価", "約定単価", "株価"],
+    "quantity": ["quantity", "数量", "約定数量", "株数"],
+    "stock": ["stock", "銘柄名", "銘柄"],
+    "feeling": ["feeling", "感情"],
+    "purpose": ["purpose", "目的"],
+    "memo": ["memo", "メモ"],
+}
+IMPORT_TYPES = {
+    "buy": "buy", "買": "buy", "買付": "buy", "現物買": "buy",
+    "sell": "sell", "売": "sell", "売付": "sell", "現物売": "sell",
+}
+IMPORT_DATE_PATTERN = re.compile(r"([0-9]{4})[-/]([0-9]{1,2})[-/]([0-9]{1,2})")
+PURPOSE_CODES = {label: str(code) for code, label in purposes.items()}
+
+
+def resolve_import_columns(fieldnames, aliases_by_key=IMPORT_COLUMNS,
+                           required=("date", "code", "type", "price", "quantity")):
+    """
+    CSVヘッダから {項目: 実際の列名} を作る。必須列が無ければ ValueError。
+    """
+    header = {(name or "").strip().lower(): name for name in fieldnames or []}
+    columns = {}
+    for key, aliases in aliases_by_key.items():
+        for alias in aliases:
+            if alias.lower() in header:
+                columns[key] = header[alias.lower()]
+                break
+    missing = [key for key in required if key not in columns]
+    if missing:
+        raise ValueError("CSVに必要な列がありません: " + ", ".join(missing))
+    return columns
+
+
+def parse_import_code(text):
+    code = unicodedata.normalize("NFKC", text).upper()
+    if not code:
+        raise ValueError("銘柄コードがありません")
+    return code.zfill(4)
+
+
+def parse_import_date(text):
+    """
+    YYYY-MM-DD / YYYY/M/D を YYYY-MM-DD にする。不正なら ValueError。
+    """
+    # strptime は1行あたりが重いので、正規表現で分解してから datetime で妥当性だけ確かめる
+    match = IMPORT_DATE_PATTERN.fullmatch(text)
+    try:
+        year, month, day = (int(part) for part in match.groups())
+        datetime(year, month, day)
+    except (AttributeError, ValueError):
+        raise ValueError(f"日付が不正です（{text}）")
+    return f"{year:04d}-{month:02d}-{day:02d}"
+
+
+def parse_import_row(row, columns):
+    """
+    CSVの1行を /form と同じ形の値にそろえる。不正な行は ValueError。
+    """
+    def value(key):
+        column = columns.get(key)
+        return (row.get(column) or "").strip() if column else ""
+
+    type = IMPORT_TYPES.get(value("type").lower())
+    if type is None:
+        raise ValueError(f"売買区分が不正です（{value('type')}）")
+    code = parse_import_code(value("code"))
+    stock = value("stock") or code2company.get(code, "")
+    if not stock:
+        raise ValueError(f"銘柄名が分かりません（{code}）")
+    try:
+        price = int(float(value("price").replace(",", "")))
+    except ValueError:
+        raise ValueError("株価が不正です")
+    try:
+        quantity = int(value("quantity").replace(",", ""))
+    except ValueError:
+        raise ValueError("数量が不正です")
+    date = parse_import_date(value("date"))
+    try:
+        feeling = int(value("feeling"))
+    except ValueError:
+        feeling = 2  # 普通
+    purpose_raw = value("purpose")
+    purpose = PURPOSE_CODES.get(purpose_raw, purpose_raw)
+    try:
+        purpose = int(purpose)
+    except ValueError:
+        purpose = 0  # 未設定
+    return {
+        "type": type, "code": code, "stock": stock, "price": price, "quantity": quantity,
+        "total": price * quantity, "date": date, "feeling": feeling, "purpose": purpose,
+        "memo": value("memo"),
+    }
+
+
+def load_code_parents(c, code):
+    """
+    銘柄コードの親カードと、そのチェーンの正味残数（買い+・空売り-）・いちばん新しい子カードの日付を読む。
+    """
+    c.execute("""
+        SELECT t.id, t.type, t.stock, t.purpose, t.quantity, t.total,
+               COALESCE(p.pos_qty, 0) - COALESCE(p.short_qty, 0), t.date,
+               (SELECT MAX(ch.date) FROM trades ch WHERE ch.parent_id = t.id)
+        FROM trades t
+        LEFT JOIN positions p ON p.parent_id = t.id
+        WHERE t.code = ? AND t.parent_id IS NULL
+        ORDER BY t.id
+    """, (code,))
+    return [
+        {"id": row[0], "type": row[1], "stock": row[2], "purpose": row[3],
+         "quantity": row[4] or 0, "total": row[5] or 0, "net": row[6],
+         "date": row[7], "last_child_date": row[8]}
+        for row in c.fetchall()
+    ]
+
+
+def import_trades(f, batch_size=IMPORT_BATCH_SIZE, on_batch=None):
+    """
+    証券会社のCSV（テキストストリーム）を1行ずつ読んで取り込む。
+    振り分けは /form と同じルール:
+      - 同じ銘柄・同じ目的の反対売買で建玉が残っている親カードがあれば、その子カード
+        （残数を超える分は古いチェーンから順に割り当てる）
+      - 建玉を超えた分は、同じ銘柄・同じ目的・同じ売買で同じ向きの建玉が残っている親カードがあれば合算
+        （親カードより後の日付の子カードがあるチェーンには合算しない。損益の計算が前後で変わるため）
+      - それ以外は新しい親カード
+    行はメモリに溜めず batch_size 件ごとに executemany で書き込み、全体を1トランザクションにする。
+    メモリに持つのは登場した銘柄の親カードだけ。
+    on_batch(stats) はバッチを書き込むたびに呼ぶ（ジョブの進み具合の報告用）。
+    """
+    reader = csv.DictReader(f)
+    columns = resolve_import_columns(reader.fieldnames)
+    stats = {"rows": 0, "parents": 0, "children": 0, "merged": 0, "error_count": 0, "errors": []}
+
+    parents_by_code = {}
+    inserts = []
+    merges = {}
+    touched = set()
+
+    def flush(c):
+        c.executemany("""
+            INSERT INTO trades (id, type, stock, price, quantity, total, date, feeling, memo, parent_id, code, purpose)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, inserts)
+        c.executemany(
+            "UPDATE trades SET quantity=?, total=?, price=?, date=? WHERE id=?",
+            [values + (parent_id,) for parent_id, values in merges.items()]
+        )
+        inserts.clear()
+        merges.clear()
+
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        # id はこちらで振る（子カードが同じバッチ内の新しい親を参照できるように）
+        c.execute("""
+            SELECT MAX(COALESCE((SELECT MAX(id) FROM trades), 0),
+                       COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'trades'), 0))
+        """)
+        next_id = c.fetchone()[0] + 1
+
+        for line_no, row in enumerate(reader, start=2):
+            stats["rows"] += 1
+            try:
+                trade = parse_import_row(row, columns)
+            except ValueError as e:
+                stats["error_count"] += 1
+                if len(stats["errors"]) < IMPORT_MAX_ERRORS:
+                    stats["errors"].append(f"{line_no}行目: {e}")
+                continue
+
+            code = trade["code"]
+            if code not in parents_by_code:
+                parents_by_code[code] = load_code_parents(c, code)
+            parents = parents_by_code[code]
+            sign = 1 if trade["type"] == "buy" else -1
+
+            # 1. 反対売買：同じ銘柄名・同じ目的で建玉が残っている親カードに、古いチェーンから順に割り当てる
+            #    （1つのチェーンの残数を超える分は次のチェーンの子カードに分ける）
+            opposite = "sell" if trade["type"] == "buy" else "buy"
+            remaining = trade["quantity"]
+            for parent in parents:
+                if not remaining:
+                    break
+                if (parent["type"] != opposite or parent["stock"] != trade["stock"]
+                        or str(parent["purpose"]) != str(trade["purpose"])):
+                    continue
+                open_qty = parent["net"] if opposite == "buy" else -parent["net"]
+                if open_qty <= 0:
+                    continue
+                quantity = min(remaining, open_qty)
+                inserts.append((next_id, trade["type"], trade["stock"], trade["price"], quantity,
+                                trade["price"] * quantity, trade["date"], trade["feeling"], trade["memo"],
+                                parent["id"], code, trade["purpose"]))
+                next_id += 1
+                parent["net"] += sign * quantity
+                parent["last_child_date"] = max(parent["last_child_date"] or "", trade["date"])
+                remaining -= quantity
+                touched.add(parent["id"])
+                stats["children"] += 1
+
+            # 建玉をすべて閉じても余った分は、新しい建玉（買いなら現物・売りなら空売り）として扱う
+            if remaining:
+                total = trade["price"] * remaining
+                same_purpose = next(
+                    (p for p in parents if p["type"] == trade["type"] and p["stock"] == trade["stock"]
+                     and str(p["purpose"]) == str(trade["purpose"]) and sign * p["net"] > 0
+                     and (p["last_child_date"] is None or p["last_child_date"] <= p["date"])),
+                    None
+                )
+                if same_purpose is not None:
+                    # 2. 合算（/form の「合算」と同じ更新）。子カードがあるときは日付を動かさない
+                    same_purpose["quantity"] += remaining
+                    same_purpose["total"] += total
+                    new_price = same_purpose["total"] / same_purpose["quantity"] if same_purpose["quantity"] else 0
+                    if same_purpose["last_child_date"] is None:
+                        same_purpose["date"] = trade["date"]
+                    merges[same_purpose["id"]] = (same_purpose["quantity"], same_purpose["total"], new_price,
+                                                  same_purpose["date"])
+                    same_purpose["net"] += sign * remaining
+                    touched.add(same_purpose["id"])
+                    stats["merged"] += 1
                 else:
-                    pos_cost += t["price"] * q
+                    # 3. 新しい親カード
+                    inserts.append((next_id, trade["type"], trade["stock"], trade["price"], remaining,
+                                    total, trade["date"], trade["feeling"], trade["memo"],
+                                    None, code, trade["purpose"]))
+                    parents.append({"id": next_id, "type": trade["type"], "stock": trade["stock"],
+                                    "purpose": trade["purpose"], "quantity": remaining,
+                                    "total": total, "net": sign * remaining,
+                                    "date": trade["date"], "last_child_date": None})
+                    touched.add(next_id)
+                    next_id += 1
+                    stats["parents"] += 1
+
+            if len(inserts) + len(merges) >= batch_size:
+                flush(c)
+                if on_batch:
+                    on_batch(stats)
+
+        flush(c)
+        for parent_id in touched:
+            refresh_position(c, parent_id)
+        if touched:
+            bump_ledger_version(c)
+    return stats
+
+
+def import_summary(stats):
+    return (f"{stats['rows']}行を読み込みました（新規{stats['parents']}件・追加売買{stats['children']}件・"
+            f"合算{stats['merged']}件・エラー{stats['error_count']}件）")
+
+
+@app.route("/import", methods=["POST"])
+def import_csv():
+    file = request.files.get("file")
+    if not file or not file.filename:
+        flash("CSVファイルを選んでください。")
+        return redirect(url_for("settings"))
+    encoding = request.form.get("encoding") or "utf-8-sig"
+    if upload_size(file) >= JOB_INLINE_IMPORT_BYTES:
+        job_id = enqueue_upload(file, "import_trades", encoding)
+        flash(f"大きいファイルなのでバックグラウンドで取り込みます（ジョブ #{job_id}）。")
+        return redirect(url_for("settings"))
+    try:
+        stats = import_trades(io.TextIOWrapper(file.stream, encoding=encoding, newline=""))
+    except (ValueError, UnicodeDecodeError) as e:
+        flash(f"取り込めませんでした: {e}")
+        return redirect(url_for("settings"))
+    flash(import_summary(stats))
+    for error in stats["errors"]:
+        flash(error)
+    return redirect(url_for("settings"))
+
+
+@app.cli.command("import-trades")
+@click.argument("csv_path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--encoding", default="utf-8-sig", help="CSVの文字コード（SBI・楽天などは cp932）")
+@click.option("--batch-size", default=IMPORT_BATCH_SIZE, show_default=True)
+@click.option("--user", help="取り込み先のユーザー（COCOTOSHI_SHARD_DIR を使うとき）")
+def import_trades_command(csv_path, encoding, batch_size, user):
+    """証券会社のCSVを一括で取り込む"""
+    use_user_shard(user)
+    with open(csv_path, encoding=encoding, newline="") as f:
+        stats = import_trades(f, batch_size=batch_size)
+    click.echo(import_summary(stats))
+    for error in stats["errors"]:
+        click.echo(error)
+
+
+# ===============================
+# 時価評価（prices テーブル）
+# ===============================
+PRICE_COLUMNS = {
+    "code": ["code", "コード", "銘柄コード"],
+    "date": ["date", "日付"],
+    "close": ["close", "終値", "price", "株価"],
+}
+
+
+def parse_price_row(row, columns):
+    """
+    株価CSVの1行を (code, date, close) にする。不正な行は ValueError。
+    """
+    def value(key):
+        return (row.get(columns[key]) or "").strip()
+
+    code = parse_import_code(value("code"))
+    date = parse_import_date(value("date"))
+    try:
+        close = float(value("close").replace(",", ""))
+    except ValueError:
+        raise ValueError(f"終値が不正です（{value('close')}）")
+    return code, date, close
+
+
+def import_prices(f, batch_size=IMPORT_BATCH_SIZE, on_batch=None):
+    """
+    日々の終値のCSV（code, date, close）をまとめて prices に入れる。同じ銘柄・同じ日付は上書き。
+    ネットワークには一切つながず、手元のファイルだけで完結する。on_batch は import_trades と同じ。
+    """
+    reader = csv.DictReader(f)
+    columns = resolve_import_columns(reader.fieldnames, PRICE_COLUMNS, ("code", "date", "close"))
+    stats = {"rows": 0, "loaded": 0, "error_count": 0, "errors": []}
+    batch = []
+
+    def flush(c):
+        c.executemany("INSERT OR REPLACE INTO prices (code, date, close) VALUES (?, ?, ?)", batch)
+        stats["loaded"] += len(batch)
+        batch.clear()
+
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        for line_no, row in enumerate(reader, start=2):
+            stats["rows"] += 1
+            try:
+                batch.append(parse_price_row(row, columns))
+            except ValueError as e:
+                stats["error_count"] += 1
+                if len(stats["errors"]) < IMPORT_MAX_ERRORS:
+                    stats["errors"].append(f"{line_no}行目: {e}")
+                continue
+            if len(batch) >= batch_size:
+                flush(c)
+                if on_batch:
+                    on_batch(stats)
+        flush(c)
+        # 時価が変わると /summary・API の結果も変わるので、キャッシュとETagを無効にする
+        bump_ledger_version(c)
+    return stats
+
+
+def import_prices_summary(stats):
+    return f"{stats['rows']}行を読み込みました（株価{stats['loaded']}件・エラー{stats['error_count']}件）"
+
+
+@app.route("/import_prices", methods=["POST"])
+def import_prices_csv():
+    file = request.files.get("file")
+    if not file or not file.filename:
+        flash("CSVファイルを選んでください。")
+        return redirect(url_for("settings"))
+    encoding = request.form.get("encoding") or "utf-8-sig"
+    if upload_size(file) >= JOB_INLINE_IMPORT_BYTES:
+        job_id = enqueue_upload(file, "import_prices", encoding)
+        flash(f"大きいファイルなのでバックグラウンドで取り込みます（ジョブ #{job_id}）。")
+        return redirect(url_for("settings"))
+    try:
+        stats = import_prices(io.TextIOWrapper(file.stream, encoding=encoding, newline=""))
+    except (ValueError, UnicodeDecodeError) as e:
+        flash(f"取り込めませんでした: {e}")
+        return redirect(url_for("settings"))
+    flash(import_prices_summary(stats))
+    for error in stats["errors"]:
+        flash(error)
+    return redirect(url_for("settings"))
+
+
+@app.cli.command("import-prices")
+@click.argument("csv_path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--encoding", default="utf-8-sig", help="CSVの文字コード")
+@click.option("--batch-size", default=IMPORT_BATCH_SIZE, show_default=True)
+@click.option("--user", help="取り込み先のユーザー（COCOTOSHI_SHARD_DIR を使うとき）")
+def import_prices_command(csv_path, encoding, batch_size, user):
+    """日々の終値のCSV（code, date, close）を取り込む"""
+    use_user_shard(user)
+    with open(csv_path, encoding=encoding, newline="") as f:
+        stats = import_prices(f, batch_size=batch_size)
+    click.echo(import_prices_summary(stats))
+    for error in stats["errors"]:
+        click.echo(error)
+
+
+# 建玉が残っている銘柄だけ、(code, date) の主キーで最新の終値を引く（prices 全体は走査しない）
+LATEST_PRICES_SQL = """
+    SELECT o.code, pr.date, pr.close
+    FROM (
+        SELECT DISTINCT t.code
+        FROM positions p
+        CROSS JOIN trades t ON t.id = p.parent_id  -- 建玉の索引から読む（trades の索引を全部なめない）
+        WHERE p.is_completed = 0
+    ) o
+    JOIN prices pr ON pr.code = o.code AND pr.date = (SELECT MAX(date) FROM prices WHERE code = o.code)
+"""
+OPEN_POSITIONS_SQL = """
+    SELECT p.parent_id, t.code, p.pos_qty, p.short_qty, p.avg_price, p.short_avg_price
+    FROM positions p
+    JOIN trades t ON t.id = p.parent_id
+    WHERE p.is_completed = 0
+"""
+
+
+def value_positions(c):
+    """
+    建玉が残っている全チェーンを、銘柄ごとの最新の終値で評価する。
+    最新の終値は建玉のある銘柄ごとに (code, date) の主キーを1回引くだけ（チェーンごとには引かない）。
+    チェーンとの突き合わせと計算は NumPy でまとめて行う。
+      数量は 現物－空売り（空売りは負）、取得単価は現物なら平均単価・空売りなら空売り平均単価
+      含み損益 ＝ (終値－取得単価)×数量、損益率 ＝ 含み損益÷取得額
+      比率 ＝ 評価額（終値×株数）÷ 評価額の合計（空売りも株数で数える）
+    戻り値: {"positions": {親id: 評価のdict}, "market_value", "unrealized", "cost", "price_date"}
+    終値の無い銘柄のチェーンは positions に入らない。
+    """
+    c.execute(LATEST_PRICES_SQL)
+    latest = c.fetchall()
+    empty = {"positions": {}, "market_value": 0, "unrealized": 0, "cost": 0, "price_date": None}
+    if not latest:
+        return empty
+    price_index = {code: i for i, (code, _, _) in enumerate(latest)}
+    closes = np.array([close for _, _, close in latest], dtype=np.float64)
+
+    c.execute(OPEN_POSITIONS_SQL)
+    rows = c.fetchall()
+    which = np.array([price_index.get(row[1], -1) for row in rows], dtype=np.int64)
+    priced = which >= 0
+    if not priced.any():
+        return empty
+    rows = [row for row, ok in zip(rows, priced.tolist()) if ok]
+    which = which[priced]
+
+    # NULL（古い positions 行）は0として扱う
+    values = np.nan_to_num(np.array([row[2:6] for row in rows], dtype=np.float64))
+    pos_qty, short_qty, avg_price, short_avg_price = values.T
+    close = closes[which]
+    qty = pos_qty - short_qty
+    basis = np.where(qty > 0, avg_price, short_avg_price)
+    unrealized = (close - basis) * qty
+    cost = basis * np.abs(qty)
+    return_pct = np.divide(unrealized, cost, out=np.zeros_like(cost), where=cost > 0) * 100
+    market_value = close * np.abs(qty)
+    total_value = market_value.sum()
+    weight = market_value / total_value * 100 if total_value else np.zeros_like(market_value)
+
+    positions = {
+        row[0]: {
+            "price": price,
+            "price_date": latest[i][1],
+            "market_value": mv,
+            "unrealized": pl,
+            "return_pct": pct,
+            "weight": w,
+        }
+        for row, i, price, mv, pl, pct, w in zip(
+            rows, which.tolist(), close.tolist(), market_value.tolist(), unrealized.tolist(),
+            return_pct.tolist(), weight.tolist()
+        )
+    }
+    return {
+        "positions": positions,
+        "market_value": float(total_value),
+        "unrealized": float(unrealized.sum()),
+        "cost": float(cost.sum()),
+        "price_date": max(latest[i][1] for i in set(which.tolist())),
+    }
+
+
+def cached_valuation():
+    def load():
+        with get_db() as conn:
+            return value_positions(conn.cursor())
+    return cached_result(("valuation",), load)
+
+
+@dataclass(slots=True)
+class Trade:
+    """
+    カード1枚（trades テーブルの1行）。
+    profits 以下は replay_chain が書き込む再生結果（profits は反対売買で確定した損益）。
+    __slots__ なので1枚あたり dict の数分の1のメモリで済み、テンプレートからは従来どおり t.price で読める。
+    """
+    id: int
+    type: str
+    stock: str
+    price: float
+    quantity: int
+    total: float
+    date: str
+    feeling: int
+    memo: str
+    parent_id: int
+    code: str
+    remaining_quantity: int = 0
+    purpose: str = ""
+    profits: list = ()
+    pos_qty: int = 0
+    short_qty: int = 0
+    avg_price: float = 0.0
+    short_avg_price: float = 0.0
+
+
+@dataclass(slots=True)
+class Position:
+    """
+    チェーン（親＋子カード）を再生した最終状態。positions テーブルの1行にあたる。
+    """
+    pos_qty: int = 0               # 現物残数
+    pos_cost: float = 0.0          # 現物コスト合計
+    avg_price: float = 0.0         # 現物平均単価
+    short_qty: int = 0             # 空売り残数
+    short_cost: float = 0.0        # 空売りコスト合計
+    short_avg_price: float = 0.0   # 空売り平均単価
+    total_profit: float = 0
+    last_date: str = None          # positions から読んだときだけ入る
+
+    @property
+    def is_completed(self):
+        return self.pos_qty == 0 and self.short_qty == 0
+
+    @property
+    def remaining(self):
+        # 現物なら+残、空売りなら-残
+        return self.pos_qty if self.pos_qty > 0 else -self.short_qty
+
+    def average_price(self, parent_type):
+        return self.avg_price if parent_type == "buy" else self.short_avg_price
+
+
+@dataclass(slots=True)
+class TradeChain:
+    """
+    build_trade_tree の1要素（親カード＋子カードと再生結果）。
+    """
+    parent: Trade
+    children: list
+    remaining: int
+    average_price: float
+    total_profit: float
+    is_completed: bool
+
+
+def row_to_trade(row):
+    """
+    trades テーブルの1行（タプル）をカード用の Trade に変換する。
+    """
+    return Trade(
+        row[0],
+        row[1],
+        row[2],
+        float(row[3]) if row[3] is not None else 0.0,
+        int(row[4]) if row[4] is not None else 0,
+        float(row[5]) if row[5] is not None else 0.0,
+        row[6],
+        row[7],
+        row[8],
+        row[9],
+        row[10],
+        row[11] if len(row) > 11 else 0,
+        row[12] if len(row) > 12 else "",
+    )
+
+
+def trade_order(t):
+    # チェーン内の並び（date, id順）
+    return (t.date, t.id)
+
+
+def replay_chain(trade_chain, state=None):
+    """
+    親＋子カード（date, id順）を1回だけ走査して、移動平均単価・残数・損益を計算する。
+    各カードに profits / pos_qty / short_qty / avg_price / short_avg_price を書き込み、
+    チェーン最終状態を Position で返す。
+    state を渡すとその状態から続きを計算する（positions の差分更新用）。
+    """
+    state = state or Position()
+    # 現物・空売り両対応
+    pos_qty = state.pos_qty                  # 現物残数
+    pos_cost = state.pos_cost                # 現物コスト合計
+    avg_price = state.avg_price              # 現物平均単価
+
+    short_qty = state.short_qty              # 空売り残数
+    short_cost = state.short_cost            # 空売りコスト合計
+    short_avg_price = state.short_avg_price  # 空売り平均単価
+
+    total_profit = state.total_profit
+
+    for t in trade_chain:
+        # 損益が出たカードにだけリストを作る（大半のカードは共有の空タプルのまま）
+        t.profits = ()
+        q = t.quantity
+
+        if t.type == "buy":
+            if short_qty > 0:
+                cover_qty = min(q, short_qty)
+                if cover_qty > 0:
+                    profit = (short_avg_price - t.price) * cover_qty
+                    t.profits = [profit]
+                    total_profit += profit
+                    short_cost -= short_avg_price * cover_qty
+                    short_qty -= cover_qty
+                    q -= cover_qty
+                if q > 0:
+                    pos_cost += t.price * q
                     pos_qty += q
                     avg_price = pos_cost / pos_qty if pos_qty else 0
-
-            elif t["type"] == "sell":
-                if pos_qty > 0:
-                    sell_qty = min(q, pos_qty)
-                    if sell_qty > 0:
-                        profit = (t["price"] - avg_price) * sell_qty
-                        t["profits"].append(profit)
-                        pos_cost -= avg_price * sell_qty
-                        pos_qty -= sell_qty
-                        q -= sell_qty
-                        avg_price = pos_cost / pos_qty if pos_qty else 0
-                    if q > 0:
-                        short_cost += t["price"] * q
-                        short_qty += q
-                        short_avg_price = short_cost / short_qty if short_qty else 0
-                else:
-                    short_cost += t["price"] * q
+            else:
+                pos_cost += t.price * q
+                pos_qty += q
+                avg_price = pos_cost / pos_qty if pos_qty else 0
+
+        elif t.type == "sell":
+            if pos_qty > 0:
+                sell_qty = min(q, pos_qty)
+                if sell_qty > 0:
+                    profit = (t.price - avg_price) * sell_qty
+                    t.profits = [profit]
+                    total_profit += profit
+                    pos_cost -= avg_price * sell_qty
+                    pos_qty -= sell_qty
+                    q -= sell_qty
+                    avg_price = pos_cost / pos_qty if pos_qty else 0
+                if q > 0:
+                    short_cost += t.price * q
                     short_qty += q
                     short_avg_price = short_cost / short_qty if short_qty else 0
-    # 状態記録などはそのまま
+            else:
+                short_cost += t.price * q
+                short_qty += q
+                short_avg_price = short_cost / short_qty if short_qty else 0
 
 
-            else:
-                t["profit"] = None
+        # 状態記録（デバッグやUI用）
+        t.pos_qty = pos_qty
+        t.short_qty = short_qty
+        t.avg_price = avg_price
+        t.short_avg_price = short_avg_price
+
+    return Position(pos_qty, pos_cost, avg_price, short_qty, short_cost, short_avg_price, total_profit)
+
+
+def group_trade_chains(trade_list):
+    """
+    親カードごとに (親, 親＋子カードをdate, id順に並べたリスト) を返す。
+    子カードはparent_idごとに1パスで振り分ける（O(n)）。
+    """
+    parents = []
+    children_by_parent = {}
+    for t in trade_list:
+        if t.parent_id is None:
+            parents.append(t)
+        else:
+            children_by_parent.setdefault(t.parent_id, []).append(t)
+
+    for parent in parents:
+        children = children_by_parent.get(parent.id, [])
+        yield parent, sorted([parent] + children, key=trade_order)
 
-            # 状態記録（デバッグやUI用）
-            t["pos_qty"] = pos_qty
-            t["short_qty"] = short_qty
-            t["avg_price"] = avg_price
-            t["short_avg_price"] = short_avg_price
+
+def build_trade_tree(trades):
+    with profiled("tree"):
+        return _build_trade_tree(trades)
+
+
+def _build_trade_tree(trades):
+    # トレードを Trade に変換（列名付き）
+    trade_list = [row_to_trade(row) for row in trades]
+
+    tree = []
+
+    for parent, trade_chain in group_trade_chains(trade_list):
+        state = replay_chain(trade_chain)
 
         # 子カード（親以外）のみ抽出
-        children = [t for t in trade_chain if t["id"] != parent["id"]]
-
-        total_profit = sum(sum(t["profits"]) for t in trade_chain if "profits" in t and t["profits"])
-
-        is_completed = (pos_qty == 0 and short_qty == 0)
-
-
-        tree.append({
-            "parent": {
-                "id": parent["id"],
-                "type": parent["type"],
-                "stock": parent["stock"],
-                "price": parent["price"],
-                "quantity": parent["quantity"],
-                "total": parent["total"],
-                "date": parent["date"],
-                "feeling": parent["feeling"],
-                "memo": parent["memo"],
-                "parent_id": parent["parent_id"],
-                "code": parent["code"],
-                "purpose": parent.get("purpose", "")
-            },
-            "children": children,
-            "remaining": pos_qty if pos_qty > 0 else -short_qty,  # 現物なら+残、空売りなら-残
-            "profits": profits,
-            "average_price": avg_price if parent["type"] == "buy" else short_avg_price,
-            "total_profit": total_profit,
-            "is_completed": is_completed   # ←これを追加！！
-        })
+        children = [t for t in trade_chain if t is not parent]
+
+        tree.append(TradeChain(
+            parent=parent,
+            children=children,
+            remaining=state.remaining,  # 現物なら+残、空売りなら-残
+            average_price=state.average_price(parent.type),
+            total_profit=state.total_profit,
+            is_completed=state.is_completed,
+        ))
 
     return tree
 
 
 
 
-def calc_moving_average_profit(trades):
-    pos_qty = 0
-    pos_cost = 0.0
-    avg_price = 0.0
+# ===============================
+# positions（チェーンごとのスナップショット）
+# ===============================
+def save_position(c, parent_id, state, last_date):
+    c.execute("""
+        INSERT OR REPLACE INTO positions
+            (parent_id, pos_qty, pos_cost, avg_price, short_qty, short_cost, short_avg_price,
+             realized_profit, is_completed, last_date)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (
+        parent_id,
+        state.pos_qty, state.pos_cost, state.avg_price,
+        state.short_qty, state.short_cost, state.short_avg_price,
+        state.total_profit,
+        1 if state.is_completed else 0,
+        last_date,
+    ))
+
+
+POSITION_SQL = """
+    SELECT pos_qty, pos_cost, avg_price, short_qty, short_cost, short_avg_price,
+           realized_profit, is_completed, last_date
+    FROM positions WHERE parent_id=?
+"""
 
-    for t in trades:
-        if t["type"] == "buy":
-            pos_cost += t["price"] * t["quantity"]
-            pos_qty += t["quantity"]
-            avg_price = pos_cost / pos_qty if pos_qty else 0
-            t["profit"] = None
-        elif t["type"] == "sell":
-            profit = (t["price"] - avg_price) * t["quantity"]
-            t["profit"] = profit
-            pos_cost -= avg_price * t["quantity"]
-            pos_qty -= t["quantity"]
-            avg_price = pos_cost / pos_qty if pos_qty else 0
+
+def load_position(c, parent_id):
+    c.execute(POSITION_SQL, (parent_id,))
+    row = c.fetchone()
+    if row is None:
+        return None
+    # is_completed（row[7]）は数量から決まるので読まない
+    return Position(*row[:7], last_date=row[8])
+
+
+def refresh_position(c, parent_id):
+    """
+    1つのチェーンだけを再計算して positions を更新する。
+    書き込みと同じトランザクション内（同じカーソル）で呼ぶこと。
+    親カードが無くなっていれば positions の行も消す。
+    """
+    if parent_id is None:
+        return
+    c.execute("SELECT * FROM trades WHERE id=? AND parent_id IS NULL", (parent_id,))
+    parent = c.fetchone()
+    if parent is None:
+        c.execute("DELETE FROM positions WHERE parent_id=?", (parent_id,))
+        save_closed_trades(c, parent_id, [])
+        return
+    c.execute("SELECT * FROM trades WHERE parent_id=?", (parent_id,))
+    parent = row_to_trade(parent)
+    trade_chain = sorted([parent] + [row_to_trade(row) for row in c.fetchall()], key=trade_order)
+    state = replay_chain(trade_chain)
+    save_position(c, parent_id, state, trade_chain[-1].date)
+    save_closed_trades(c, parent_id, closed_trade_rows(parent, trade_chain))
+
+
+def apply_trade_to_position(c, parent_id, trade_id):
+    """
+    子カード追加時の差分更新。
+    追加カードがチェーンの末尾（日付が最新）なら保存済みの状態から1枚分だけ進める。
+    過去日付の追加などで順序が変わる場合はチェーンを再計算する。
+    """
+    state = load_position(c, parent_id)
+    c.execute("SELECT * FROM trades WHERE id=?", (trade_id,))
+    trade = row_to_trade(c.fetchone())
+    if state is None or state.last_date is None or trade.date is None or trade.date < state.last_date:
+        refresh_position(c, parent_id)
+        return
+    state = replay_chain([trade], state)
+    save_position(c, parent_id, state, trade.date)
+    if trade.profits:
+        c.execute("SELECT * FROM trades WHERE id=?", (parent_id,))
+        rows = closed_trade_rows(row_to_trade(c.fetchone()), [trade])
+        if rows:
+            insert_closed_trades(c, rows)
+            refresh_daily_rollup(c, {trade.date})
+
+
+def rebuild_positions(c):
+    """
+    全チェーンを再生して positions を作り直す。
+    """
+    c.execute("SELECT * FROM trades")
+    trade_list = [row_to_trade(row) for row in c.fetchall()]
+    c.execute("DELETE FROM positions")
+    for parent, trade_chain in group_trade_chains(trade_list):
+        state = replay_chain(trade_chain)
+        save_position(c, parent.id, state, trade_chain[-1].date)
+
+
+# ===============================
+# 確定損益のロールアップ（closed_trades / daily_rollup）
+# ===============================
+def purpose_index(value):
+    try:
+        return int(value)
+    except Exception:
+        return 0
+
+
+def holding_days(entry_date, exit_date):
+    try:
+        return (datetime.strptime(exit_date, "%Y-%m-%d") - datetime.strptime(entry_date, "%Y-%m-%d")).days
+    except (TypeError, ValueError):
+        return None
+
+
+def closed_trade_rows(parent, trade_chain):
+    """
+    再生済み（replay_chain 後）のカードから、反対売買で損益が確定した子カードを
+    closed_trades の行にする（損益1件ごとに1行）。
+    """
+    opposite = {"buy": "sell", "sell": "buy"}.get(parent.type)
+    purpose = purpose_index(parent.purpose)
+    rows = []
+    for t in trade_chain:
+        if t is parent or t.type != opposite or not t.profits:
+            continue
+        for profit in t.profits:
+            rows.append((
+                t.id, parent.id, t.date, parent.date, parent.feeling, t.feeling,
+                purpose, profit, holding_days(parent.date, t.date),
+            ))
+    return rows
+
+
+def insert_closed_trades(c, rows):
+    c.executemany("""
+        INSERT OR REPLACE INTO closed_trades
+            (child_id, parent_id, exit_date, entry_date, entry_feeling, exit_feeling, purpose, profit, holding_days)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+
+
+def save_closed_trades(c, parent_id, rows):
+    """
+    1チェーン分の closed_trades を入れ替え、前後で関係する決済日の daily_rollup を作り直す。
+    """
+    c.execute("SELECT DISTINCT exit_date FROM closed_trades WHERE parent_id=?", (parent_id,))
+    exit_dates = {row[0] for row in c.fetchall()}
+    c.execute("DELETE FROM closed_trades WHERE parent_id=?", (parent_id,))
+    insert_closed_trades(c, rows)
+    exit_dates.update(row[2] for row in rows)
+    refresh_daily_rollup(c, exit_dates)
+
+
+DAILY_ROLLUP_SELECT = """
+    SELECT COALESCE(exit_date, ''), COALESCE(entry_feeling, -1), COALESCE(exit_feeling, -1), purpose,
+           SUM(profit), COUNT(*), SUM(profit > 0),
+           COALESCE(SUM(holding_days), 0), COUNT(holding_days)
+    FROM closed_trades
+"""
+DAILY_ROLLUP_GROUP = " GROUP BY 1, 2, 3, 4"
+
+
+def refresh_daily_rollup(c, exit_dates):
+    """
+    指定した決済日の daily_rollup だけを closed_trades から集計し直す。
+    差分の足し引きではなく毎回合計し直すので、浮動小数の誤差がたまらない。
+    """
+    for exit_date in exit_dates:
+        if exit_date:
+            where, params = " WHERE exit_date = ?", (exit_date,)
         else:
-            t["profit"] = None
-    return trades
+            where, params = " WHERE exit_date IS NULL OR exit_date = ''", ()
+        c.execute("DELETE FROM daily_rollup WHERE exit_date = ?", (exit_date or "",))
+        c.execute("INSERT INTO daily_rollup " + DAILY_ROLLUP_SELECT + where + DAILY_ROLLUP_GROUP, params)
 
 
+def rebuild_rollup(c):
+    """
+    全チェーンを再生して closed_trades と daily_rollup を作り直す。
+    """
+    c.execute("SELECT * FROM trades")
+    trade_list = [row_to_trade(row) for row in c.fetchall()]
+    c.execute("DELETE FROM closed_trades")
+    c.execute("DELETE FROM daily_rollup")
+    for parent, trade_chain in group_trade_chains(trade_list):
+        replay_chain(trade_chain)
+        insert_closed_trades(c, closed_trade_rows(parent, trade_chain))
+    c.execute("INSERT INTO daily_rollup " + DAILY_ROLLUP_SELECT + DAILY_ROLLUP_GROUP)
 
-def calc_heatmap(trades):
-    import numpy as np
-    N = 5  # 感情種類数
-    profit_mat = np.zeros((N, N))
-    count_mat = np.zeros((N, N))
-    for entry, exit_, profit in trades:
-        if entry is not None and exit_ is not None:
-            i = int(entry)
-            j = int(exit_)
-            profit_mat[i][j] += profit
-            count_mat[i][j] += 1
-    avg_profit = np.where(count_mat > 0, profit_mat / count_mat, 0)
-    return avg_profit.astype(int).tolist(), count_mat.astype(int).tolist()
+
+def check_rollup():
+    """
+    closed_trades / daily_rollup と全件再生の結果を突き合わせる。食い違いの説明文のリストを返す。
+    """
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("SELECT * FROM trades")
+        expected = {}
+        for parent, trade_chain in group_trade_chains([row_to_trade(row) for row in c.fetchall()]):
+            replay_chain(trade_chain)
+            for row in closed_trade_rows(parent, trade_chain):
+                expected[row[0]] = row
+        c.execute("""
+            SELECT child_id, parent_id, exit_date, entry_date, entry_feeling, exit_feeling, purpose, profit, holding_days
+            FROM closed_trades
+        """)
+        stored = {row[0]: row for row in c.fetchall()}
+
+        problems = []
+        for child_id in sorted(expected.keys() | stored.keys()):
+            want, got = expected.get(child_id), stored.get(child_id)
+            if want is None or got is None or want[:7] + want[8:] != got[:7] + got[8:] or abs(want[7] - got[7]) > 1e-6:
+                problems.append(f"決済 id={child_id}: closed_trades が不一致（再生={want}, 保存={got}）")
+
+        c.execute(DAILY_ROLLUP_SELECT + DAILY_ROLLUP_GROUP)
+        want_daily = {row[:4]: row[4:] for row in c.fetchall()}
+        c.execute("SELECT * FROM daily_rollup")
+        got_daily = {row[:4]: row[4:] for row in c.fetchall()}
+        for key in sorted(want_daily.keys() | got_daily.keys()):
+            want, got = want_daily.get(key), got_daily.get(key)
+            if want is None or got is None or want[1:] != got[1:] or abs(want[0] - got[0]) > 1e-6:
+                problems.append(f"daily_rollup {key}: 不一致（集計={want}, 保存={got}）")
+    return problems
+
+
+def check_positions():
+    """
+    positions と全件再生（build_trade_tree）の結果を突き合わせる。
+    食い違いの説明文のリストを返す（空なら整合）。
+    """
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("SELECT * FROM trades")
+        trade_tree = build_trade_tree(c.fetchall())
+        c.execute("SELECT parent_id FROM positions")
+        stored_ids = {row[0] for row in c.fetchall()}
+
+        problems = []
+        for item in trade_tree:
+            parent_id = item.parent.id
+            stored = load_position(c, parent_id)
+            if stored is None:
+                problems.append(f"id={parent_id}: positions に行がありません")
+                continue
+            stored_ids.discard(parent_id)
+            expected = {
+                "remaining": (item.remaining, stored.remaining),
+                "average_price": (item.average_price, stored.average_price(item.parent.type)),
+                "total_profit": (item.total_profit, stored.total_profit),
+                "is_completed": (item.is_completed, stored.is_completed),
+            }
+            for key, (want, got) in expected.items():
+                if abs(float(want) - float(got)) > 1e-6:
+                    problems.append(f"id={parent_id}: {key} が不一致（再生={want}, positions={got}）")
+        for parent_id in sorted(stored_ids):
+            problems.append(f"id={parent_id}: 親カードが無いのに positions に行があります")
+    return problems
+
+
+@app.cli.command("check-positions")
+@click.option("--fix", is_flag=True, help="不一致があれば positions を作り直す")
+def check_positions_command(fix):
+    """positions・ロールアップと全件再生の整合性チェック"""
+    problems = check_positions() + check_rollup()
+    for problem in problems:
+        click.echo(problem)
+    if not problems:
+        click.echo("positions・ロールアップは全件再生と一致しています。")
+    elif fix:
+        with get_db() as conn:
+            c = conn.cursor()
+            rebuild_positions(c)
+            rebuild_rollup(c)
+            # 作り直した結果を、各ワーカーのキャッシュと ETag にも反映させる
+            bump_ledger_version(c)
+            conn.commit()
+        click.echo("positions・ロールアップを作り直しました。")
+
+
+# ===============================
+# バックグラウンドジョブ（SQLite の jobs 表＋ run-worker プロセス）
+# ===============================
+# 全件の作り直し・大きなCSVの取り込み・VACUUM などはリクエストの中で動かさず、jobs 表に積んで
+# 別プロセスの `flask --app cocotoshi run-worker` に任せる（外部のブローカーは使わない）。
+# キューは台帳とは別のファイルにして、進み具合の書き込みで台帳の書き込みロックを取らないようにする。
+# 各ジョブは対象のDBファイル（シャードならそのユーザーの台帳）を持ち、ワーカーはそこを current_database() にして動かす
+JOBS_DB = os.environ.get("COCOTOSHI_JOBS_DB") or (os.path.join(SHARD_DIR, "jobs.db") if SHARD_DIR else "cocotoshi_jobs.db")
+JOB_UPLOAD_DIR = os.path.splitext(JOBS_DB)[0] + "_uploads"  # ワーカーに渡すまでアップロードを置いておく
+JOB_INLINE_IMPORT_BYTES = 256 * 1024  # これより小さいCSVは今までどおりリクエストの中で取り込む
+JOB_POLL_SECONDS = 1.0
+JOB_PROGRESS_INTERVAL = 0.5  # 進み具合を jobs 表に書く最短の間隔（秒）
+JOB_HEARTBEAT_SECONDS = 30  # 実行中のジョブの生存確認（heartbeat）を書く間隔。進み具合の報告とは別のスレッドで書く
+JOB_STALE_SECONDS = 600  # この間 生存確認がない running は、落ちたワーカーのものとみなして積み直す
+JOB_MAX_ATTEMPTS = 3
+JOB_LIST_LIMIT = 20
+JOB_COLUMNS = ("id", "kind", "status", "progress", "message", "result", "error",
+               "created_at", "started_at", "finished_at", "attempts")
+
+_jobs_ready = set()
+
+
+@contextmanager
+def jobs_db():
+    """
+    キューへの接続（自動コミット）。Webからは積む・読むときだけ開くので、その都度開いて閉じる。
+    """
+    conn = sqlite3.connect(JOBS_DB, timeout=5, isolation_level=None)
+    try:
+        if JOBS_DB not in _jobs_ready:
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    database TEXT NOT NULL,
+                    params TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'queued',  -- queued / running / done / failed
+                    progress REAL NOT NULL DEFAULT 0,
+                    message TEXT,
+                    result TEXT,
+                    error TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    worker TEXT,
+                    heartbeat REAL,
+                    created_at TEXT NOT NULL,
+                    started_at TEXT,
+                    finished_at TEXT
+                )
+            ''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_database ON jobs (database, id)")
+            _jobs_ready.add(JOBS_DB)
+        yield conn
+    finally:
+        conn.close()
 
 
+def job_database(database=None):
+    # 相対パスの DATABASE でも、Webとワーカーで同じファイルを指すように絶対パスにしておく
+    return os.path.abspath(database or current_database())
 
 
+def now_text():
+    return datetime.now().isoformat(timespec="seconds")
 
 
-if __name__ == '__main__':
+def enqueue_job(kind, params=None, database=None, dedupe=True):
+    """
+    ジョブを積んで id を返す。dedupe なら、同じDB・同じ内容でまだ始まっていないジョブがあればそれを返す
+    （「作り直し」ボタンの連打で同じ処理が何回も走らないように）。
+    """
+    if kind not in JOB_HANDLERS:
+        raise ValueError(f"不明なジョブです（{kind}）")
+    database = job_database(database)
+    params = json.dumps(params or {}, ensure_ascii=False, sort_keys=True)
+    with jobs_db() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE status = 'queued' AND kind = ? AND database = ? AND params = ?",
+                (kind, database, params),
+            ).fetchone() if dedupe else None
+            if row:
+                job_id = row[0]
+            else:
+                job_id = conn.execute(
+                    "INSERT INTO jobs (kind, database, params, created_at) VALUES (?, ?, ?, ?)",
+                    (kind, database, params, now_text()),
+                ).lastrowid
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return job_id
+
+
+def job_record(row):
+    job = dict(zip(JOB_COLUMNS, row))
+    job["result"] = json.loads(job["result"]) if job["result"] else None
+    job["label"] = JOB_LABELS.get(job["kind"], job["kind"])
+    return job
+
+
+def get_job(job_id, database=None):
+    # 他のユーザー（別のシャード）のジョブは見せない
+    with jobs_db() as conn:
+        row = conn.execute(
+            f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE id = ? AND database = ?",
+            (job_id, job_database(database)),
+        ).fetchone()
+    return job_record(row) if row else None
+
+
+def list_jobs(database=None, limit=JOB_LIST_LIMIT):
+    if not os.path.exists(JOBS_DB):
+        return []  # まだ一度も積んでいない（設定ページを開いただけでファイルを作らない）
+    with jobs_db() as conn:
+        rows = conn.execute(
+            f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE database = ? ORDER BY id DESC LIMIT ?",
+            (job_database(database), limit),
+        ).fetchall()
+    return [job_record(row) for row in rows]
+
+
+def claim_job(conn, worker):
+    """
+    いちばん古い queued を1件 running にして (id, kind, database, params) を返す。無ければ None。
+    BEGIN IMMEDIATE の中で選んで書き換えるので、ワーカーが複数いても同じジョブを2回取らない。
+    ついでに、止まったワーカーが持ったままの running を積み直す（JOB_MAX_ATTEMPTS 回で諦める）。
+    """
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("""
+            UPDATE jobs SET
+                status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END,
+                error = CASE WHEN attempts >= ? THEN 'ワーカーが途中で止まりました' ELSE error END,
+                finished_at = CASE WHEN attempts >= ? THEN ? ELSE finished_at END
+            WHERE status = 'running' AND heartbeat < ?
+        """, (JOB_MAX_ATTEMPTS, JOB_MAX_ATTEMPTS, JOB_MAX_ATTEMPTS, now_text(), now - JOB_STALE_SECONDS))
+        job = conn.execute(
+            "SELECT id, kind, database, params FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1"
+        ).fetchone()
+        if job:
+            conn.execute("""
+                UPDATE jobs SET status = 'running', progress = 0, message = NULL, attempts = attempts + 1,
+                                worker = ?, heartbeat = ?, started_at = ?
+                WHERE id = ?
+            """, (worker, now, now_text(), job[0]))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return job
+
+
+class JobProgress:
+    """
+    ジョブの処理から report(割合0〜1, 文言) で進み具合を知らせる。
+    細かく呼ばれても jobs 表には JOB_PROGRESS_INTERVAL ごとにしか書かない。
+    生存確認は JobHeartbeat が書くので、report を呼ばない処理でも積み直されない。
+    """
+
+    def __init__(self, conn, job_id):
+        self.conn = conn
+        self.job_id = job_id
+        self.written = 0.0
+
+    def __call__(self, progress, message=None):
+        now = time.time()
+        if now - self.written < JOB_PROGRESS_INTERVAL:
+            return
+        self.written = now
+        self.conn.execute(
+            "UPDATE jobs SET progress = ?, message = COALESCE(?, message) WHERE id = ?",
+            (min(max(float(progress), 0.0), 1.0), message, self.job_id),
+        )
+
+
+class JobHeartbeat(threading.Thread):
+    """
+    ジョブの実行中、JOB_HEARTBEAT_SECONDS ごとに heartbeat を書くスレッド。
+    処理が report を呼ばずに長く掛かっても、ワーカーのプロセスが生きている間は積み直されない。
+    接続はスレッドをまたいで使えないので自分で開く。
+    """
+
+    def __init__(self, job_id):
+        super().__init__(name=f"job-{job_id}-heartbeat", daemon=True)
+        self.job_id = job_id
+        self.stopped = threading.Event()
+
+    def run(self):
+        conn = sqlite3.connect(JOBS_DB, timeout=5, isolation_level=None)
+        try:
+            while not self.stopped.wait(JOB_HEARTBEAT_SECONDS):
+                try:
+                    conn.execute("UPDATE jobs SET heartbeat = ? WHERE id = ? AND status = 'running'",
+                                 (time.time(), self.job_id))
+                except sqlite3.OperationalError:
+                    # キューが書き込み中で待ちきれなかったら次の回に書く
+                    app.logger.warning("ジョブ #%s の生存確認を書けませんでした", self.job_id)
+        finally:
+            conn.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def run_job(conn, job):
+    """
+    1件を実行して done / failed を書く。処理はそのジョブのDBを current_database() にしたアプリの中で動かす。
+    """
+    job_id, kind, database, params = job
+    report = JobProgress(conn, job_id)
+    heartbeat = JobHeartbeat(job_id)
+    heartbeat.start()
+    try:
+        with app.app_context():
+            g.database = database
+            result = JOB_HANDLERS[kind](json.loads(params), report)
+    except Exception as e:
+        app.logger.exception("ジョブ #%s（%s）が失敗しました", job_id, kind)
+        conn.execute(
+            "UPDATE jobs SET status = 'failed', error = ?, finished_at = ? WHERE id = ?",
+            (f"{type(e).__name__}: {e}", now_text(), job_id),
+        )
+        return False
+    finally:
+        heartbeat.stop()
+    message = result.pop("message", None)
+    conn.execute(
+        "UPDATE jobs SET status = 'done', progress = 1, message = ?, result = ?, finished_at = ? WHERE id = ?",
+        (message, json.dumps(result, ensure_ascii=False), now_text(), job_id),
+    )
+    return True
+
+
+def run_worker(once=False, poll=JOB_POLL_SECONDS):
+    """
+    キューを読み続けて1件ずつ実行する。once なら空になった時点で終わる。戻り値: 実行した件数
+    """
+    worker = f"pid {os.getpid()}"
+    done = 0
+    with jobs_db() as conn:
+        while True:
+            job = claim_job(conn, worker)
+            if job is None:
+                if once:
+                    return done
+                time.sleep(poll)
+                continue
+            run_job(conn, job)
+            done += 1
+
+
+@app.cli.command("run-worker")
+@click.option("--once", is_flag=True, help="積まれているジョブを片付けたら終わる（cron などから）")
+@click.option("--poll", default=JOB_POLL_SECONDS, show_default=True, help="キューが空のときに見に行く間隔（秒）")
+def run_worker_command(once, poll):
+    """バックグラウンドジョブ（再計算・取り込み・VACUUM）を実行するワーカー"""
+    click.echo(f"ジョブのキュー: {os.path.abspath(JOBS_DB)}")
+    done = run_worker(once=once, poll=poll)
+    click.echo(f"{done} 件のジョブを実行しました。")
+
+
+def job_recompute(params, report):
+    # 全件の再生から positions・ロールアップ・検索索引を作り直す（check-positions --fix と同じ内容）
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        report(0.0, "positions を作り直しています")
+        rebuild_positions(c)
+        report(0.4, "ロールアップを作り直しています")
+        rebuild_rollup(c)
+        if has_trades_fts(c):
+            report(0.8, "検索の索引を作り直しています")
+            c.execute("INSERT INTO trades_fts (trades_fts) VALUES ('rebuild')")
+        bump_ledger_version(c)
+    return {"message": "positions・ロールアップ・検索の索引を作り直しました"}
+
+
+def job_rebuild_rollup(params, report):
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        report(0.0, "ロールアップを作り直しています")
+        rebuild_rollup(c)
+        bump_ledger_version(c)
+    return {"message": "ロールアップを作り直しました"}
+
+
+def job_maintenance(params, report):
+    # ANALYZE で索引の統計を更新し、VACUUM で削除済みのページを詰めて、WAL を縮める
+    database = current_database()
+    before = os.path.getsize(database)
+    conn = get_db()
+    report(0.0, "統計情報を更新しています（ANALYZE）")
+    conn.execute("ANALYZE")
+    if has_trades_fts(conn.cursor()):
+        report(0.2, "検索の索引を整理しています")
+        with conn:
+            conn.execute("INSERT INTO trades_fts (trades_fts) VALUES ('optimize')")
+    report(0.4, "ファイルを詰めています（VACUUM）")
+    conn.execute("VACUUM")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    after = os.path.getsize(database)
+    return {"message": f"ANALYZE・VACUUM が終わりました（{before / 1024:,.0f} KB → {after / 1024:,.0f} KB）",
+            "bytes_before": before, "bytes_after": after}
+
+
+def job_import(importer, summary):
+    # アップロードを置いたファイルから取り込み、終わったら（失敗しても）消す
+    def run(params, report):
+        path = params["path"]
+        size = os.path.getsize(path) or 1
+        try:
+            with open(path, encoding=params.get("encoding") or "utf-8-sig", newline="") as f:
+                stats = importer(f, on_batch=lambda stats: report(f.buffer.tell() / size, summary(stats)))
+        finally:
+            os.remove(path)
+        return {"message": summary(stats), "stats": stats}
+    return run
+
+
+JOB_HANDLERS = {
+    "recompute": job_recompute,
+    "rebuild_rollup": job_rebuild_rollup,
+    "maintenance": job_maintenance,
+    "import_trades": job_import(import_trades, import_summary),
+    "import_prices": job_import(import_prices, import_prices_summary),
+}
+JOB_LABELS = {
+    "recompute": "全件の再計算",
+    "rebuild_rollup": "ロールアップの作り直し",
+    "maintenance": "ANALYZE・VACUUM",
+    "import_trades": "取引CSVの取り込み",
+    "import_prices": "株価CSVの取り込み",
+}
+MAINTENANCE_JOBS = ("recompute", "rebuild_rollup", "maintenance")  # 画面・APIから積めるもの
+
+
+def upload_size(file):
+    stream = file.stream
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    return size
+
+
+def enqueue_upload(file, kind, encoding):
+    os.makedirs(JOB_UPLOAD_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=".csv", dir=JOB_UPLOAD_DIR)
+    with os.fdopen(fd, "wb") as out:
+        file.save(out)
+    return enqueue_job(kind, {"path": os.path.abspath(path), "encoding": encoding}, dedupe=False)
+
+
+@app.route("/jobs", methods=["POST"])
+def enqueue_maintenance():
+    kind = request.form.get("kind")
+    if kind not in MAINTENANCE_JOBS:
+        flash("不明なジョブです。")
+    else:
+        job_id = enqueue_job(kind)
+        flash(f"「{JOB_LABELS[kind]}」を積みました（ジョブ #{job_id}）。")
+    return redirect(url_for("settings"))
+
+
+def job_response(payload, status=200):
+    response = jsonify(payload)
+    response.status_code = status
+    # 進み具合は刻々と変わるので、キャッシュさせない
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+
+@app.route("/api/v1/jobs", methods=["GET", "POST"])
+def api_jobs():
+    """
+    GET: このユーザー（DB）の最近のジョブ。POST {"kind": "recompute" など}: ジョブを積んで 202 を返す。
+    """
+    if request.method == "POST":
+        kind = (request.get_json(silent=True) or {}).get("kind") or request.form.get("kind")
+        if kind not in MAINTENANCE_JOBS:
+            return job_response({"error": "unknown job", "kinds": list(MAINTENANCE_JOBS)}, 400)
+        job_id = enqueue_job(kind)
+        response = job_response(get_job(job_id), 202)
+        response.headers["Location"] = url_for("api_job", job_id=job_id)
+        return response
+    return job_response({"jobs": list_jobs()})
+
+
+@app.route("/api/v1/jobs/<int:job_id>")
+def api_job(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return job_response({"error": "not found"}, 404)
+    return job_response(job)
+
+
+# gunicorn 起動時にもマイグレーションを流す（各ユーザーのシャードは初めて開いたときに流す。
+# シャードを使うときは共用の cocotoshi.db は開かないので作らない）
+if SHARD_DIR:
+    init_users_db()
+else:
     init_db()
+# 書き出し済みの manifest があれば読むだけ（作り直すのは build-assets と gunicorn の on_starting）
+asset_manifest.update(load_asset_manifest())
+
+
+if __name__ == '__main__':
     app.run(host="0.0.0.0", port=5000, debug=True)
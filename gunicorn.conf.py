@@ -0,0 +1,44 @@
+"""
+ココトシの gunicorn 設定（Procfile から -c gunicorn.conf.py で読む）。
+
+    gunicorn -c gunicorn.conf.py cocotoshi:app
+
+既定の sync ワーカーは1リクエストずつしか処理しないので、遅い /matrix が1本あるだけで
+そのワーカーの後ろに全員が並ぶ。ここではスレッドプール付きの gthread ワーカーを使う。
+  - SQLite の呼び出し中は GIL が外れるので、あるスレッドがDBを待つ間に別のスレッドが描画できる
+  - 接続はスレッドごとに get_db() で使い回す（スレッド数＝ワーカーあたりの接続数。
+    COCOTOSHI_SHARD_DIR でユーザーごとのシャードにしたときは、スレッドあたり最大 COCOTOSHI_SHARD_CONNECTIONS 本）
+  - keep-alive が効くので、APIやチャートの連続リクエストで毎回TCPを張り直さない
+同じ集計への同時アクセスは ResultCache が1回の計算にまとめる。
+
+環境変数で上書きできる:
+  WEB_CONCURRENCY   ワーカー（プロセス）数。既定は CPU コア数
+  GUNICORN_THREADS  ワーカーあたりのスレッド数。既定は 8
+  PORT              待ち受けポート（gunicorn が自動で 0.0.0.0:$PORT にする）
+"""
+import multiprocessing
+import os
+
+worker_class = "gthread"
+# コア数より多くしても GIL の外で並列になる部分は増えず、プロセス間の奪い合いで p99 が悪くなる
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+
+# マイグレーション（init_db）をマスターで1回だけ行ってから fork する。
+# 接続は get_db() が pid を見て fork 後に張り直すので、マスターの接続を子が使うことはない
+preload_app = True
+
+# 同時に受け付ける接続数（ワーカーあたり）と、それを超えたときに待たせる数
+worker_connections = 1000
+backlog = 2048
+keepalive = 5
+
+timeout = 30
+graceful_timeout = 30
+
+
+def on_starting(server):
+    # 静的ファイルのハッシュ名（static/dist）をマスターで書き出してから fork する。
+    # preload_app なのでアプリはもう読み込まれている（import しただけでは static/dist に書かない）
+    import cocotoshi
+    cocotoshi.asset_manifest.update(cocotoshi.load_asset_manifest(rebuild=True))
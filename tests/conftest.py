@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cocotoshi  # noqa: E402
+
+
+@pytest.fixture
+def ledger(tmp_path, monkeypatch):
+    """
+    空の台帳DB（マイグレーション済み）に切り替えて、アプリコンテキストの中でテストを流す。
+    """
+    path = str(tmp_path / "ledger.db")
+    cocotoshi.close_db()
+    cocotoshi.result_cache.clear()
+    cocotoshi.fragment_cache.clear()
+    monkeypatch.setattr(cocotoshi, "DATABASE", path)
+    cocotoshi.init_db(path)
+    with cocotoshi.app.app_context():
+        yield path
+    cocotoshi.close_db()
+    cocotoshi.result_cache.clear()
+    cocotoshi.fragment_cache.clear()
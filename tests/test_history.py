@@ -0,0 +1,47 @@
+import cocotoshi
+
+
+def add_parent(c, date):
+    c.execute("""
+        INSERT INTO trades (type, stock, price, quantity, total, date, feeling, memo, parent_id, code, purpose)
+        VALUES ('buy', '極洋', 1000, 100, 100000, ?, 2, '', NULL, '1301', 0)
+    """, (date,))
+    parent_id = c.lastrowid
+    cocotoshi.refresh_position(c, parent_id)
+    return parent_id
+
+
+def page_ids(trade_tree):
+    return [item.parent.id for item in trade_tree]
+
+
+def test_missing_dates_are_stored_as_empty(ledger):
+    with cocotoshi.get_db() as conn:
+        c = conn.cursor()
+        inserted = add_parent(c, None)
+        updated = add_parent(c, "2025-01-06")
+        c.execute("UPDATE trades SET date = NULL WHERE id = ?", (updated,))
+        c.execute("SELECT date FROM trades WHERE id IN (?, ?) ORDER BY id", (inserted, updated))
+        assert c.fetchall() == [("",), ("",)]
+
+
+def test_cursor_pages_through_undated_parents(ledger):
+    with cocotoshi.get_db() as conn:
+        c = conn.cursor()
+        dated = [add_parent(c, "2025-01-06"), add_parent(c, "2025-02-03")]
+        undated = [add_parent(c, None), add_parent(c, None)]
+
+    c = cocotoshi.get_db().cursor()
+    seen = []
+    trade_tree, total_pages, prev_cursor, next_cursor = cocotoshi.fetch_history_page(c, per_page=1)
+    while trade_tree:
+        seen += page_ids(trade_tree)
+        trade_tree, _, _, next_cursor = cocotoshi.fetch_history_page(
+            c, per_page=1, after=cocotoshi.parse_cursor(next_cursor))
+    assert total_pages == 4
+    assert seen == [dated[1], dated[0], undated[1], undated[0]]
+
+    # 最後のページから「前へ」で戻る
+    trade_tree, _, prev_cursor, _ = cocotoshi.fetch_history_page(
+        c, per_page=1, before=cocotoshi.parse_cursor(f":{undated[0]}"))
+    assert page_ids(trade_tree) == [undated[1]]
@@ -0,0 +1,121 @@
+import io
+
+import cocotoshi
+
+
+def add_parent(c, type, quantity, purpose=0, stock="極洋", code="1301"):
+    c.execute("""
+        INSERT INTO trades (type, stock, price, quantity, total, date, feeling, memo, parent_id, code, purpose)
+        VALUES (?, ?, 1000, ?, ?, '2025-01-06', 2, '', NULL, ?, ?)
+    """, (type, stock, quantity, 1000 * quantity, code, purpose))
+    parent_id = c.lastrowid
+    cocotoshi.refresh_position(c, parent_id)
+    return parent_id
+
+
+def import_csv(text):
+    return cocotoshi.import_trades(io.StringIO("date,code,stock,type,price,quantity,purpose\n" + text))
+
+
+def children(c, parent_id):
+    c.execute("SELECT type, quantity FROM trades WHERE parent_id = ? ORDER BY id", (parent_id,))
+    return c.fetchall()
+
+
+def net(c, parent_id):
+    position = cocotoshi.load_position(c, parent_id)
+    return position.pos_qty - position.short_qty
+
+
+def test_sell_is_split_across_open_chains_oldest_first(ledger):
+    with cocotoshi.get_db() as conn:
+        c = conn.cursor()
+        first = add_parent(c, "buy", 100)
+        second = add_parent(c, "buy", 200)
+        other_purpose = add_parent(c, "buy", 300, purpose=1)
+
+    stats = import_csv("2025/02/03,1301,極洋,売,1200,250,0\n")
+
+    c = cocotoshi.get_db().cursor()
+    assert stats["error_count"] == 0
+    assert stats["children"] == 2
+    assert children(c, first) == [("sell", 100)]
+    assert children(c, second) == [("sell", 150)]
+    assert children(c, other_purpose) == []
+    assert (net(c, first), net(c, second), net(c, other_purpose)) == (0, 50, 300)
+
+
+def test_sell_beyond_open_chains_opens_short(ledger):
+    with cocotoshi.get_db() as conn:
+        c = conn.cursor()
+        first = add_parent(c, "buy", 100)
+        second = add_parent(c, "buy", 200)
+
+    stats = import_csv("2025/02/03,1301,極洋,売,1200,400,0\n")
+
+    c = cocotoshi.get_db().cursor()
+    assert stats["error_count"] == 0
+    assert (stats["children"], stats["parents"]) == (2, 1)
+    assert children(c, first) == [("sell", 100)]
+    assert children(c, second) == [("sell", 200)]
+    c.execute("SELECT id, quantity FROM trades WHERE type = 'sell' AND parent_id IS NULL")
+    short_id, quantity = c.fetchone()
+    assert quantity == 100
+    assert net(c, short_id) == -100
+
+
+def test_exit_matches_stock_and_purpose(ledger):
+    with cocotoshi.get_db() as conn:
+        c = conn.cursor()
+        long_term = add_parent(c, "buy", 100, purpose=2)
+
+    stats = import_csv("2025/02/03,1301,極洋,売,1200,100,0\n")
+
+    c = cocotoshi.get_db().cursor()
+    assert (stats["children"], stats["parents"]) == (0, 1)
+    assert children(c, long_term) == []
+    assert net(c, long_term) == 100
+
+
+def parents(c):
+    c.execute("SELECT id, type, quantity, date FROM trades WHERE parent_id IS NULL ORDER BY id")
+    return c.fetchall()
+
+
+def test_buy_after_closed_chain_opens_new_parent(ledger):
+    stats = import_csv("2025/01/01,1301,極洋,買,1000,100,0\n"
+                       "2025/02/01,1301,極洋,売,1200,100,0\n"
+                       "2025/03/01,1301,極洋,買,900,100,0\n")
+
+    c = cocotoshi.get_db().cursor()
+    assert (stats["parents"], stats["children"], stats["merged"]) == (2, 1, 0)
+    (first, _, first_qty, first_date), (second, _, second_qty, second_date) = parents(c)
+    assert (first_qty, first_date) == (100, "2025-01-01")
+    assert (second_qty, second_date) == (100, "2025-03-01")
+    assert children(c, first) == [("sell", 100)]
+    assert cocotoshi.load_position(c, first).total_profit == 20000
+    assert (net(c, first), net(c, second)) == (0, 100)
+
+
+def test_buy_after_partly_closed_chain_opens_new_parent(ledger):
+    stats = import_csv("2025/01/01,1301,極洋,買,1000,100,0\n"
+                       "2025/02/01,1301,極洋,売,1200,40,0\n"
+                       "2025/03/01,1301,極洋,買,900,100,0\n")
+
+    c = cocotoshi.get_db().cursor()
+    assert (stats["parents"], stats["children"], stats["merged"]) == (2, 1, 0)
+    (first, _, first_qty, first_date), (second, _, _, _) = parents(c)
+    assert (first_qty, first_date) == (100, "2025-01-01")
+    assert cocotoshi.load_position(c, first).total_profit == 8000
+    assert (net(c, first), net(c, second)) == (60, 100)
+
+
+def test_buy_merges_into_open_chain_without_later_children(ledger):
+    stats = import_csv("2025/01/01,1301,極洋,買,1000,100,0\n"
+                       "2025/03/01,1301,極洋,買,900,100,0\n")
+
+    c = cocotoshi.get_db().cursor()
+    assert (stats["parents"], stats["merged"]) == (1, 1)
+    [(first, _, quantity, date)] = parents(c)
+    assert (quantity, date) == (200, "2025-03-01")
+    assert net(c, first) == 200
@@ -0,0 +1,55 @@
+import time
+
+import pytest
+
+import cocotoshi
+
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    monkeypatch.setattr(cocotoshi, "JOBS_DB", str(tmp_path / "jobs.db"))
+    with cocotoshi.jobs_db() as conn:
+        yield conn
+
+
+def job_row(conn, job_id):
+    return conn.execute("SELECT status, attempts, worker FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+
+def test_stale_running_job_is_requeued(ledger, queue):
+    job_id = cocotoshi.enqueue_job("recompute", database=ledger)
+    assert cocotoshi.claim_job(queue, "worker a")[0] == job_id
+
+    # 生存確認が JOB_STALE_SECONDS より古い running は、次に取りに来たワーカーが引き取る
+    queue.execute("UPDATE jobs SET heartbeat = ? WHERE id = ?",
+                  (time.time() - cocotoshi.JOB_STALE_SECONDS - 1, job_id))
+    assert cocotoshi.claim_job(queue, "worker b")[0] == job_id
+    assert job_row(queue, job_id) == ("running", 2, "worker b")
+
+
+def test_stale_job_fails_after_max_attempts(ledger, queue):
+    job_id = cocotoshi.enqueue_job("recompute", database=ledger)
+    cocotoshi.claim_job(queue, "worker a")
+    queue.execute("UPDATE jobs SET attempts = ?, heartbeat = ? WHERE id = ?",
+                  (cocotoshi.JOB_MAX_ATTEMPTS, time.time() - cocotoshi.JOB_STALE_SECONDS - 1, job_id))
+    assert cocotoshi.claim_job(queue, "worker b") is None
+    assert job_row(queue, job_id)[0] == "failed"
+
+
+def test_long_job_without_reports_is_not_requeued(ledger, queue, monkeypatch):
+    monkeypatch.setattr(cocotoshi, "JOB_HEARTBEAT_SECONDS", 0.05)
+    monkeypatch.setattr(cocotoshi, "JOB_STALE_SECONDS", 0.3)
+    stolen = []
+
+    def slow_job(params, report):
+        # report を一度も呼ばずに JOB_STALE_SECONDS より長く掛かる処理
+        time.sleep(0.6)
+        with cocotoshi.jobs_db() as other:
+            stolen.append(cocotoshi.claim_job(other, "worker b"))
+        return {}
+
+    monkeypatch.setitem(cocotoshi.JOB_HANDLERS, "slow", slow_job)
+    job_id = cocotoshi.enqueue_job("slow", database=ledger)
+    assert cocotoshi.run_job(queue, cocotoshi.claim_job(queue, "worker a"))
+    assert stolen == [None]
+    assert job_row(queue, job_id) == ("done", 1, "worker a")
@@ -0,0 +1,38 @@
+import cocotoshi
+
+
+def test_hot_queries_use_indexes(ledger):
+    assert cocotoshi.check_query_plans() == []
+
+
+def test_hot_queries_cover_every_matrix_sort():
+    labels = [label for label, _, _ in cocotoshi.hot_queries()]
+    for sort in cocotoshi.MATRIX_ORDER:
+        assert f"/matrix {sort} page" in labels
+
+
+def test_plan_problems_flags_table_scan_and_sort():
+    plan = [
+        (2, 0, 0, "MATERIALIZE ct"),
+        (5, 2, 0, "SCAN closed_trades"),
+        (9, 2, 0, "USE TEMP B-TREE FOR ORDER BY"),
+        (20, 0, 0, "SCAN ct"),
+        (22, 0, 0, "SEARCH p USING INTEGER PRIMARY KEY (rowid=?)"),
+        (30, 0, 0, "USE TEMP B-TREE FOR ORDER BY"),
+    ]
+    assert cocotoshi.plan_problems(plan) == ["SCAN closed_trades", "USE TEMP B-TREE FOR ORDER BY"]
+
+
+def test_plan_problems_allows_index_scans():
+    plan = [
+        (2, 0, 0, "SCAN positions USING COVERING INDEX idx_positions_last_date"),
+        (5, 0, 0, "SEARCH trades USING INTEGER PRIMARY KEY (rowid=?)"),
+        (7, 0, 0, "SCAN CONSTANT ROW"),
+    ]
+    assert cocotoshi.plan_problems(plan) == []
+
+
+def test_plan_problems_reports_prices_scan(ledger):
+    conn = cocotoshi.get_db()
+    plan = conn.execute("EXPLAIN QUERY PLAN SELECT DISTINCT code FROM prices").fetchall()
+    assert cocotoshi.plan_problems(plan) == ["SCAN prices"]
@@ -0,0 +1,62 @@
+import pytest
+
+import cocotoshi
+
+
+@pytest.fixture
+def shards(tmp_path, monkeypatch):
+    monkeypatch.setattr(cocotoshi, "SHARD_DIR", str(tmp_path))
+    monkeypatch.setattr(cocotoshi.app, "secret_key", "test-secret")
+    cocotoshi.close_db()
+    cocotoshi.result_cache.clear()
+    cocotoshi.init_users_db()
+    yield tmp_path
+    cocotoshi.close_db()
+    cocotoshi.result_cache.clear()
+
+
+def login(client, name):
+    response = client.post("/login", data={"name": name, "password": "password123"})
+    assert response.status_code == 302
+
+
+def test_metrics_and_cache_stats_require_login(shards):
+    client = cocotoshi.app.test_client()
+    assert client.get("/metrics").status_code == 302
+    assert client.get("/api/cache_stats").status_code == 401
+
+
+def test_cache_stats_are_per_user(shards):
+    cocotoshi.create_user("alice", "password123")
+    cocotoshi.create_user("bob", "password123")
+    alice, bob = cocotoshi.app.test_client(), cocotoshi.app.test_client()
+    login(alice, "alice")
+    login(bob, "bob")
+
+    for _ in range(3):
+        assert alice.get("/api/v1/analytics").status_code == 200
+    assert bob.get("/api/v1/analytics").status_code == 200
+
+    alice_stats = alice.get("/api/cache_stats").get_json()
+    bob_stats = bob.get("/api/cache_stats").get_json()
+    assert (alice_stats["hits"], alice_stats["misses"]) == (2, 1)
+    assert (bob_stats["hits"], bob_stats["misses"]) == (0, 1)
+
+
+def test_etag_is_per_user(shards):
+    cocotoshi.create_user("alice", "password123")
+    cocotoshi.create_user("bob", "password123")
+    alice, bob = cocotoshi.app.test_client(), cocotoshi.app.test_client()
+    login(alice, "alice")
+    login(bob, "bob")
+
+    first = alice.get("/api/v1/chains")
+    assert first.status_code == 200
+    assert first.headers["Cache-Control"] == "private, no-cache"
+    assert "Cookie" in first.headers["Vary"]
+    assert alice.get("/api/v1/chains", headers={"If-None-Match": first.headers["ETag"]}).status_code == 304
+
+    # 台帳バージョンが同じでも、別のユーザーの ETag では 304 にならない
+    other = bob.get("/api/v1/chains", headers={"If-None-Match": first.headers["ETag"]})
+    assert other.status_code == 200
+    assert other.headers["ETag"] != first.headers["ETag"]